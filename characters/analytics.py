@@ -0,0 +1,89 @@
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.db.models import Count
+
+from .models import Character
+
+# Query parameter name -> Character field, for grouping and for filtering
+QUERY_FIELDS = {
+    'class': 'character_class',
+    'position': 'position',
+    'user': 'user__username',
+}
+MAX_GROUP_FIELDS = 2
+# Rollups over every roster are a full scan, so they are cached for a short while
+ROLLUP_CACHE_TIMEOUT = 60
+
+
+class RosterQuery:
+    """Character counts, filtered and grouped by up to two fields, as a single GROUP BY.
+
+    With a user only that user's roster is counted; without one, every
+    roster is (the admin rollup).
+    """
+
+    def __init__(self, group_by=(), filters=None, user=None):
+        group_by = list(group_by)
+        filters = dict(filters or {})
+        for field in group_by + list(filters):
+            if field not in QUERY_FIELDS:
+                raise ValueError(f"Unknown field: {field}. Use one of {', '.join(QUERY_FIELDS)}.")
+        if len(set(group_by)) != len(group_by):
+            raise ValueError('Each field can only be grouped by once.')
+        if len(group_by) > MAX_GROUP_FIELDS:
+            raise ValueError(f'Group by at most {MAX_GROUP_FIELDS} fields.')
+        self.group_by = group_by
+        self.filters = filters
+        self.user = user
+
+    @classmethod
+    def from_params(cls, params, user=None):
+        """Build a query from ?group_by=class,position&position=Tank style parameters."""
+        group_by = [field.strip() for field in params.get('group_by', '').split(',') if field.strip()]
+        filters = {field: params[field] for field in QUERY_FIELDS if params.get(field)}
+        return cls(group_by, filters, user)
+
+    def queryset(self):
+        characters = Character.objects.all() if self.user is None else Character.objects.filter(user=self.user)
+        return characters.filter(**{QUERY_FIELDS[field]: value for field, value in self.filters.items()})
+
+    def run(self):
+        characters = self.queryset()
+        if not self.group_by:
+            return {'group_by': [], 'total': characters.count()}
+
+        fields = [QUERY_FIELDS[field] for field in self.group_by]
+        rows = list(characters.values_list(*fields).annotate(count=Count('id')).order_by(*fields))
+        result = {'group_by': self.group_by, 'total': sum(row[-1] for row in rows)}
+        if len(fields) == 1:
+            result['counts'] = dict(rows)
+            return result
+
+        # Cross-tab: row and column labels once, then a matrix of counts
+        row_labels = sorted({row for row, _, _ in rows})
+        column_labels = sorted({column for _, column, _ in rows})
+        row_index = {label: index for index, label in enumerate(row_labels)}
+        column_index = {label: index for index, label in enumerate(column_labels)}
+        counts = [[0] * len(column_labels) for _ in row_labels]
+        for row, column, count in rows:
+            counts[row_index[row]][column_index[column]] = count
+        result.update(rows=row_labels, columns=column_labels, counts=counts)
+        return result
+
+    def cache_key(self):
+        query = json.dumps([self.group_by, sorted(self.filters.items())])
+        return f"roster_rollup:{hashlib.sha256(query.encode('utf-8')).hexdigest()}"
+
+    def get(self):
+        # A user's roster is counted through the (user, position) index on
+        # every request; only the cross-roster rollups are cached
+        if self.user is not None:
+            return self.run()
+        key = self.cache_key()
+        result = cache.get(key)
+        if result is None:
+            result = self.run()
+            cache.set(key, result, ROLLUP_CACHE_TIMEOUT)
+        return result
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class CsvtoexcelConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'characters'
+
+    def ready(self):
+        from . import character_management, export_cache, stats  # noqa: F401 connects the roster_changed receivers
+        from .rules import load_rules
+
+        # Build the position/class lookup tables once, and fail at startup on bad overrides
+        load_rules()
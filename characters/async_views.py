@@ -0,0 +1,180 @@
+import asyncio
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.http import StreamingHttpResponse
+from django.shortcuts import redirect, render
+
+from .character_management import CharacterImporter, RosterSync, file_digest
+from .export_cache import build_export, cache_path, export_etag, open_cached_file
+from .exporters import EXPORTERS, EXPORT_CHUNK_SIZE, EXPORT_FIELDS, STREAM_BLOCK_SIZE
+from .models import Character, ImportJob, RosterVersion
+from .profiling import record_rows
+from .views import add_export_headers, error_context, export_not_modified
+
+# Row chunks fetched ahead of the encoder; bounds memory while an export is built
+EXPORT_PREFETCH_CHUNKS = 2
+
+arender = sync_to_async(render)
+_cpu_executor = None
+
+
+class ExportAborted(Exception):
+    pass
+
+
+def cpu_executor():
+    # Parsing and xlsx encoding run here, never on the event loop; the pool
+    # size caps how many of them run at once however many requests are waiting
+    global _cpu_executor
+    if _cpu_executor is None:
+        _cpu_executor = ThreadPoolExecutor(max_workers=settings.CHARACTER_ASYNC_CPU_WORKERS,
+                                           thread_name_prefix='characters-cpu')
+    return _cpu_executor
+
+
+async def run_cpu_bound(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor(), function, *args)
+
+
+@login_required
+async def upload_csv(request):
+    if request.method != "POST":
+        return await arender(request, 'upload_csv.html')
+    # Multipart parsing reads the spooled body from disk, so it stays off the loop too
+    files = await run_cpu_bound(getattr, request, 'FILES')
+    if not files.get('file'):
+        return await arender(request, 'upload_csv.html')
+
+    csv_file = files['file']
+    user = await request.auser()
+    sync = bool(request.POST.get('sync'))
+    fail_fast = bool(request.POST.get('fail_fast'))
+
+    if csv_file.size > settings.CHARACTER_IMPORT_ASYNC_THRESHOLD:
+        import_job = await ImportJob.objects.acreate(user=user, file=csv_file, sync=sync, fail_fast=fail_fast)
+        return await arender(request, 'upload_csv.html', {'import_job': import_job})
+
+    max_errors = settings.CHARACTER_UPLOAD_FAIL_FAST_ERRORS if fail_fast else None
+    if sync:
+        # Hashing and parsing run in the executor; only the roster lookups
+        # and the writes need the request's database connection
+        roster_sync = RosterSync(user, max_errors=max_errors)
+        file_hash = await run_cpu_bound(file_digest, csv_file)
+        if await sync_to_async(roster_sync.file_unchanged)(file_hash):
+            error_messages = []
+        else:
+            batches = await run_cpu_bound(roster_sync.parse, csv_file)
+            error_messages = await sync_to_async(roster_sync.run_batches)(batches, file_hash)
+        record_rows(request, roster_sync.rows_parsed)
+        if error_messages:
+            return await arender(request, 'upload_csv.html', error_context(roster_sync.report))
+        return await arender(request, 'upload_csv.html', {'import_diff': roster_sync.diff})
+
+    # Parse and run the per-row checks in the executor; only the cross-row
+    # checks and the insert need the request's database connection
+    importer = CharacterImporter(user, max_errors=max_errors)
+    batches = await run_cpu_bound(importer.parse, csv_file)
+    error_messages = await sync_to_async(importer.run_batches)(batches)
+    record_rows(request, importer.rows_parsed)
+
+    if error_messages:
+        return await arender(request, 'upload_csv.html', error_context(importer.report))
+    return redirect('character_list')
+
+
+@login_required
+async def export_to_excel(request):
+    user = await request.auser()
+    if not await Character.objects.filter(user=user).aexists():
+        return await arender(request, 'character_list.html', {
+            'characters': [],
+            'error_message': 'No characters available to export.'
+        })
+    return await export_response(request, EXPORTERS['xlsx'], user)
+
+
+async def export_response(request, exporter, user):
+    roster_version, _ = await RosterVersion.objects.aget_or_create(user_id=user.pk)
+    etag = export_etag(roster_version, exporter)
+    not_modified = export_not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+
+    export_file = await open_cached_export(exporter, user, roster_version)
+    response = StreamingHttpResponse(iter_file(export_file), content_type=exporter.content_type)
+    stat = await sync_to_async(os.fstat, thread_sensitive=False)(export_file.fileno())
+    response['Content-Length'] = stat.st_size
+    return add_export_headers(response, exporter, etag)
+
+
+async def open_cached_export(exporter, user, roster_version):
+    path = cache_path(roster_version, exporter)
+    # Opening the file and touching its mtime block, so they stay off the loop
+    export_file = await sync_to_async(open_cached_file, thread_sensitive=False)(path)
+    return export_file or await build_export_async(exporter, user, path)
+
+
+async def build_export_async(exporter, user, path):
+    # Rows are fetched on the event loop's side and handed over a queue to the
+    # encoder in the executor, a few chunks ahead of it
+    loop = asyncio.get_running_loop()
+    chunks = queue.SimpleQueue()
+    free_slots = asyncio.Semaphore(EXPORT_PREFETCH_CHUNKS)
+    feeder = asyncio.ensure_future(feed_rows(chunks, free_slots, user))
+    rows = queued_rows(chunks, lambda: loop.call_soon_threadsafe(free_slots.release))
+    try:
+        return await loop.run_in_executor(cpu_executor(), build_export, exporter, rows, path)
+    finally:
+        # If the encoder failed or the request went away, stop the feeder and
+        # end the encoder, which then removes its partial file
+        feeder.cancel()
+        chunks.put(ExportAborted('The export was cancelled.'))
+
+
+def fetch_rows(user, after_id, limit):
+    # id is the first export field, so each chunk continues after the last id seen
+    return list(Character.objects.filter(user=user, id__gt=after_id)
+                .order_by('id')
+                .values_list(*EXPORT_FIELDS)[:limit])
+
+
+async def feed_rows(chunks, free_slots, user):
+    try:
+        after_id = 0
+        while True:
+            await free_slots.acquire()
+            chunk = await sync_to_async(fetch_rows)(user, after_id, EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.put(chunk)
+            after_id = chunk[-1][0]
+        chunks.put(None)
+    except Exception as exc:
+        chunks.put(exc)
+
+
+def queued_rows(chunks, release_slot):
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            return
+        if isinstance(chunk, Exception):
+            raise ExportAborted('Reading the roster failed.') from chunk
+        release_slot()
+        yield from chunk
+
+
+async def iter_file(export_file):
+    try:
+        while True:
+            block = await sync_to_async(export_file.read, thread_sensitive=False)(STREAM_BLOCK_SIZE)
+            if not block:
+                return
+            yield block
+    finally:
+        export_file.close()
@@ -0,0 +1,184 @@
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.db import transaction
+from django.test import RequestFactory, override_settings
+from django.urls import reverse
+
+from .character_management import CharacterBatchValidator, CharacterManager, CharacterValidator
+from .parsing import CharacterParser
+from .readers import sniff_format
+from .stats import CharacterStats
+
+BENCHMARK_USERNAME = '__benchmark__'
+DEFAULT_SIZES = (1000, 10000, 100000)
+# A stage regresses when its throughput drops, or its peak memory grows, by more than this
+DEFAULT_TOLERANCE = 0.2
+ROLE_LEADERS = [
+    ('Warrior', 'Tank'),
+    ('Paladin', 'Tank'),
+    ('Shaman', 'Heal'),
+    ('Druid', 'Heal'),
+]
+CLASS_POSITIONS = [
+    ('Warlock', 'Ranged_Dps'),
+    ('Mage', 'Ranged_Dps'),
+    ('Shaman', 'Ranged_Dps'),
+    ('Warrior', 'Melee_Dps'),
+    ('Paladin', 'Melee_Dps'),
+    ('Druid', 'Melee_Dps'),
+]
+
+
+def synthetic_characters(count):
+    # A roster that passes validation: the first rows fill the Tank and Heal
+    # caps and everything after them is DPS
+    for i in range(count):
+        if i < len(ROLE_LEADERS):
+            character_class, position = ROLE_LEADERS[i]
+        else:
+            character_class, position = CLASS_POSITIONS[i % len(CLASS_POSITIONS)]
+        yield {'Name': f'Bench{i}', 'Class': character_class, 'Position': position}
+
+
+def write_roster(path, count):
+    """Write count characters as Key: Value blocks, the layout of sample_info.csv."""
+    with open(path, 'w', encoding='utf-8', newline='\n') as roster_file:
+        for character in synthetic_characters(count):
+            roster_file.write(f"Name: {character['Name']}\nClass: {character['Class']}\n"
+                              f"Position: {character['Position']}\n\n")
+
+
+class StageRecorder:
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.results = {}
+
+    @contextmanager
+    def stage(self, name, rows):
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            peak_memory = tracemalloc.get_traced_memory()[1] - memory_before if self.trace_memory else None
+            if started_tracing:
+                tracemalloc.stop()
+        self.results[name] = {
+            'rows': rows,
+            'seconds': seconds,
+            'rows_per_second': rows / seconds if seconds else None,
+            'peak_memory': peak_memory,
+        }
+
+
+def legacy_validate(characters):
+    # The per-row loop uploads used before CharacterBatchValidator
+    names = set()
+    tank_count = heal_count = 0
+    errors = []
+    for character_data in characters:
+        tank_count += character_data['Position'] == 'Tank'
+        heal_count += character_data['Position'] == 'Heal'
+        errors += CharacterValidator.validate(character_data, names, tank_count, heal_count)
+    return errors
+
+
+def warm_up():
+    # pandas, numpy and openpyxl load on first use; load them, and run one
+    # small validation, before any stage is timed so no stage pays for it
+    import numpy  # noqa: F401
+    import openpyxl  # noqa: F401
+    import pandas  # noqa: F401
+
+    CharacterBatchValidator().validate(list(synthetic_characters(len(ROLE_LEADERS) + len(CLASS_POSITIONS))))
+
+
+def run_benchmark(size, workdir, trace_memory=True):
+    """Time each hot path against a synthetic roster of size characters."""
+    from .views import character_list, export_to_excel
+
+    path = os.path.join(workdir, f'roster_{size}.csv')
+    write_roster(path, size)
+    warm_up()
+    recorder = StageRecorder(trace_memory)
+
+    with recorder.stage('parse', size), open(path, 'rb') as roster_file:
+        characters = list(CharacterParser.iter_blocks(File(roster_file)))
+    with recorder.stage('validate (per row)', size):
+        legacy_validate(characters)
+    with recorder.stage('validate (batch)', size):
+        CharacterBatchValidator().validate(characters)
+    with recorder.stage('read + validate upload', size), open(path, 'rb') as roster_file:
+        source = File(roster_file)
+        validator = CharacterBatchValidator()
+        for batch in sniff_format(source).read_batches(source):
+            validator.validate(batch)
+
+    factory = RequestFactory()
+    # Exports are cached on disk per user and roster version, and both are
+    # rolled back below, so the benchmark gets a throwaway export cache
+    with override_settings(CHARACTER_EXPORT_CACHE_DIR=os.path.join(workdir, 'exports')), transaction.atomic():
+        user = User.objects.create(username=BENCHMARK_USERNAME)
+        try:
+            with recorder.stage('create', size):
+                CharacterManager.bulk_create_characters(characters, user)
+
+            request = factory.get(reverse('character_list'))
+            request.user = user
+            with recorder.stage('character_list', size):
+                character_list(request).content
+
+            for stage in ('export_to_excel', 'export_to_excel (cached)'):
+                request = factory.get(reverse('export_to_excel'))
+                request.user = user
+                with recorder.stage(stage, size):
+                    for _ in export_to_excel(request).streaming_content:
+                        pass
+        finally:
+            # Nothing is kept: not the rows, and not the stats cached for this user id
+            transaction.set_rollback(True)
+            CharacterStats.invalidate(user.pk)
+
+    return recorder.results
+
+
+def compare_to_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Return a message for each stage that got slower or hungrier than the baseline allows."""
+    regressions = []
+    for size, stages in results.items():
+        for stage, result in stages.items():
+            expected = baseline.get(size, {}).get(stage)
+            if not expected:
+                continue
+            if expected.get('rows_per_second') and result['rows_per_second'] is not None \
+                    and result['rows_per_second'] < expected['rows_per_second'] * (1 - tolerance):
+                regressions.append(f"{size} rows, {stage}: {result['rows_per_second']:,.0f} rows/s "
+                                   f"vs {expected['rows_per_second']:,.0f} in the baseline")
+            if expected.get('peak_memory') and result['peak_memory'] is not None \
+                    and result['peak_memory'] > expected['peak_memory'] * (1 + tolerance):
+                regressions.append(f"{size} rows, {stage}: peak memory {result['peak_memory']:,} bytes "
+                                   f"vs {expected['peak_memory']:,} in the baseline")
+    return regressions
+
+
+def load_baseline(path):
+    with open(path, encoding='utf-8') as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_results(path, results):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
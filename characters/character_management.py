@@ -1,29 +1,166 @@
 
-import pandas as pd
-
-from .models import Character
+import base64
+import hashlib
+import json
 from collections import Counter
+from itertools import islice
+from zipfile import BadZipFile
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q
+from django.dispatch import receiver
+
+from .analytics import RosterQuery
+from .error_reports import ErrorReport
+from .models import Character, ImportedRecord, ImportedRoster, RoleCount
+from .readers import rewind, sniff_format
+from .rules import get_rules, MAX_TANKS, MAX_HEALS, POSITION_CLASS_MAP  # noqa: F401
+from .signals import roster_changed, send_roster_changed
+
+BULK_CREATE_BATCH_SIZE = 1000
+VALIDATION_BATCH_SIZE = 5000
+# RosterFormatError, UnicodeDecodeError and pandas' ParserError are all ValueErrors;
+# a truncated xlsx shows up as a BadZipFile
+UNREADABLE_FILE_ERRORS = (ValueError, BadZipFile)
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+# Largest id list a single bulk delete or edit accepts
+MAX_BULK_IDS = 5000
+
+# Per-row error codes returned by CharacterBatchValidator, combined as bit flags
+ERROR_NAME_CAPITAL = 1
+ERROR_DUPLICATE_IN_FILE = 2
+ERROR_DUPLICATE_IN_ROSTER = 4
+ERROR_POSITION_CLASS = 8
+ERROR_TOO_MANY_TANKS = 16
+ERROR_TOO_MANY_HEALS = 32
+
+ROLE_PLURALS = {'Tank': 'Tanks', 'Heal': 'Healers'}
+
+UNKNOWN_VALUE_ERROR = 'Only characters with a known class and position can be saved.'
+
+# Parsed characters keep their class and position as an index into these
+CHARACTER_CLASSES = tuple(value for value, _ in Character.CLASS_CHOICES)
+POSITIONS = tuple(value for value, _ in Character.POSITION_CHOICES)
+CLASS_CODES = {value: code for code, value in enumerate(CHARACTER_CLASSES)}
+POSITION_CODES = {value: code for code, value in enumerate(POSITIONS)}
 
-MAX_TANKS = 2
-MAX_HEALS = 2
-POSITION_CLASS_MAP = {
-    'Tank': ['Paladin', 'Warrior'],
-    'Heal': ['Shaman', 'Paladin', 'Druid'],
-    'Ranged_Dps': ['Warlock', 'Mage', 'Shaman'],
-    'Melee_Dps': ['Warrior', 'Paladin', 'Druid'],
-}
+
+class RoleCapExceeded(Exception):
+    def __init__(self, position, cap):
+        self.position = position
+        self.cap = cap
+        super().__init__(f"There cannot be more than {cap} {ROLE_PLURALS.get(position, position)}.")
 
 class BaseCharacter:
-    def __init__(self, name, character_class, position, user):
+    """One parsed character, with its class and position held as choice codes."""
+
+    __slots__ = ('name', 'class_code', 'position_code')
+
+    def __init__(self, name, class_code, position_code):
         self.name = name
-        self.character_class = character_class
-        self.position = position
-        self.user = user
+        self.class_code = class_code
+        self.position_code = position_code
+
+    @property
+    def character_class(self):
+        return CHARACTER_CLASSES[self.class_code]
+
+    @property
+    def position(self):
+        return POSITIONS[self.position_code]
+
+class CharacterBatch:
+    """Parsed characters stored column-wise: a list of names and int8 class and position codes.
+
+    A row costs its name plus two bytes; every row shares the class and
+    position strings in CHARACTER_CLASSES and POSITIONS. A value that is
+    not a choice gets code -1, and only batches without one can be saved.
+    """
+
+    __slots__ = ('names', 'class_codes', 'position_codes')
+
+    def __init__(self, names, class_codes, position_codes):
+        self.names = names
+        self.class_codes = class_codes
+        self.position_codes = position_codes
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Pack a DataFrame, or a dict of Name, Class and Position lists."""
+        import numpy as np
+        import pandas as pd
+
+        names = columns['Name']
+        return cls(
+            names.tolist() if hasattr(names, 'tolist') else list(names),
+            pd.Categorical(columns['Class'], categories=CHARACTER_CLASSES).codes.astype(np.int8, copy=False),
+            pd.Categorical(columns['Position'], categories=POSITIONS).codes.astype(np.int8, copy=False),
+        )
+
+    @classmethod
+    def iter_from_records(cls, records, batch_size):
+        """Pack Name/Class/Position mappings batch_size at a time."""
+        import numpy as np
+
+        records = iter(records)
+        while True:
+            names, class_codes, position_codes = [], [], []
+            for record in islice(records, batch_size):
+                names.append(record['Name'])
+                class_codes.append(CLASS_CODES.get(record['Class'], -1))
+                position_codes.append(POSITION_CODES.get(record['Position'], -1))
+            if not names:
+                return
+            yield cls(names, np.array(class_codes, dtype=np.int8), np.array(position_codes, dtype=np.int8))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for name, class_code, position_code in zip(self.names, self.class_codes.tolist(),
+                                                   self.position_codes.tolist()):
+            yield BaseCharacter(name, class_code, position_code)
+
+    def take(self, rows):
+        """Return the rows at a slice or a list of indexes as a new batch."""
+        names = self.names[rows] if isinstance(rows, slice) else [self.names[row] for row in rows]
+        return CharacterBatch(names, self.class_codes[rows], self.position_codes[rows])
+
+    def position_counts(self):
+        import numpy as np
+
+        if len(self) and self.position_codes.min() < 0:
+            # bincount cannot count the -1 code, and the batch could not be saved anyway
+            raise ValueError(UNKNOWN_VALUE_ERROR)
+        counts = np.bincount(self.position_codes, minlength=len(POSITIONS))
+        return {position: int(count) for position, count in zip(POSITIONS, counts) if count}
+
+    def to_frame(self):
+        import numpy as np
+        import pandas as pd
+
+        # Code -1 picks the extra trailing empty string
+        return pd.DataFrame({
+            'Name': self.names,
+            'Class': np.array(CHARACTER_CLASSES + ('',), dtype=object)[self.class_codes],
+            'Position': np.array(POSITIONS + ('',), dtype=object)[self.position_codes],
+        })
+
+    def to_models(self, user):
+        if len(self) and (self.class_codes.min() < 0 or self.position_codes.min() < 0):
+            raise ValueError(UNKNOWN_VALUE_ERROR)
+        return [
+            Character(name=name, character_class=CHARACTER_CLASSES[class_code],
+                      position=POSITIONS[position_code], user=user)
+            for name, class_code, position_code in zip(self.names, self.class_codes.tolist(),
+                                                       self.position_codes.tolist())
+        ]
 
 class CharacterValidator:
     @staticmethod
     def is_valid_position_class(position, character_class):
-        return position in POSITION_CLASS_MAP and character_class in POSITION_CLASS_MAP[position]
+        return get_rules().is_legal(position, character_class)
 
     @staticmethod
     def name_starts_with_capital(name):
@@ -45,23 +182,291 @@ class CharacterValidator:
         if not CharacterValidator.is_valid_position_class(character_data.get('Position'), character_data.get('Class')):
             errors.append(f"{character_data['Class']} cannot be a {character_data['Position']}.")
 
-        if tank_count > MAX_TANKS:
-            errors.append("There cannot be more than 2 Tanks.")
-        if heal_count > MAX_HEALS:
-            errors.append("There cannot be more than 2 Healers.")
+        rules = get_rules()
+        if tank_count > rules.role_cap('Tank'):
+            errors.append(f"There cannot be more than {rules.role_cap('Tank')} Tanks.")
+        if heal_count > rules.role_cap('Heal'):
+            errors.append(f"There cannot be more than {rules.role_cap('Heal')} Healers.")
 
         return errors
 
+    @staticmethod
+    def validate_batch(characters, user=None):
+        return CharacterBatchValidator(user).validate(characters)
+
+class CharacterBatchValidator:
+    """Validates parsed uploads a batch at a time, carrying names and role counts across batches."""
+
+    def __init__(self, user=None):
+        self.user = user
+        self.rules = get_rules()
+        self.seen_names = set()
+        self.tank_count = 0
+        self.heal_count = 0
+        if user is not None:
+            role_counts = CharacterManager.role_counts(user)
+            self.tank_count = role_counts.get('Tank', 0)
+            self.heal_count = role_counts.get('Heal', 0)
+
+    @staticmethod
+    def to_frame(characters):
+        import pandas as pd
+
+        if isinstance(characters, CharacterBatch):
+            return characters.to_frame()
+        frame = characters if isinstance(characters, pd.DataFrame) else pd.DataFrame(characters)
+        return frame.reindex(columns=['Name', 'Class', 'Position']).fillna('').astype(str)
+
+    def validate(self, characters):
+        frame = self.to_frame(characters)
+        return self.validate_rows(frame) | self.validate_across_rows(frame)
+
+    def validate_rows(self, characters):
+        # Checks that only look at one row at a time; these need no shared
+        # state, so separate pieces of an upload can run them in parallel.
+        import numpy as np
+        import pandas as pd
+
+        frame = self.to_frame(characters)
+        codes = np.zeros(len(frame), dtype=np.int8)
+
+        codes[~frame['Name'].str[:1].str.isupper().to_numpy(dtype=bool)] |= ERROR_NAME_CAPITAL
+
+        # Unknown values get code -1, which indexes the all-False last row/column
+        position_codes = pd.Categorical(frame['Position'], categories=self.rules.positions).codes
+        class_codes = pd.Categorical(frame['Class'], categories=self.rules.classes).codes
+        codes[~self.rules.legal_matrix[position_codes, class_codes]] |= ERROR_POSITION_CLASS
+
+        return codes
+
+    def validate_across_rows(self, characters):
+        # Duplicate names and role caps depend on every row seen so far, so
+        # batches must be fed through here in upload order.
+        import numpy as np
+
+        frame = self.to_frame(characters)
+        names = frame['Name']
+        positions = frame['Position']
+        codes = np.zeros(len(frame), dtype=np.int8)
+
+        name_list = names.tolist()
+        if self.seen_names:
+            seen_before = np.fromiter(map(self.seen_names.__contains__, name_list), dtype=bool, count=len(name_list))
+            codes[seen_before] |= ERROR_DUPLICATE_IN_FILE
+        codes[names.duplicated().to_numpy()] |= ERROR_DUPLICATE_IN_FILE
+        self.seen_names.update(name_list)
+
+        if self.user is not None and len(frame):
+            # One IN query per batch of names for those already in the roster
+            unique_names = names.unique().tolist()
+            existing = set()
+            for offset in range(0, len(unique_names), VALIDATION_BATCH_SIZE):
+                existing.update(Character.objects.filter(
+                    user=self.user, name__in=unique_names[offset:offset + VALIDATION_BATCH_SIZE]
+                ).values_list('name', flat=True))
+            if existing:
+                codes[names.isin(list(existing)).to_numpy()] |= ERROR_DUPLICATE_IN_ROSTER
+
+        is_tank = (positions == 'Tank').to_numpy()
+        is_heal = (positions == 'Heal').to_numpy()
+        codes[is_tank & (np.cumsum(is_tank) + self.tank_count > self.rules.role_cap('Tank'))] |= ERROR_TOO_MANY_TANKS
+        codes[is_heal & (np.cumsum(is_heal) + self.heal_count > self.rules.role_cap('Heal'))] |= ERROR_TOO_MANY_HEALS
+        self.tank_count += int(is_tank.sum())
+        self.heal_count += int(is_heal.sum())
+
+        return codes
+
+    @staticmethod
+    def errors(characters, codes, first_row=1):
+        """Yield (row, field, code, message) for each flag in codes, numbering rows from first_row."""
+        import numpy as np
+
+        rules = get_rules()
+        frame = CharacterBatchValidator.to_frame(characters)
+        for row in np.flatnonzero(codes):
+            code = codes[row]
+            name, character_class, position = frame.iloc[row]
+            row_number = first_row + int(row)
+            if code & ERROR_NAME_CAPITAL:
+                yield row_number, 'Name', 'name_capital', 'Name must start with a capital letter.'
+            if code & ERROR_DUPLICATE_IN_FILE:
+                yield row_number, 'Name', 'duplicate_in_file', f"Names cannot be the same: {name}"
+            if code & ERROR_DUPLICATE_IN_ROSTER:
+                yield row_number, 'Name', 'duplicate_in_roster', f"Names cannot be the same for the same user: {name}"
+            if code & ERROR_POSITION_CLASS:
+                yield row_number, 'Class', 'position_class', f"{character_class} cannot be a {position}."
+            if code & ERROR_TOO_MANY_TANKS:
+                yield (row_number, 'Position', 'too_many_tanks',
+                       f"There cannot be more than {rules.role_cap('Tank')} Tanks.")
+            if code & ERROR_TOO_MANY_HEALS:
+                yield (row_number, 'Position', 'too_many_heals',
+                       f"There cannot be more than {rules.role_cap('Heal')} Healers.")
+
+    @staticmethod
+    def error_messages(characters, codes):
+        return [message for _, _, _, message in CharacterBatchValidator.errors(characters, codes)]
+
 class CharacterManager:
     @staticmethod
     def create_character(character_data, user):
-        return Character.objects.create(
-            name=character_data['Name'],
-            character_class=character_data['Class'],
-            position=character_data['Position'],
-            user=user
+        with transaction.atomic():
+            CharacterManager.adjust_role_counts(user, {character_data['Position']: 1})
+            character = Character.objects.create(
+                name=character_data['Name'],
+                character_class=character_data['Class'],
+                position=character_data['Position'],
+                user=user
+            )
+        send_roster_changed(user.pk)
+        return character
+
+    @staticmethod
+    def bulk_create_characters(characters, user, batch_size=BULK_CREATE_BATCH_SIZE):
+        return CharacterManager.bulk_create_batches(
+            CharacterBatch.iter_from_records(characters, batch_size), user, batch_size
         )
 
+    @staticmethod
+    def bulk_create_batches(batches, user, batch_size=BULK_CREATE_BATCH_SIZE, sender=None):
+        # Rows are written batch_size at a time inside a single transaction,
+        # so a failing batch rolls back everything written so far. Model
+        # instances only exist for the rows of the INSERT being sent.
+        created = 0
+        with transaction.atomic():
+            for batch in batches:
+                for offset in range(0, len(batch), batch_size):
+                    chunk = batch.take(slice(offset, offset + batch_size))
+                    CharacterManager.adjust_role_counts(user, chunk.position_counts())
+                    Character.objects.bulk_create(chunk.to_models(user))
+                    created += len(chunk)
+        if created:
+            send_roster_changed(user.pk, sender)
+        return created
+
+    @staticmethod
+    def delete_character(character):
+        with transaction.atomic():
+            CharacterManager.adjust_role_counts(character.user_id, {character.position: -1})
+            character.delete()
+        send_roster_changed(character.user_id)
+
+    @staticmethod
+    def bulk_delete_characters(user, ids=None, position=None, character_class=None):
+        """Delete the user's characters matching every given criterion in one DELETE.
+
+        With no ids, position or class, the whole roster goes. Returns how
+        many characters were deleted.
+        """
+        characters = Character.objects.filter(user=user)
+        if ids is not None:
+            characters = characters.filter(id__in=ids)
+        if position:
+            characters = characters.filter(position=position)
+        if character_class:
+            characters = characters.filter(character_class=character_class)
+
+        with transaction.atomic():
+            CharacterManager.lock_role_counts(user)
+            deltas = {position: -count for position, count in
+                      characters.values_list('position').annotate(count=Count('id')).order_by()}
+            CharacterManager.adjust_role_counts(user, deltas)
+            deleted = characters.delete()[0]
+        if deleted:
+            send_roster_changed(user.pk)
+        return deleted
+
+    @staticmethod
+    def bulk_change_position(user, ids, position):
+        """Move the user's characters with these ids to position in one UPDATE.
+
+        Raises ValueError if a character's class cannot play the position,
+        and RoleCapExceeded if the move would pass the position's cap.
+        Returns how many characters changed position.
+        """
+        rules = get_rules()
+        if position not in rules.position_codes:
+            raise ValueError(f"Unknown position: {position}.")
+        characters = Character.objects.filter(user=user, id__in=ids).exclude(position=position)
+
+        with transaction.atomic():
+            CharacterManager.lock_role_counts(user)
+            groups = list(characters.values_list('position', 'character_class')
+                          .annotate(count=Count('id')).order_by('character_class'))
+            for _, character_class, _ in groups:
+                if not rules.is_legal(position, character_class):
+                    raise ValueError(f"{character_class} cannot be a {position}.")
+            deltas = Counter()
+            for old_position, _, count in groups:
+                deltas[old_position] -= count
+                deltas[position] += count
+            CharacterManager.adjust_role_counts(user, deltas)
+            updated = characters.update(position=position)
+        if updated:
+            send_roster_changed(user.pk)
+        return updated
+
+    @staticmethod
+    def lock_role_counts(user):
+        """Lock all of a user's role counters until the transaction ends, creating any that are missing.
+
+        Every write to a roster moves a counter first, so while they are held
+        the set of characters a bulk operation counted cannot change under it.
+        """
+        user_id = getattr(user, 'pk', user)
+        locked = set(RoleCount.objects.select_for_update().filter(user_id=user_id).values_list('position', flat=True))
+        missing = [position for position in POSITIONS if position not in locked]
+        if missing:
+            counts = dict(Character.objects.filter(user_id=user_id, position__in=missing)
+                          .values_list('position').annotate(count=Count('id')).order_by())
+            RoleCount.objects.bulk_create([
+                RoleCount(user_id=user_id, position=position, count=counts.get(position, 0))
+                for position in missing
+            ], ignore_conflicts=True)
+            list(RoleCount.objects.select_for_update().filter(user_id=user_id, position__in=missing)
+                 .values_list('id', flat=True))
+
+    @staticmethod
+    def adjust_role_counts(user, deltas):
+        """Move a user's per-position counters by deltas, raising RoleCapExceeded past a cap.
+
+        Call inside the transaction that writes the rows, before writing them.
+        Increases to a capped position are a conditional UPDATE that matches
+        no row once the cap would be passed, and the row stays locked until
+        commit, so two requests can never both take the last slot.
+        """
+        user_id = getattr(user, 'pk', user)
+        rules = get_rules()
+        # Decreases first, so moving characters between roles never trips a cap on the way
+        for position, delta in sorted(deltas.items(), key=lambda item: item[1]):
+            if not delta:
+                continue
+            cap = rules.role_cap(position)
+            counters = RoleCount.objects.filter(user_id=user_id, position=position)
+            if delta > 0 and cap is not None:
+                counters = counters.filter(count__lte=cap - delta)
+            if counters.update(count=F('count') + delta):
+                continue
+            # No counter yet for this user and position: start it from the roster
+            # as it is before this write, then try again
+            RoleCount.objects.get_or_create(user_id=user_id, position=position, defaults={
+                'count': Character.objects.filter(user_id=user_id, position=position).count(),
+            })
+            if not counters.update(count=F('count') + delta):
+                raise RoleCapExceeded(position, cap)
+
+    @staticmethod
+    def role_counts(user):
+        counts = dict(RoleCount.objects.filter(user=user).values_list('position', 'count'))
+        if len(counts) < len(Character.POSITION_CHOICES):
+            # Positions without a counter yet are counted from the roster
+            missing = dict(Character.objects.filter(user=user)
+                           .exclude(position__in=list(counts))
+                           .values_list('position')
+                           .annotate(count=Count('id'))
+                           .order_by())
+            counts.update(missing)
+        return counts
+
     @staticmethod
     def count_characters_by_position(user, position):
         return Character.objects.filter(position=position, user=user).count()
@@ -79,12 +484,314 @@ class CharacterManager:
         return Character.objects.filter(user=user).order_by('name')
 
     @staticmethod
-    def aggregate_character_classes(user):
+    def encode_cursor(character):
+        return base64.urlsafe_b64encode(json.dumps([character.name, character.id]).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            name, character_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except (ValueError, TypeError, UnicodeError):
+            raise ValueError('Invalid cursor.')
+        if not isinstance(name, str) or not isinstance(character_id, int):
+            raise ValueError('Invalid cursor.')
+        return name, character_id
+
+    @staticmethod
+    def page_characters(user, cursor=None, page_size=DEFAULT_PAGE_SIZE, position=None, character_class=None):
+        # Keyset pagination on (name, id): each page seeks past the last row of
+        # the previous one, so page N costs the same as page 1.
         characters = Character.objects.filter(user=user)
-        class_counts = Counter(character.character_class for character in characters)
-        return dict(class_counts)
+        if position:
+            characters = characters.filter(position=position)
+        if character_class:
+            characters = characters.filter(character_class=character_class)
+        if cursor:
+            name, character_id = CharacterManager.decode_cursor(cursor)
+            characters = characters.filter(Q(name__gt=name) | Q(name=name, id__gt=character_id))
+
+        page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+        page = list(characters.order_by('name', 'id')[:page_size + 1])
+        next_cursor = CharacterManager.encode_cursor(page[page_size - 1]) if len(page) > page_size else None
+        return page[:page_size], next_cursor
 
     @staticmethod
-    def export_characters_to_dataframe(user):
-        characters = Character.objects.filter(user=user).values()
-        return pd.DataFrame(list(characters))
+    def aggregate_character_classes(user):
+        return RosterQuery(['class'], user=user).run()['counts']
+
+class CharacterImporter:
+    def __init__(self, user, on_progress=None, reader=None, max_errors=None):
+        self.user = user
+        self.on_progress = on_progress
+        self.reader = reader
+        # With max_errors set, reading stops once that many errors are found
+        self.report = ErrorReport(user.pk, max_errors)
+        self.rows_parsed = 0
+        self.rows_inserted = 0
+
+    @property
+    def error_messages(self):
+        return self.report.messages()
+
+    def read_batches(self, source):
+        # Parsing and the per-row checks touch no database, so this part can
+        # run on any thread
+        reader = self.reader or sniff_format(source)
+        validator = CharacterBatchValidator()
+        for batch in reader.read_batches(source, VALIDATION_BATCH_SIZE):
+            yield batch, validator.validate_rows(batch)
+
+    def parse(self, source):
+        """Read the whole upload up front, recording an unreadable file as an error."""
+        batches = []
+        invalid_rows = 0
+        try:
+            for batch, row_codes in self.read_batches(source):
+                batches.append((batch, row_codes))
+                invalid_rows += int((row_codes != 0).sum())
+                if self.report.max_errors is not None and invalid_rows >= self.report.max_errors:
+                    break
+        except UNREADABLE_FILE_ERRORS as exc:
+            self.report.add(None, '', 'unreadable_file', f"The file could not be read: {exc}")
+            return []
+        return batches
+
+    def validated_batches(self, batches):
+        validator = CharacterBatchValidator(self.user)
+        for batch, row_codes in batches:
+            first_row = self.rows_parsed + 1
+            self.rows_parsed += len(batch)
+            codes = row_codes | validator.validate_across_rows(batch)
+            if codes.any():
+                for error in CharacterBatchValidator.errors(batch, codes, first_row):
+                    self.report.add(*error)
+                    if self.report.full:
+                        break
+
+            if self.on_progress:
+                self.on_progress(self)
+
+            if self.report.full:
+                # Fail fast: the rest of the file is never read
+                return
+            # Once anything is invalid the upload will be rolled back, so stop inserting
+            if not self.report.total:
+                yield CharacterBatch.from_columns(batch)
+
+    def validate_batches(self, batches):
+        try:
+            for _ in self.validated_batches(batches):
+                pass
+        except UNREADABLE_FILE_ERRORS as exc:
+            self.report.add(None, '', 'unreadable_file', f"The file could not be read: {exc}")
+        finally:
+            self.report.close()
+        return self.error_messages
+
+    def run(self, source):
+        return self.run_batches(self.read_batches(source))
+
+    def run_batches(self, batches):
+        try:
+            with transaction.atomic():
+                self.rows_inserted = CharacterManager.bulk_create_batches(
+                    self.validated_batches(batches), self.user
+                )
+                if self.report.total:
+                    # Keep parsing to report every error, but never leave part of the upload behind
+                    transaction.set_rollback(True)
+                    self.rows_inserted = 0
+        except IntegrityError:
+            # The (user, name) unique constraint caught a name already in the roster
+            self.rows_inserted = 0
+            self.report.add(None, 'Name', 'duplicate_in_roster', 'Names cannot be the same for the same user.')
+        except RoleCapExceeded as exc:
+            # A concurrent request filled the role after this upload was validated
+            self.rows_inserted = 0
+            self.report.add(None, 'Position', 'role_cap', str(exc))
+        except UNREADABLE_FILE_ERRORS as exc:
+            self.rows_inserted = 0
+            self.report.add(None, '', 'unreadable_file', f"The file could not be read: {exc}")
+        finally:
+            self.report.close()
+        return self.error_messages
+
+
+def file_digest(source):
+    digest = hashlib.sha256()
+    for chunk in rewind(source).chunks():
+        digest.update(chunk)
+    rewind(source)
+    return digest.hexdigest()
+
+
+def record_digest(name, character_class, position):
+    return hashlib.blake2b(f"{name}\x1f{character_class}\x1f{position}".encode('utf-8'), digest_size=16).hexdigest()
+
+
+class RosterSync:
+    """Treats an upload as the user's full imported roster and writes only what changed.
+
+    Characters added by hand or by a plain upload are left alone unless the
+    file names them, in which case the sync takes them over.
+    """
+
+    def __init__(self, user, reader=None, max_errors=None):
+        self.user = user
+        self.reader = reader
+        self.report = ErrorReport(user.pk, max_errors)
+        self.rows_parsed = 0
+        self.rows_inserted = 0
+        self.diff = {'file_unchanged': False, 'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+
+    @property
+    def error_messages(self):
+        return self.report.messages()
+
+    def read(self, source):
+        """Read the whole upload as CharacterBatches, recording the problems found within single rows."""
+        reader = self.reader or sniff_format(source)
+        validator = CharacterBatchValidator()
+        batches = []
+        first_row = 1
+        for frame in reader.read_batches(source, VALIDATION_BATCH_SIZE):
+            row_codes = validator.validate_rows(frame)
+            if row_codes.any():
+                for error in CharacterBatchValidator.errors(frame, row_codes, first_row):
+                    self.report.add(*error)
+                    if self.report.full:
+                        return batches
+            batches.append(CharacterBatch.from_columns(frame))
+            first_row += len(frame)
+        return batches
+
+    def run(self, source):
+        try:
+            file_hash = file_digest(source)
+            if self.file_unchanged(file_hash):
+                return self.error_messages
+            return self.apply(self.parse(source), file_hash)
+        finally:
+            self.report.close()
+
+    def file_unchanged(self, file_hash):
+        # Byte-for-byte the file we synced last time, and nothing else has
+        # changed the roster since: nothing to parse or write
+        self.diff['file_unchanged'] = ImportedRoster.objects.filter(user=self.user, file_hash=file_hash).exists()
+        return self.diff['file_unchanged']
+
+    def parse(self, source):
+        """Read the whole upload, or record an unreadable file as an error and return None.
+
+        Like hashing the file, this touches no database, so it can run on any thread.
+        """
+        try:
+            batches = self.read(source)
+        except UNREADABLE_FILE_ERRORS as exc:
+            self.report.add(None, '', 'unreadable_file', f"The file could not be read: {exc}")
+            return None
+        self.rows_parsed = sum(map(len, batches))
+        return batches
+
+    def run_batches(self, batches, file_hash):
+        try:
+            return self.apply(batches, file_hash)
+        finally:
+            self.report.close()
+
+    def apply(self, batches, file_hash):
+        if batches is None or self.report.full:
+            return self.error_messages
+
+        current = {
+            name: (character_id, character_class, position)
+            for character_id, name, character_class, position in Character.objects.filter(user=self.user)
+            .values_list('id', 'name', 'character_class', 'position').iterator(chunk_size=VALIDATION_BATCH_SIZE)
+        }
+        records = dict(ImportedRecord.objects.filter(user=self.user).values_list('name', 'digest'))
+        file_names = {name for batch in batches for name in batch.names}
+
+        # Role caps apply to the roster as it will be after the sync: the
+        # characters it keeps untouched plus everything in the file
+        kept_positions = [position for name, (_, _, position) in current.items()
+                          if name not in file_names and name not in records]
+        validator = CharacterBatchValidator()
+        validator.tank_count = kept_positions.count('Tank')
+        validator.heal_count = kept_positions.count('Heal')
+        first_row = 1
+        for batch in batches:
+            codes = validator.validate_across_rows(batch)
+            if codes.any():
+                for error in CharacterBatchValidator.errors(batch, codes, first_row):
+                    self.report.add(*error)
+                    if self.report.full:
+                        return self.error_messages
+            first_row += len(batch)
+        if self.report.total:
+            return self.error_messages
+
+        inserted, updated, changed_records = [], [], []
+        # Role counters move before the rows do; inserts adjust their own
+        role_deltas = Counter()
+        for batch in batches:
+            new_rows = []
+            for row, character in enumerate(batch):
+                name, character_class, position = character.name, character.character_class, character.position
+                digest = record_digest(name, character_class, position)
+                existing = current.get(name)
+                if existing is None:
+                    new_rows.append(row)
+                elif existing[1:] != (character_class, position):
+                    updated.append(Character(id=existing[0], character_class=character_class, position=position))
+                    role_deltas[existing[2]] -= 1
+                    role_deltas[position] += 1
+                else:
+                    self.diff['unchanged'] += 1
+                if records.get(name) != digest:
+                    changed_records.append(ImportedRecord(user=self.user, name=name, digest=digest))
+            if new_rows:
+                inserted.append(batch.take(new_rows))
+        removed = [name for name in records if name not in file_names]
+        for name in removed:
+            if name in current:
+                role_deltas[current[name][2]] -= 1
+
+        try:
+            with transaction.atomic():
+                CharacterManager.adjust_role_counts(self.user, role_deltas)
+                for offset in range(0, len(removed), VALIDATION_BATCH_SIZE):
+                    chunk = removed[offset:offset + VALIDATION_BATCH_SIZE]
+                    self.diff['deleted'] += Character.objects.filter(user=self.user, name__in=chunk).delete()[0]
+                    ImportedRecord.objects.filter(user=self.user, name__in=chunk).delete()
+                self.rows_inserted = CharacterManager.bulk_create_batches(inserted, self.user, sender=RosterSync)
+                Character.objects.bulk_update(updated, ['character_class', 'position'],
+                                              batch_size=BULK_CREATE_BATCH_SIZE)
+                ImportedRecord.objects.bulk_create(
+                    changed_records, batch_size=BULK_CREATE_BATCH_SIZE,
+                    update_conflicts=True, unique_fields=['user', 'name'], update_fields=['digest'],
+                )
+                ImportedRoster.objects.update_or_create(user=self.user, defaults={'file_hash': file_hash})
+        except IntegrityError:
+            # Someone else added one of these names while the diff was computed
+            self.rows_inserted = 0
+            self.report.add(None, 'Name', 'duplicate_in_roster', 'Names cannot be the same for the same user.')
+            return self.error_messages
+        except RoleCapExceeded as exc:
+            self.rows_inserted = 0
+            self.report.add(None, 'Position', 'role_cap', str(exc))
+            return self.error_messages
+
+        self.diff['inserted'] = self.rows_inserted
+        self.diff['updated'] = len(updated)
+        if updated or self.diff['deleted']:
+            # bulk_create_characters already announced any inserts
+            send_roster_changed(self.user.id, RosterSync)
+        return self.error_messages
+
+
+@receiver(roster_changed)
+def forget_synced_file(sender, user_id, **kwargs):
+    # Any change but a sync's own takes the roster away from the last synced
+    # file, so syncing that file again has to diff it instead of skipping it
+    if sender is not RosterSync:
+        ImportedRoster.objects.filter(user_id=user_id).delete()
@@ -0,0 +1,255 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .character_management import VALIDATION_BATCH_SIZE, CharacterBatchValidator
+from .models import ChunkedUpload, ImportJob
+from .parsing import REQUIRED_FIELDS, CharacterParser, last_record_boundary
+from .readers import READERS, sniff_format
+
+# Under MEDIA_ROOT, one directory per upload with the file and its parsed segments
+UPLOAD_DIR = 'uploads'
+DATA_FILE = 'roster'
+WRITE_BLOCK_SIZE = 64 * 1024
+CHECKSUM_HEADER = 'X-Chunk-SHA256'
+
+
+class ChunkError(ValueError):
+    """A chunk or request the upload cannot take: wrong index, length or checksum."""
+
+
+class UploadConflict(ValueError):
+    """A request that contradicts what the upload already holds."""
+
+
+def upload_dir(upload):
+    return os.path.join(settings.MEDIA_ROOT, UPLOAD_DIR, upload.token)
+
+
+def data_name(upload):
+    # Relative to MEDIA_ROOT, so the finished file is handed to its ImportJob as it is
+    return f'{UPLOAD_DIR}/{upload.token}/{DATA_FILE}'
+
+
+def data_path(upload):
+    return os.path.join(upload_dir(upload), DATA_FILE)
+
+
+def segment_path(upload, start):
+    return os.path.join(upload_dir(upload), f'segment-{start:015d}.npz')
+
+
+def start_upload(user, size, sync=False, fail_fast=False):
+    max_size = settings.CHARACTER_CHUNKED_UPLOAD_MAX_SIZE
+    if not 0 < size <= max_size:
+        raise ChunkError(f'The file size must be between 1 and {max_size} bytes.')
+    remove_expired_uploads()
+    # A sync diffs the whole file against the roster, so only plain imports parse ahead
+    upload = ChunkedUpload.objects.create(user=user, size=size, chunk_size=settings.CHARACTER_UPLOAD_CHUNK_SIZE,
+                                          sync=sync, fail_fast=fail_fast, parse_ahead=not sync)
+    os.makedirs(upload_dir(upload), exist_ok=True)
+    # Chunks are written in place at their offsets, in whatever order they arrive
+    with open(data_path(upload), 'wb') as data_file:
+        data_file.truncate(size)
+    return upload
+
+
+def write_chunk(upload, index, stream, checksum):
+    """Store chunk index, read from stream, then parse up to a chunk's worth of the prefix it completed."""
+    if not 0 <= index < upload.chunk_count:
+        raise ChunkError(f'The chunk index must be between 0 and {upload.chunk_count - 1}.')
+    checksum = (checksum or '').strip().lower()
+    if len(checksum) != 64:
+        raise ChunkError(f"Send the chunk's SHA-256 as hex in the {CHECKSUM_HEADER} header.")
+    if is_stored(upload, index, checksum):
+        return upload
+
+    start = index * upload.chunk_size
+    length = min(upload.chunk_size, upload.size - start)
+    # Staged in a file of its own, so two requests racing with the same chunk
+    # never both write into the roster
+    descriptor, staged_path = tempfile.mkstemp(dir=upload_dir(upload), suffix='.chunk')
+    try:
+        with os.fdopen(descriptor, 'w+b') as staged_file:
+            digest = hashlib.sha256()
+            written = 0
+            for block in iter(lambda: stream.read(WRITE_BLOCK_SIZE), b''):
+                written += len(block)
+                if written > length:
+                    raise ChunkError(f'Chunk {index} must be {length} bytes.')
+                digest.update(block)
+                staged_file.write(block)
+            if written != length:
+                raise ChunkError(f'Chunk {index} must be {length} bytes.')
+            if digest.hexdigest() != checksum:
+                raise ChunkError(f'Chunk {index} does not match its checksum; send it again.')
+
+            # The row lock serializes concurrent chunks, so one of them at a
+            # time writes itself into place, records itself and moves the
+            # parsed prefix along
+            with transaction.atomic():
+                upload = ChunkedUpload.objects.select_for_update().get(pk=upload.pk)
+                if is_stored(upload, index, checksum):
+                    return upload
+                staged_file.seek(0)
+                with open(data_path(upload), 'r+b') as data_file:
+                    data_file.seek(start)
+                    shutil.copyfileobj(staged_file, data_file, WRITE_BLOCK_SIZE)
+                    # On disk before it is recorded as received, so a resumed upload can rely on it
+                    data_file.flush()
+                    os.fsync(data_file.fileno())
+                upload.received[str(index)] = checksum
+                # A chunk's worth per request, so the request that completes
+                # a long prefix does not parse all of it; the import job
+                # parses whatever is left
+                parse_prefix(upload, max_bytes=upload.chunk_size)
+                upload.save()
+    finally:
+        os.unlink(staged_path)
+    return upload
+
+
+def is_stored(upload, index, checksum):
+    if upload.import_job_id is not None:
+        raise UploadConflict('This upload has already been finalized.')
+    if str(index) not in upload.received:
+        return False
+    # A retry after a lost response: the stored chunk stands
+    if upload.received[str(index)] != checksum:
+        raise UploadConflict(f'Chunk {index} was already received with a different checksum.')
+    return True
+
+
+def received_prefix_end(upload):
+    missing = upload.missing_chunks()
+    return missing[0] * upload.chunk_size if missing else upload.size
+
+
+def parse_prefix(upload, max_bytes=None):
+    """Parse a Key: Value upload's received prefix, up to its last complete record.
+
+    Each stretch is parsed once, run through the per-row checks and stored
+    as a segment that the import job reads instead of the file. With
+    max_bytes set, parsing stops once at least that many bytes are parsed.
+    Other formats, and anything that fails to decode, are left to the
+    import job.
+    """
+    if not upload.parse_ahead:
+        return
+    end = received_prefix_end(upload)
+    if end == 0:
+        return
+    validator = CharacterBatchValidator()
+    window = upload.chunk_size
+    stop_at = end if max_bytes is None else min(end, upload.parsed_offset + max_bytes)
+    with open(data_path(upload), 'rb') as data_file:
+        if upload.parsed_offset == 0 and sniff_format(data_file) is not READERS['blocks']:
+            upload.parse_ahead = False
+            return
+        while upload.parsed_offset < stop_at:
+            start = upload.parsed_offset
+            data_file.seek(start)
+            data = data_file.read(min(window, end - start))
+            stop = len(data) if start + len(data) == upload.size else last_record_boundary(data)
+            if not stop:
+                if start + len(data) == end:
+                    # The record runs on into a chunk that has not arrived yet
+                    return
+                window *= 2
+                continue
+            try:
+                lines = data[:stop].decode('utf-8-sig' if start == 0 else 'utf-8').split('\n')
+            except UnicodeDecodeError:
+                upload.parse_ahead = False
+                return
+            columns = next(CharacterParser.parse_columns(lines))
+            save_segment(upload, start, start + stop, columns, validator.validate_rows(columns))
+            upload.parsed_offset = start + stop
+            upload.parsed_rows += len(columns['Name'])
+            window = upload.chunk_size
+
+
+def save_segment(upload, start, end, columns, row_codes):
+    import numpy as np
+
+    # Each column is stored as its UTF-8 bytes run together plus where each
+    # value ends; a fixed-width string array would make every value as wide
+    # as the longest one
+    arrays = {}
+    for field in REQUIRED_FIELDS:
+        encoded = [value.encode('utf-8') for value in columns[field]]
+        arrays[field] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        arrays[f'{field}_ends'] = np.cumsum([len(value) for value in encoded], dtype=np.int64)
+    path = segment_path(upload, start)
+    partial_path = f'{path}.part'
+    with open(partial_path, 'wb') as segment_file:
+        np.savez(segment_file, end=np.int64(end), row_codes=row_codes, **arrays)
+    os.replace(partial_path, path)
+
+
+def load_column(segment, field):
+    data = segment[field].tobytes()
+    starts = [0] + segment[f'{field}_ends'].tolist()
+    return [data[start:end].decode('utf-8') for start, end in zip(starts, starts[1:])]
+
+
+def is_parsed(upload):
+    return upload.parse_ahead and upload.parsed_offset == upload.size
+
+
+def finish_parse(upload):
+    """Parse what the chunk requests of a finalized upload left, returning whether it is all parsed."""
+    parse_prefix(upload)
+    upload.save(update_fields=['parse_ahead', 'parsed_offset', 'parsed_rows', 'updated_at'])
+    return is_parsed(upload)
+
+
+def parsed_batches(upload, batch_size=VALIDATION_BATCH_SIZE):
+    """Yield (batch, row codes) from the parsed segments in file order, like CharacterImporter.read_batches."""
+    import numpy as np
+    import pandas as pd
+
+    # Each segment names where the next one starts, so a segment left behind
+    # by an interrupted parse is never picked up
+    start = 0
+    while start < upload.parsed_offset:
+        with np.load(segment_path(upload, start)) as segment:
+            frame = pd.DataFrame({field: load_column(segment, field) for field in REQUIRED_FIELDS})
+            row_codes = segment['row_codes']
+            start = int(segment['end'])
+        for offset in range(0, len(frame), batch_size):
+            yield frame.iloc[offset:offset + batch_size], row_codes[offset:offset + batch_size]
+
+
+def finalize_upload(upload):
+    """Queue a complete upload for the import worker, handing it the file and the parsed segments."""
+    with transaction.atomic():
+        upload = ChunkedUpload.objects.select_for_update().get(pk=upload.pk)
+        if upload.import_job_id is not None:
+            # A retried finalize gets the job the first one queued
+            return upload
+        missing = upload.missing_chunks()
+        if missing:
+            raise ChunkError(f'{len(missing)} chunks are missing, starting with chunk {missing[0]}.')
+        upload.import_job = ImportJob.objects.create(user=upload.user, file=data_name(upload), sync=upload.sync,
+                                                     fail_fast=upload.fail_fast)
+        upload.save(update_fields=['import_job', 'updated_at'])
+    return upload
+
+
+def discard_upload(upload):
+    shutil.rmtree(upload_dir(upload), ignore_errors=True)
+    upload.delete()
+
+
+def remove_expired_uploads():
+    """Drop uploads that were never finalized and have not been touched for CHARACTER_CHUNKED_UPLOAD_MAX_AGE seconds."""
+    cutoff = timezone.now() - timedelta(seconds=settings.CHARACTER_CHUNKED_UPLOAD_MAX_AGE)
+    for upload in ChunkedUpload.objects.filter(import_job__isnull=True, updated_at__lt=cutoff):
+        discard_upload(upload)
@@ -0,0 +1,103 @@
+import csv
+import io
+import os
+import re
+import secrets
+import time
+from collections import Counter, namedtuple
+
+from django.conf import settings
+
+REPORT_FIELDS = ('row', 'field', 'code', 'message')
+# Errors kept in memory, to show on the upload page and store on an import job
+ERROR_SUMMARY_SIZE = 50
+REPORT_TOKEN = re.compile(r'^[0-9a-f]{32}$')
+
+# row is the record's 1-based position in the file, None for a file-level error
+UploadError = namedtuple('UploadError', REPORT_FIELDS)
+
+
+def report_path(user_id, token):
+    return os.path.join(settings.CHARACTER_ERROR_REPORT_DIR, f'{user_id}-{token}.csv')
+
+
+def open_report(user_id, token):
+    """Return the user's report with this token as an open binary file, or None."""
+    if not REPORT_TOKEN.match(token):
+        return None
+    try:
+        return open(report_path(user_id, token), 'rb')
+    except FileNotFoundError:
+        return None
+
+
+def iter_report_rows(report_file):
+    rows = csv.reader(io.TextIOWrapper(report_file, encoding='utf-8', newline=''))
+    next(rows, None)  # header
+    for row, field, code, message in rows:
+        yield int(row) if row else None, field, code, message
+
+
+class ErrorReport:
+    """An upload's errors, held in bounded memory however many there are.
+
+    Counts per error code and the first summary_size errors stay in memory;
+    every error is also appended to a CSV file under
+    CHARACTER_ERROR_REPORT_DIR, which the user can download by its token.
+    With max_errors set, full becomes true once that many errors are in so
+    the caller can stop reading the file.
+    """
+
+    def __init__(self, user_id, max_errors=None, summary_size=ERROR_SUMMARY_SIZE):
+        self.user_id = user_id
+        self.max_errors = max_errors
+        self.summary_size = summary_size
+        self.summary = []
+        self.counts = Counter()
+        self.total = 0
+        self.token = None
+        self.report_file = None
+        self.writer = None
+
+    def add(self, row, field, code, message):
+        error = UploadError(row, field, code, message)
+        self.total += 1
+        self.counts[code] += 1
+        if len(self.summary) < self.summary_size:
+            self.summary.append(error)
+        if self.writer is None:
+            self.open()
+        self.writer.writerow(error)
+
+    def open(self):
+        os.makedirs(settings.CHARACTER_ERROR_REPORT_DIR, exist_ok=True)
+        remove_expired_reports()
+        self.token = secrets.token_hex(16)
+        self.report_file = open(report_path(self.user_id, self.token), 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.report_file)
+        self.writer.writerow(REPORT_FIELDS)
+
+    def close(self):
+        if self.report_file is not None and not self.report_file.closed:
+            self.report_file.close()
+
+    @property
+    def full(self):
+        return self.max_errors is not None and self.total >= self.max_errors
+
+    def messages(self):
+        return [error.message for error in self.summary]
+
+    def most_common(self):
+        return self.counts.most_common()
+
+
+def remove_expired_reports():
+    """Delete reports older than CHARACTER_ERROR_REPORT_MAX_AGE seconds."""
+    cutoff = time.time() - settings.CHARACTER_ERROR_REPORT_MAX_AGE
+    for entry in os.scandir(settings.CHARACTER_ERROR_REPORT_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
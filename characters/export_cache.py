@@ -0,0 +1,93 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.dispatch import receiver
+
+from .exporters import iter_character_rows
+from .models import RosterVersion
+from .signals import roster_changed
+
+PARTIAL_SUFFIX = '.part'
+
+
+def roster_key(roster_version):
+    return f'{roster_version.user_id}-{roster_version.token}-{roster_version.version}'
+
+
+def cache_path(roster_version, exporter):
+    return os.path.join(settings.CHARACTER_EXPORT_CACHE_DIR, f'{roster_key(roster_version)}.{exporter.extension}')
+
+
+def export_etag(roster_version, exporter):
+    # Weak, because a rebuilt xlsx holds the same rows but a different zip timestamp
+    return f'W/"{roster_key(roster_version)}-{exporter.format}"'
+
+
+def open_cached_export(exporter, user, roster_version):
+    """Return the export of this roster version as an open file, building it on a miss."""
+    path = cache_path(roster_version, exporter)
+    return open_cached_file(path) or build_export(exporter, iter_character_rows(user), path)
+
+
+def open_cached_file(path):
+    """Open a cached export and mark it used, or return None if it is not cached."""
+    try:
+        export_file = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    # The mtime is the last use, which is what evict_exports orders by
+    os.utime(path)
+    return export_file
+
+
+def build_export(exporter, rows, path):
+    directory = settings.CHARACTER_EXPORT_CACHE_DIR
+    os.makedirs(directory, exist_ok=True)
+    descriptor, partial_path = tempfile.mkstemp(dir=directory, suffix=PARTIAL_SUFFIX)
+    try:
+        with os.fdopen(descriptor, 'wb') as output:
+            for block in exporter.stream(rows):
+                output.write(block)
+        # Renamed into place so a concurrent request never serves a half-written file
+        os.replace(partial_path, path)
+    except BaseException:
+        os.unlink(partial_path)
+        raise
+    export_file = open(path, 'rb')
+    evict_exports(keep=path)
+    return export_file
+
+
+def evict_exports(keep=None):
+    """Drop the least recently used exports until the cache fits CHARACTER_EXPORT_CACHE_MAX_BYTES."""
+    directory = settings.CHARACTER_EXPORT_CACHE_DIR
+    entries = []
+    for entry in os.scandir(directory):
+        if not entry.is_file() or entry.name.endswith(PARTIAL_SUFFIX):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= settings.CHARACTER_EXPORT_CACHE_MAX_BYTES:
+            return
+        if path == keep:
+            continue
+        try:
+            # Open handles keep working after the unlink on POSIX
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+@receiver(roster_changed)
+def bump_roster_version(sender, user_id, **kwargs):
+    # roster_changed fires again after commit, so the version also moves past
+    # anything exported while the change was still uncommitted
+    RosterVersion.bump(user_id)
@@ -0,0 +1,173 @@
+import csv
+import json
+import tempfile
+from io import StringIO
+from itertools import islice
+
+from .models import Character
+
+EXPORT_FIELDS = ('id', 'name', 'character_class', 'position', 'user_id')
+INTEGER_FIELDS = ('id', 'user_id')
+EXPORT_CHUNK_SIZE = 2000
+STREAM_BLOCK_SIZE = 64 * 1024
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+DEFAULT_EXPORT_FORMAT = 'xlsx'
+
+EXPORTERS = {}
+
+
+def register_exporter(exporter_class):
+    exporter = exporter_class()
+    EXPORTERS[exporter.format] = exporter
+    return exporter_class
+
+
+def iter_character_rows(user, chunk_size=EXPORT_CHUNK_SIZE):
+    return (Character.objects.filter(user=user)
+            .order_by('id')
+            .values_list(*EXPORT_FIELDS)
+            .iterator(chunk_size=chunk_size))
+
+
+def iter_row_chunks(rows, chunk_size=EXPORT_CHUNK_SIZE):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def stream_file(output):
+    output.seek(0)
+    while True:
+        block = output.read(STREAM_BLOCK_SIZE)
+        if not block:
+            return
+        yield block
+
+
+class Exporter:
+    format = None
+    content_type = None
+    extension = None
+
+    def is_available(self):
+        return True
+
+    def stream(self, rows, header=EXPORT_FIELDS):
+        raise NotImplementedError
+
+
+@register_exporter
+class XlsxExporter(Exporter):
+    format = 'xlsx'
+    content_type = XLSX_CONTENT_TYPE
+    extension = 'xlsx'
+
+    def stream(self, rows, header=EXPORT_FIELDS):
+        from openpyxl import Workbook
+
+        # A write-only workbook spools each row to a temporary file instead of
+        # keeping cell objects around, so memory stays flat however many rows
+        # are exported. The finished file is then sent in fixed-size blocks.
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('Sheet1')
+        sheet.append(header)
+        for row in rows:
+            sheet.append(row)
+
+        with tempfile.TemporaryFile() as output:
+            workbook.save(output)
+            yield from stream_file(output)
+
+
+@register_exporter
+class CsvExporter(Exporter):
+    format = 'csv'
+    content_type = 'text/csv'
+    extension = 'csv'
+
+    def stream(self, rows, header=EXPORT_FIELDS):
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header)
+        for chunk in iter_row_chunks(rows):
+            writer.writerows(chunk)
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+
+
+@register_exporter
+class JsonLinesExporter(Exporter):
+    format = 'jsonl'
+    content_type = 'application/x-ndjson'
+    extension = 'jsonl'
+
+    def stream(self, rows, header=EXPORT_FIELDS):
+        for chunk in iter_row_chunks(rows):
+            yield ''.join(json.dumps(dict(zip(header, row))) + '\n' for row in chunk).encode('utf-8')
+
+
+@register_exporter
+class ParquetExporter(Exporter):
+    format = 'parquet'
+    content_type = 'application/vnd.apache.parquet'
+    extension = 'parquet'
+
+    def is_available(self):
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def stream(self, rows, header=EXPORT_FIELDS):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([(field, pa.int64() if field in INTEGER_FIELDS else pa.string()) for field in header])
+        # Each chunk becomes one row group, so only a chunk of rows is ever
+        # held as Arrow columns at once
+        with tempfile.TemporaryFile() as output:
+            with pq.ParquetWriter(output, schema) as writer:
+                for chunk in iter_row_chunks(rows):
+                    columns = list(zip(*chunk))
+                    writer.write_table(pa.table(dict(zip(header, columns)), schema=schema))
+            yield from stream_file(output)
+
+
+def available_formats():
+    return [fmt for fmt, exporter in EXPORTERS.items() if exporter.is_available()]
+
+
+def negotiate_format(request, fmt=None):
+    """Pick an exporter from the URL, a ?format= parameter or the Accept header."""
+    fmt = fmt or request.GET.get('format')
+    if fmt:
+        exporter = EXPORTERS.get(fmt.lower())
+        return exporter if exporter and exporter.is_available() else None
+
+    accepted = []
+    for position, media_range in enumerate(request.headers.get('Accept', '*/*').split(',')):
+        media_type, *params = [part.strip() for part in media_range.split(';')]
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.append((-quality, position, media_type.lower()))
+
+    for _, _, media_type in sorted(accepted):
+        if media_type in ('*/*', 'application/*'):
+            return EXPORTERS[DEFAULT_EXPORT_FORMAT]
+        for exporter in EXPORTERS.values():
+            if exporter.content_type == media_type and exporter.is_available():
+                return exporter
+    return None
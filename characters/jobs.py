@@ -0,0 +1,141 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .character_management import CharacterImporter, RosterSync
+from .chunked_uploads import discard_upload, finish_parse, parsed_batches
+from .models import ChunkedUpload, ImportJob
+
+WORKER_POLL_INTERVAL = 2.0
+STALE_JOB_MESSAGE = 'The import stopped before it finished; upload the file again.'
+
+logger = logging.getLogger(__name__)
+
+
+def fail_stale_jobs():
+    """Fail running jobs that have saved no progress for CHARACTER_IMPORT_JOB_TIMEOUT seconds.
+
+    Their worker died partway through, so nothing else would ever finish them
+    and the upload page would keep polling.
+    """
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=settings.CHARACTER_IMPORT_JOB_TIMEOUT)
+    with transaction.atomic():
+        jobs = list(ImportJob.objects.select_for_update(skip_locked=True)
+                    .filter(status=ImportJob.RUNNING, heartbeat_at__lt=cutoff))
+        for job in jobs:
+            job.error_messages = (job.error_messages + [STALE_JOB_MESSAGE])[:ImportJob.MAX_STORED_ERRORS]
+            job.error_count += 1
+            job.status = ImportJob.FAILED
+            job.finished_at = now
+            job.save(update_fields=['status', 'finished_at', 'error_messages', 'error_count'])
+    for job in jobs:
+        discard_job_files(job)
+    return len(jobs)
+
+
+def claim_next_job():
+    fail_stale_jobs()
+    # skip_locked lets several workers poll the same table without handing
+    # the same job to two of them.
+    with transaction.atomic():
+        job = (ImportJob.objects.select_for_update(skip_locked=True)
+               .filter(status=ImportJob.PENDING)
+               .order_by('created_at')
+               .first())
+        if job is None:
+            return None
+        job.status = ImportJob.RUNNING
+        job.started_at = job.heartbeat_at = timezone.now()
+        job.save(update_fields=['status', 'started_at', 'heartbeat_at'])
+    return job
+
+
+def save_progress(job, importer):
+    job.rows_parsed = importer.rows_parsed
+    job.rows_inserted = importer.rows_inserted
+    job.error_count = importer.report.total
+    job.error_counts = dict(importer.report.counts)
+    job.error_messages = importer.error_messages[:ImportJob.MAX_STORED_ERRORS]
+    job.error_report = importer.report.token or ''
+    job.heartbeat_at = timezone.now()
+    job.save(update_fields=['rows_parsed', 'rows_inserted', 'error_count', 'error_counts', 'error_messages',
+                            'error_report', 'heartbeat_at'])
+
+
+def discard_job_files(job, upload=None):
+    job.file.delete(save=False)
+    upload = upload or ChunkedUpload.objects.filter(import_job=job).first()
+    if upload is not None:
+        discard_upload(upload)
+
+
+def run_import_job(job):
+    # Validation runs outside any transaction so progress updates are visible
+    # to the polling endpoint; the insert pass then runs as one transaction.
+    max_errors = settings.CHARACTER_UPLOAD_FAIL_FAST_ERRORS if job.fail_fast else None
+    upload = ChunkedUpload.objects.filter(import_job=job).first()
+    if upload is not None and finish_parse(upload):
+        # Parsed while its chunks were arriving, bar what finish_parse just
+        # caught up on: read the parsed segments, not the file
+        def read_batches(importer):
+            return parsed_batches(upload)
+    else:
+        def read_batches(importer):
+            return importer.read_batches(job.file)
+    validation = CharacterImporter(job.user, on_progress=lambda importer: save_progress(job, importer),
+                                   max_errors=max_errors)
+    try:
+        if job.sync:
+            # A sync reads the whole file before diffing it, so progress is saved once at the end
+            roster_sync = RosterSync(job.user, max_errors=max_errors)
+            roster_sync.run(job.file)
+            save_progress(job, roster_sync)
+            job.diff = roster_sync.diff
+            job.status = ImportJob.FAILED if roster_sync.error_messages else ImportJob.DONE
+            return job
+        validation.validate_batches(read_batches(validation))
+        save_progress(job, validation)
+        if validation.error_messages:
+            job.status = ImportJob.FAILED
+        else:
+            importer = CharacterImporter(job.user)
+            importer.run_batches(read_batches(importer))
+            save_progress(job, importer)
+            # The insert re-checks against the roster, which may have changed since validation
+            job.status = ImportJob.FAILED if importer.error_messages else ImportJob.DONE
+    except Exception as exc:
+        job.error_messages = (job.error_messages + [f"Import failed: {exc}"])[:ImportJob.MAX_STORED_ERRORS]
+        job.error_count += 1
+        job.status = ImportJob.FAILED
+        raise
+    finally:
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'finished_at', 'error_messages', 'error_count', 'diff'])
+        discard_job_files(job, upload)
+    return job
+
+
+def process_pending_jobs():
+    processed = 0
+    while True:
+        job = claim_next_job()
+        if job is None:
+            return processed
+        try:
+            run_import_job(job)
+        except Exception:
+            logger.exception('Import job %s failed', job.id)
+        processed += 1
+
+
+def run_worker(poll_interval=WORKER_POLL_INTERVAL, once=False):
+    while True:
+        process_pending_jobs()
+        if once:
+            return
+        time.sleep(poll_interval)
@@ -0,0 +1,44 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from characters.benchmarks import synthetic_characters
+from characters.character_management import CharacterManager, BULK_CREATE_BATCH_SIZE
+
+BENCH_USERNAME = '__bench_bulk_create__'
+
+
+class Command(BaseCommand):
+    help = 'Compare per-row create_character inserts with bulk_create_characters.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--batch-size', type=int, default=BULK_CREATE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        per_row = self.run_rolled_back(lambda user: [
+            CharacterManager.create_character(character_data, user)
+            for character_data in synthetic_characters(rows)
+        ])
+        bulk = self.run_rolled_back(lambda user: CharacterManager.bulk_create_characters(
+            synthetic_characters(rows), user, batch_size=options['batch_size']
+        ))
+
+        self.stdout.write(f'per-row create_character: {rows} rows in {per_row:.3f}s ({rows / per_row:,.0f} rows/s)')
+        self.stdout.write(f'bulk_create_characters:   {rows} rows in {bulk:.3f}s ({rows / bulk:,.0f} rows/s)')
+        self.stdout.write(self.style.SUCCESS(f'speedup: {per_row / bulk:.1f}x'))
+
+    @staticmethod
+    def run_rolled_back(insert):
+        # Everything happens inside a transaction that is rolled back, so the
+        # benchmark never leaves rows behind in the configured database.
+        with transaction.atomic():
+            user = User.objects.create(username=BENCH_USERNAME)
+            start = time.perf_counter()
+            insert(user)
+            elapsed = time.perf_counter() - start
+            transaction.set_rollback(True)
+        return elapsed
@@ -0,0 +1,101 @@
+import os
+import tempfile
+import time
+from itertools import compress
+
+from django.core.management.base import BaseCommand, CommandError
+
+from characters.character_management import CharacterBatchValidator
+from characters.error_reports import ERROR_SUMMARY_SIZE
+from characters.exporters import EXPORTERS, available_formats
+from characters.parsing import MAPPED_REGION_SIZE, iter_mapped_columns
+
+# The export's own column names, so a converted file can be uploaded again
+CONVERTED_FIELDS = ('name', 'character_class', 'position')
+XLSX_MAX_ROWS = 1048576
+
+
+class Command(BaseCommand):
+    help = ('Convert a Key: Value roster file to xlsx, csv, jsonl or parquet, checking it against the roster '
+            'rules. Runs without the database: the file is memory-mapped and parsed a region at a time.')
+    # Nothing here touches the database, so neither do the system checks
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='Key: Value roster file, like characters/sample_info.csv.')
+        parser.add_argument('output', help='File to write; its extension picks the format unless --format is given.')
+        parser.add_argument('--format', choices=sorted(EXPORTERS), help='Output format.')
+        parser.add_argument('--skip-invalid', action='store_true',
+                            help='Leave invalid rows out of the output instead of failing.')
+        parser.add_argument('--region-size', type=int, default=MAPPED_REGION_SIZE,
+                            help='Approximate bytes of the input parsed at a time.')
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or os.path.splitext(options['output'])[1].lstrip('.').lower()
+        exporter = EXPORTERS.get(fmt)
+        if exporter is None or not exporter.is_available():
+            raise CommandError(f"Cannot write {fmt or 'that'} files; use one of {', '.join(available_formats())}.")
+        if not os.path.isfile(options['input']):
+            raise CommandError(f"No such file: {options['input']}.")
+
+        self.rows = self.written = self.error_count = self.invalid_rows = 0
+        self.skip_invalid = options['skip_invalid']
+        # A sheet also holds the header row
+        self.max_rows = XLSX_MAX_ROWS - 1 if exporter.format == 'xlsx' else None
+        self.too_many_rows = False
+        started = time.perf_counter()
+
+        # Written next to the output and renamed into place, so a failed
+        # conversion never leaves a partial file behind
+        output = os.path.abspath(options['output'])
+        descriptor, partial_path = tempfile.mkstemp(dir=os.path.dirname(output), suffix='.part')
+        try:
+            with os.fdopen(descriptor, 'wb') as output_file:
+                rows = self.valid_rows(options['input'], options['region_size'])
+                for block in exporter.stream(rows, header=CONVERTED_FIELDS):
+                    output_file.write(block)
+            if self.too_many_rows:
+                raise CommandError(f'An xlsx sheet holds at most {self.max_rows} rows; '
+                                   f'convert to csv or parquet instead.')
+            if self.error_count and not self.skip_invalid:
+                raise CommandError(f'{self.error_count} errors found, nothing was written.')
+            os.replace(partial_path, output)
+        except BaseException:
+            os.unlink(partial_path)
+            raise
+
+        seconds = time.perf_counter() - started
+        if self.invalid_rows:
+            self.stderr.write(f'Skipped {self.invalid_rows} invalid rows.')
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {self.written} of {self.rows} characters to {options["output"]} in {seconds:.3f}s'
+            f' ({self.rows / seconds:,.0f} rows/s).' if seconds else f'Wrote {self.written} characters.'
+        ))
+
+    def valid_rows(self, path, region_size):
+        # The same checks as an upload, across the whole file: names must be
+        # unique and the role caps hold for the file as a roster of its own
+        validator = CharacterBatchValidator()
+        for columns in iter_mapped_columns(path, region_size):
+            first_row = self.rows + 1
+            self.rows += len(columns['Name'])
+            codes = validator.validate(columns)
+            rows = zip(columns['Name'], columns['Class'], columns['Position'])
+            if codes.any():
+                for row, _, _, message in CharacterBatchValidator.errors(columns, codes, first_row):
+                    if self.error_count < ERROR_SUMMARY_SIZE:
+                        self.stderr.write(f'Row {row}: {message}')
+                    self.error_count += 1
+                valid = codes == 0
+                self.invalid_rows += len(valid) - int(valid.sum())
+                rows = compress(rows, valid.tolist())
+            if self.error_count and not self.skip_invalid:
+                # The output will be thrown away: keep checking, stop writing
+                continue
+            for row in rows:
+                if self.written == self.max_rows:
+                    # Ending the rows lets the exporter close its file before the command fails
+                    self.too_many_rows = True
+                    return
+                self.written += 1
+                yield row
@@ -0,0 +1,143 @@
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+
+from characters.character_management import (
+    CharacterBatch, CharacterBatchValidator, CharacterManager, RoleCapExceeded,
+)
+from characters.error_reports import ErrorReport, report_path
+from characters.models import Character
+from characters.parsing import read_piece, split_at_record_boundaries
+
+DEFAULT_PIECE_SIZE = 8 * 1024 * 1024
+
+
+def parse_and_validate_piece(path, start, end):
+    # Runs in a worker process: parse one piece and run the per-row checks.
+    columns = read_piece(path, start, end)
+    return columns, CharacterBatchValidator().validate_rows(columns)
+
+
+class Command(BaseCommand):
+    help = ('Import Key: Value roster files for a user. Large files are split at blank lines and '
+            'parsed and validated in parallel before a single bulk write.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Roster files, directories or glob patterns.')
+        parser.add_argument('--user', required=True, help='Username that owns the imported characters.')
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--piece-size', type=int, default=DEFAULT_PIECE_SIZE,
+                            help='Approximate size in bytes of each piece handed to a worker.')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"No user named {options['user']}.")
+
+        timings = {}
+        started = time.perf_counter()
+        paths = self.find_roster_files(options['paths'])
+        if not paths:
+            raise CommandError('No roster files matched.')
+        pieces = [
+            (path, start, end)
+            for path in paths
+            for start, end in split_at_record_boundaries(path, options['piece_size'])
+        ]
+        timings['split'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        results = self.parse_pieces(pieces, options['processes'])
+        timings['parse + validate'] = time.perf_counter() - started
+
+        # Single reduction over the pieces in file order: duplicate names and
+        # role caps span pieces and files, and existing roster rows count too.
+        started = time.perf_counter()
+        validator = CharacterBatchValidator(user)
+        # Only a summary of the errors is held; all of them go to the report file
+        report = ErrorReport(user.pk)
+        valid_columns = []
+        rows = 0
+        file_rows = dict.fromkeys(paths, 0)
+        try:
+            for (path, _, _), (columns, row_codes) in zip(pieces, results):
+                rows += len(row_codes)
+                codes = row_codes | validator.validate_across_rows(columns)
+                if codes.any():
+                    errors = CharacterBatchValidator.errors(columns, codes, first_row=file_rows[path] + 1)
+                    for row, field, code, message in errors:
+                        report.add(row, field, code, f"{os.path.basename(path)}: {message}")
+                file_rows[path] += len(row_codes)
+                valid_columns.append((path, columns, np.flatnonzero(codes == 0)))
+        finally:
+            report.close()
+        timings['reduce'] = time.perf_counter() - started
+
+        if report.total:
+            for message in report.messages():
+                self.stderr.write(message)
+            self.stderr.write(f'Every error is listed in {report_path(user.pk, report.token)}')
+            self.report_timings(timings, rows)
+            raise CommandError(f'{report.total} errors found, nothing was imported.')
+
+        started = time.perf_counter()
+        try:
+            created = CharacterManager.bulk_create_batches(
+                (CharacterBatch.from_columns(columns).take(valid_rows) for _, columns, valid_rows in valid_columns),
+                user
+            )
+        except RoleCapExceeded as exc:
+            raise CommandError(f'{exc} Nothing was imported.')
+        except IntegrityError:
+            # The (user, name) unique constraint caught a character added since validation
+            raise CommandError(f'{self.describe_name_clash(user, valid_columns)} Nothing was imported.')
+        timings['write'] = time.perf_counter() - started
+
+        self.report_timings(timings, rows)
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {created} characters from {len(paths)} files ({len(pieces)} pieces).'
+        ))
+
+    @staticmethod
+    def find_roster_files(patterns):
+        paths = []
+        for pattern in patterns:
+            if os.path.isdir(pattern):
+                matches = glob.glob(os.path.join(pattern, '*.csv'))
+            else:
+                matches = glob.glob(pattern)
+            paths += sorted(path for path in matches if os.path.isfile(path))
+        return list(dict.fromkeys(paths))
+
+    @staticmethod
+    def describe_name_clash(user, valid_columns):
+        existing = set(Character.objects.filter(user=user).values_list('name', flat=True))
+        for path, columns, valid_rows in valid_columns:
+            for row in valid_rows:
+                name = columns['Name'][row]
+                if name in existing:
+                    return (f"{name} from {os.path.basename(path)} was added to {user.username}'s roster "
+                            f"during the import.")
+        files = ', '.join(dict.fromkeys(os.path.basename(path) for path, _, _ in valid_columns))
+        return f"A name from {files} was added to {user.username}'s roster during the import."
+
+    @staticmethod
+    def parse_pieces(pieces, processes):
+        if processes <= 1 or len(pieces) <= 1:
+            return [parse_and_validate_piece(*piece) for piece in pieces]
+        # Workers only parse and validate; they never touch the database
+        with ProcessPoolExecutor(max_workers=processes, initializer=django.setup) as executor:
+            return list(executor.map(parse_and_validate_piece, *zip(*pieces)))
+
+    def report_timings(self, timings, rows):
+        for stage, seconds in timings.items():
+            rate = f' ({rows / seconds:,.0f} rows/s)' if stage != 'split' and seconds and rows else ''
+            self.stdout.write(f'{stage}: {seconds:.3f}s{rate}')
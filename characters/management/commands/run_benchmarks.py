@@ -0,0 +1,58 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from characters.benchmarks import (
+    DEFAULT_SIZES, DEFAULT_TOLERANCE, compare_to_baseline, load_baseline, run_benchmark, save_results,
+)
+
+DEFAULT_BASELINE = os.path.join(settings.BASE_DIR, 'benchmarks', 'baseline.json')
+
+
+class Command(BaseCommand):
+    help = ('Time parsing, validation, inserts, the character list and exports on synthetic rosters, '
+            'and fail when throughput or peak memory regress against a baseline JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                            help='Roster sizes in characters, e.g. 1000 10000 100000 1000000.')
+        parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+        parser.add_argument('--save-baseline', action='store_true',
+                            help='Store these results as the new baseline instead of comparing.')
+        parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+        parser.add_argument('--output', help='Also write the results to this JSON file.')
+        parser.add_argument('--no-memory', action='store_true',
+                            help='Skip tracemalloc; timings get faster but peak memory is not recorded.')
+
+    def handle(self, *args, **options):
+        results = {}
+        with tempfile.TemporaryDirectory() as workdir:
+            for size in options['sizes']:
+                results[str(size)] = run_benchmark(size, workdir, trace_memory=not options['no_memory'])
+                self.report(size, results[str(size)])
+
+        if options['output']:
+            save_results(options['output'], results)
+        if options['save_baseline']:
+            save_results(options['baseline'], results)
+            self.stdout.write(self.style.SUCCESS(f"Baseline saved to {options['baseline']}."))
+            return
+        if not os.path.exists(options['baseline']):
+            self.stdout.write(f"No baseline at {options['baseline']}; run with --save-baseline to create one.")
+            return
+
+        regressions = compare_to_baseline(results, load_baseline(options['baseline']), options['tolerance'])
+        for regression in regressions:
+            self.stderr.write(regression)
+        if regressions:
+            raise CommandError(f'{len(regressions)} benchmark regressions.')
+        self.stdout.write(self.style.SUCCESS('No regressions against the baseline.'))
+
+    def report(self, size, stages):
+        self.stdout.write(f'{size:,} characters')
+        for stage, result in stages.items():
+            memory = f", peak {result['peak_memory'] / 1024 / 1024:.1f} MiB" if result['peak_memory'] is not None else ''
+            rate = f" ({result['rows_per_second']:,.0f} rows/s)" if result['rows_per_second'] else ''
+            self.stdout.write(f"  {stage}: {result['seconds']:.3f}s{rate}{memory}")
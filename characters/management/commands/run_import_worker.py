@@ -0,0 +1,32 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from characters.jobs import run_worker, WORKER_POLL_INTERVAL
+
+
+class Command(BaseCommand):
+    help = 'Process queued character imports from the ImportJob table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Number of worker processes polling the queue.')
+        parser.add_argument('--poll-interval', type=float, default=WORKER_POLL_INTERVAL)
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the queue and exit instead of polling forever.')
+
+    def handle(self, *args, **options):
+        if options['processes'] <= 1:
+            run_worker(options['poll_interval'], options['once'])
+            return
+
+        # Forked workers must open their own database connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options['processes']) as executor:
+            futures = [
+                executor.submit(run_worker, options['poll_interval'], options['once'])
+                for _ in range(options['processes'])
+            ]
+            for future in futures:
+                future.result()
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:05
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def rename_duplicate_names(apps, schema_editor):
+    # Rosters uploaded before names were unique per user may contain
+    # duplicates; keep the oldest and suffix the rest with their id.
+    Character = apps.get_model('characters', 'Character')
+    duplicates = (Character.objects.values('user_id', 'name')
+                  .annotate(count=Count('id'))
+                  .filter(count__gt=1))
+    for duplicate in duplicates:
+        characters = (Character.objects.filter(user_id=duplicate['user_id'], name=duplicate['name'])
+                      .order_by('id')[1:])
+        for character in characters:
+            suffix = f" ({character.id})"
+            character.name = character.name[:100 - len(suffix)] + suffix
+            character.save(update_fields=['name'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('characters', '0004_importjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicate_names, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='character',
+            index=models.Index(fields=['user', 'position'], name='character_user_position_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='character',
+            constraint=models.UniqueConstraint(fields=('user', 'name'), name='character_unique_user_name'),
+        ),
+    ]
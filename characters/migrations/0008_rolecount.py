@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:46
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def seed_role_counts(apps, schema_editor):
+    # Start every existing user's counters from their current roster
+    Character = apps.get_model('characters', 'Character')
+    RoleCount = apps.get_model('characters', 'RoleCount')
+    counts = (Character.objects.values_list('user_id', 'position')
+              .annotate(count=Count('id'))
+              .order_by())
+    RoleCount.objects.bulk_create(
+        [RoleCount(user_id=user_id, position=position, count=count) for user_id, position, count in counts],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('characters', '0007_rosterversion'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoleCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.CharField(choices=[('Tank', 'Tank'), ('Heal', 'Heal'), ('Melee_Dps', 'Melee DPS'), ('Ranged_Dps', 'Ranged DPS')], max_length=20)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'position'), name='role_count_unique_user_position')],
+            },
+        ),
+        migrations.RunPython(seed_role_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:15
+
+import characters.models
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('characters', '0009_importjob_error_report'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChunkedUpload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(default=characters.models.new_upload_token, max_length=32, unique=True)),
+                ('size', models.PositiveBigIntegerField()),
+                ('chunk_size', models.PositiveIntegerField()),
+                ('sync', models.BooleanField(default=False)),
+                ('fail_fast', models.BooleanField(default=False)),
+                ('received', models.JSONField(blank=True, default=dict)),
+                ('parse_ahead', models.BooleanField(default=True)),
+                ('parsed_offset', models.PositiveBigIntegerField(default=0)),
+                ('parsed_rows', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('import_job', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='characters.importjob')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
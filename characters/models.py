@@ -1,5 +1,9 @@
+import secrets
+
 from django.db import models
+from django.db.models import F
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 class Character(models.Model):
     CLASS_CHOICES = [
@@ -24,5 +28,183 @@ class Character(models.Model):
     position = models.CharField(max_length=20, choices=POSITION_CHOICES)
     user = models.ForeignKey(User, on_delete=models.CASCADE, null = False)  # Link to User model
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'position'], name='character_user_position_idx'),
+        ]
+        constraints = [
+            # Also serves as the (user, name) index for name lookups and sorting
+            models.UniqueConstraint(fields=['user', 'name'], name='character_unique_user_name'),
+        ]
+
     def __str__(self):
         return f"{self.name} - {self.character_class} - {self.position}"
+
+
+class ImportJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+    MAX_STORED_ERRORS = 100
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    file = models.FileField(upload_to='imports/')
+    sync = models.BooleanField(default=False)
+    fail_fast = models.BooleanField(default=False)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    rows_parsed = models.PositiveIntegerField(default=0)
+    rows_inserted = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+    error_messages = models.JSONField(default=list, blank=True)
+    error_counts = models.JSONField(default=dict, blank=True)
+    # Token of the downloadable report holding every error, see error_reports.py
+    error_report = models.CharField(max_length=32, blank=True)
+    # What a sync job inserted, updated and deleted, as RosterSync.diff
+    diff = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Moved on as a running job saves progress; a job silent for longer than
+    # CHARACTER_IMPORT_JOB_TIMEOUT lost its worker, see jobs.fail_stale_jobs
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def progress(self):
+        elapsed = None
+        if self.started_at:
+            elapsed = ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+        return {
+            'id': self.id,
+            'status': self.status,
+            'rows_parsed': self.rows_parsed,
+            'rows_inserted': self.rows_inserted,
+            'error_count': self.error_count,
+            'errors': self.error_messages,
+            'error_counts': self.error_counts,
+            'diff': self.diff,
+            'elapsed_seconds': elapsed,
+            'rows_per_second': self.rows_parsed / elapsed if elapsed else None,
+        }
+
+    def __str__(self):
+        return f"Import {self.id} - {self.user} - {self.status}"
+
+
+class ImportedRoster(models.Model):
+    # Hash of the last roster file synced for a user
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    file_hash = models.CharField(max_length=64)
+    imported_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user} - {self.file_hash}"
+
+
+class ImportedRecord(models.Model):
+    # Hash of each record block from the last sync, keyed by character name
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    name = models.CharField(max_length=100)
+    digest = models.CharField(max_length=32)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'name'], name='imported_record_unique_user_name'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.name} - {self.digest}"
+
+
+def new_roster_token():
+    return secrets.token_hex(8)
+
+
+class RosterVersion(models.Model):
+    # Bumped every time the user's roster changes; cached exports are keyed on
+    # the token and version, and the token is new for every row, so a reused
+    # user id never matches files left behind by a deleted user
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    token = models.CharField(max_length=16, default=new_roster_token)
+    version = models.PositiveBigIntegerField(default=0)
+
+    @classmethod
+    def for_user(cls, user_id):
+        return cls.objects.get_or_create(user_id=user_id)[0]
+
+    @classmethod
+    def bump(cls, user_id):
+        if not cls.objects.filter(user_id=user_id).update(version=F('version') + 1):
+            cls.objects.get_or_create(user_id=user_id, defaults={'version': 1})
+
+    def __str__(self):
+        return f"{self.user} - v{self.version}"
+
+
+class RoleCount(models.Model):
+    # Characters per position for a user, kept in step with every insert and
+    # delete so caps are enforced by a conditional UPDATE of this one row
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    position = models.CharField(max_length=20, choices=Character.POSITION_CHOICES)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'position'], name='role_count_unique_user_position'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.position}: {self.count}"
+
+
+def new_upload_token():
+    return secrets.token_hex(16)
+
+
+class ChunkedUpload(models.Model):
+    # A large file sent in numbered chunks, see chunked_uploads.py. received
+    # maps each stored chunk's index to its SHA-256, so a retried upload only
+    # sends what is missing.
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    token = models.CharField(max_length=32, unique=True, default=new_upload_token)
+    size = models.PositiveBigIntegerField()
+    chunk_size = models.PositiveIntegerField()
+    sync = models.BooleanField(default=False)
+    fail_fast = models.BooleanField(default=False)
+    received = models.JSONField(default=dict, blank=True)
+    # Key: Value files are parsed while later chunks are still arriving;
+    # parsed_offset is where the parsed prefix ends
+    parse_ahead = models.BooleanField(default=True)
+    parsed_offset = models.PositiveBigIntegerField(default=0)
+    parsed_rows = models.PositiveIntegerField(default=0)
+    import_job = models.OneToOneField(ImportJob, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def chunk_count(self):
+        return -(-self.size // self.chunk_size)
+
+    def missing_chunks(self):
+        return [index for index in range(self.chunk_count) if str(index) not in self.received]
+
+    def progress(self):
+        return {
+            'token': self.token,
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'chunks': self.chunk_count,
+            'received': sorted(int(index) for index in self.received),
+            'checksums': self.received,
+            'parsed_bytes': self.parsed_offset,
+            'parsed_rows': self.parsed_rows,
+            'import_job': self.import_job_id,
+        }
+
+    def __str__(self):
+        return f"Upload {self.token} - {self.user} - {len(self.received)}/{self.chunk_count} chunks"
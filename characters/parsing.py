@@ -0,0 +1,218 @@
+import codecs
+import os
+import re
+
+REQUIRED_FIELDS = ('Name', 'Class', 'Position')
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Bytes of a memory-mapped roster parsed at a time by iter_mapped_columns
+MAPPED_REGION_SIZE = 8 * 1024 * 1024
+# One or more blank lines end a block; a field line is split at its first colon
+BLANK_LINES = re.compile(rb'\n(?:[ \t\r\f\v]*\n)+')
+FIELD_LINE = re.compile(rb'^[ \t\r\f\v]*(Name|Class|Position)[ \t\r\f\v]*:[ \t\r\f\v]*(.*?)[ \t\r\f\v]*$', re.M)
+
+
+class CharacterParser:
+    @staticmethod
+    def iter_lines(uploaded_file, chunk_size=UPLOAD_CHUNK_SIZE):
+        # Decode incrementally so a multi-byte character split across two
+        # chunks is only emitted once it is complete.
+        decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        pending = ''
+        for chunk in uploaded_file.chunks(chunk_size):
+            pending += decoder.decode(chunk)
+            lines = pending.split('\n')
+            pending = lines.pop()
+            yield from lines
+        pending += decoder.decode(b'', final=True)
+        if pending:
+            yield pending
+
+    @staticmethod
+    def iter_blocks(uploaded_file, chunk_size=UPLOAD_CHUNK_SIZE):
+        return CharacterParser.parse_lines(CharacterParser.iter_lines(uploaded_file, chunk_size))
+
+    @staticmethod
+    def parse_lines(lines):
+        character_data = {}
+        for line in lines:
+            line = line.strip()
+            if ':' in line:
+                key, value = map(str.strip, line.split(':', 1))
+                character_data[key] = value
+            elif line == '' and character_data:
+                yield character_data
+                character_data = {}
+
+        # A trailing block without a blank line after it is only kept when complete
+        if character_data and all(k in character_data for k in REQUIRED_FIELDS):
+            yield character_data
+
+    @staticmethod
+    def parse_columns(lines, batch_size=None):
+        """Parse blocks like parse_lines, into Name, Class and Position column lists.
+
+        Yields a dict of the three lists every batch_size blocks, or once for
+        everything without a batch_size. No dict is built per block; a field
+        a block leaves out is an empty string.
+        """
+        lines = iter(lines)
+        while True:
+            columns = {field: [] for field in REQUIRED_FIELDS}
+            names, classes, positions = (columns[field] for field in REQUIRED_FIELDS)
+            name = character_class = position = None
+            in_block = False
+            for line in lines:
+                line = line.strip()
+                if ':' in line:
+                    key, value = map(str.strip, line.split(':', 1))
+                    if key == 'Name':
+                        name = value
+                    elif key == 'Class':
+                        character_class = value
+                    elif key == 'Position':
+                        position = value
+                    in_block = True
+                elif line == '' and in_block:
+                    names.append(name or '')
+                    classes.append(character_class or '')
+                    positions.append(position or '')
+                    name = character_class = position = None
+                    in_block = False
+                    if batch_size and len(names) >= batch_size:
+                        break
+            else:
+                if None not in (name, character_class, position):
+                    names.append(name)
+                    classes.append(character_class)
+                    positions.append(position)
+                if names or not batch_size:
+                    yield columns
+                return
+            yield columns
+
+
+def split_at_record_boundaries(path, piece_size):
+    """Return (start, end) byte ranges of roughly piece_size that each end on a blank line."""
+    size = os.path.getsize(path)
+    pieces = []
+    start = 0
+    with open(path, 'rb') as roster_file:
+        while start < size:
+            end = start + piece_size
+            if end < size:
+                roster_file.seek(end)
+                roster_file.readline()  # finish the line the cut landed in
+                for line in iter(roster_file.readline, b''):
+                    if not line.strip():
+                        break
+                end = roster_file.tell()
+            end = min(end, size)
+            pieces.append((start, end))
+            start = end
+    return pieces
+
+
+def last_record_boundary(data):
+    """Return the offset just past the last blank line in data, or 0 if it has none."""
+    end = len(data)
+    while True:
+        newline = data.rfind(b'\n', 0, end)
+        if newline < 0:
+            return 0
+        previous = data.rfind(b'\n', 0, newline)
+        if not data[previous + 1:newline].strip():
+            return newline + 1
+        end = newline
+
+
+def read_piece(path, start, end):
+    with open(path, 'rb') as roster_file:
+        roster_file.seek(start)
+        data = roster_file.read(end - start)
+    # Pieces end on a newline, so they never cut a multi-byte character in half
+    text = data.decode('utf-8-sig' if start == 0 else 'utf-8')
+    return next(CharacterParser.parse_columns(text.split('\n')))
+
+
+def iter_mapped_columns(path, region_size=MAPPED_REGION_SIZE):
+    """Parse a Key: Value roster like BlockReader, a region of a memory-mapped file at a time.
+
+    Yields Name, Class and Position column lists per region. Blocks and
+    fields are found with bytes regexes, and each column is decoded once
+    per region instead of line by line.
+    """
+    import mmap
+
+    with open(path, 'rb') as roster_file:
+        size = os.fstat(roster_file.fileno()).st_size
+        if not size:
+            return
+        with mmap.mmap(roster_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            start = len(codecs.BOM_UTF8) if mapped[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8 else 0
+            window = region_size
+            while start < size:
+                data = mapped[start:start + window]
+                stop = len(data) if start + len(data) == size else last_record_boundary(data)
+                if not stop:
+                    # A single record longer than the window
+                    window *= 2
+                    continue
+                yield parse_region(data[:stop])
+                start += stop
+                window = region_size
+
+
+def parse_region(data):
+    """Parse Key: Value blocks from bytes that start on a line and end after a blank line or at the end of the file."""
+    columns = parse_written_layout(data)
+    if columns is not None:
+        return columns
+
+    names, classes, positions = [], [], []
+    blocks = BLANK_LINES.split(data)
+    last = len(blocks) - 1
+    for index, block in enumerate(blocks):
+        # Any line with a colon makes a block a record, as in parse_columns
+        if b':' not in block:
+            continue
+        fields = dict(FIELD_LINE.findall(block))
+        if index == last and len(fields) < len(REQUIRED_FIELDS):
+            # A trailing block without a blank line after it is only kept when complete
+            continue
+        names.append(fields.get(b'Name', b''))
+        classes.append(fields.get(b'Class', b''))
+        positions.append(fields.get(b'Position', b''))
+    return decode_columns(names, classes, positions)
+
+
+def parse_written_layout(data):
+    """Parse data laid out the way write_roster and the exports write it, or return None.
+
+    That is Name, Class and Position lines in that order, then one blank
+    line. The check and the parse are a handful of bytes method calls over
+    the whole region, with no Python work per line.
+    """
+    lines = data.replace(b'\r\n', b'\n').split(b'\n')
+    # The last record of a file may end without a newline or a blank line after it
+    if lines[-1]:
+        lines.append(b'')
+    if len(lines) % 4 == 0:
+        lines.append(b'')
+    count = len(lines) // 4
+    if not count or len(lines) != 4 * count + 1 or lines[-1] or any(lines[3::4]):
+        return None
+    columns = {}
+    for offset, field in enumerate(REQUIRED_FIELDS):
+        key = field.encode('ascii') + b':'
+        values = b'\n'.join(lines[offset:-1:4])
+        # Each line starts with the key, and the key appears nowhere else
+        if not values.startswith(key) or values.count(key) != count or values.count(b'\n' + key) != count - 1:
+            return None
+        columns[field] = list(map(str.strip, values.replace(key, b'').decode('utf-8').split('\n')))
+    return columns
+
+
+def decode_columns(*columns):
+    # Values never hold a newline, so each column is decoded in one call
+    return {field: b'\n'.join(values).decode('utf-8').split('\n') if values else []
+            for field, values in zip(REQUIRED_FIELDS, columns)}
@@ -0,0 +1,184 @@
+import re
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict, deque
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+PROFILE_WINDOW_SIZE = 1000
+PERCENTILES = (50, 95, 99)
+# The same query shape this many times in one request is reported as an N+1
+REPEATED_QUERY_THRESHOLD = 10
+SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_IN_LIST = re.compile(r'\bIN \([^)]*\)', re.IGNORECASE)
+
+
+def query_shape(sql):
+    # Queries differing only in their literals or IN list length share a shape
+    return SQL_IN_LIST.sub('IN (...)', SQL_LITERAL.sub('?', sql))
+
+
+def record_rows(request, count):
+    """Add to the rows a view reports as processed for this request."""
+    request.rows_processed = getattr(request, 'rows_processed', 0) + count
+
+
+class QueryRecorder:
+    """execute_wrapper that counts and times every query run on the connection."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+            self.shapes[query_shape(sql)] += 1
+
+    def repeated_queries(self, threshold=REPEATED_QUERY_THRESHOLD):
+        return {shape: count for shape, count in self.shapes.items() if count >= threshold}
+
+
+class ProfileStore:
+    """Per-view rolling windows of request samples, kept in process memory."""
+
+    def __init__(self, window_size=PROFILE_WINDOW_SIZE):
+        self.lock = threading.Lock()
+        self.window_size = window_size
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.samples = defaultdict(lambda: deque(maxlen=self.window_size))
+            self.totals = defaultdict(Counter)
+            self.repeated = defaultdict(Counter)
+
+    def record(self, view, sample, repeated_queries):
+        with self.lock:
+            self.samples[view].append(sample)
+            totals = self.totals[view]
+            totals['requests'] += 1
+            totals['seconds'] += sample['seconds']
+            totals['queries'] += sample['queries']
+            totals['db_seconds'] += sample['db_seconds']
+            totals['rows'] += sample['rows']
+            if repeated_queries:
+                totals['repeated_query_requests'] += 1
+                self.repeated[view].update(repeated_queries)
+
+    def summary(self):
+        with self.lock:
+            views = {view: (list(samples), dict(self.totals[view]), self.repeated[view].most_common(5))
+                     for view, samples in self.samples.items()}
+
+        summary = []
+        for view, (samples, totals, repeated) in sorted(views.items()):
+            memory = [sample['peak_memory'] for sample in samples if sample['peak_memory'] is not None]
+            summary.append({
+                'view': view,
+                'totals': totals,
+                'window': len(samples),
+                'seconds': percentiles([sample['seconds'] for sample in samples]),
+                'queries': percentiles([sample['queries'] for sample in samples]),
+                'db_seconds': percentiles([sample['db_seconds'] for sample in samples]),
+                'rows': percentiles([sample['rows'] for sample in samples]),
+                'peak_memory': max(memory) if memory else None,
+                'repeated_queries': repeated,
+            })
+        return summary
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    import numpy as np
+
+    return dict(zip(PERCENTILES, np.percentile(values, PERCENTILES).tolist()))
+
+
+profile_store = ProfileStore()
+
+
+class ProfilingMiddleware:
+    """Records wall time, query count and time, rows and peak memory per view.
+
+    Only active when settings.CHARACTER_PROFILING is true. Peak memory needs
+    CHARACTER_PROFILING_TRACE_MEMORY as well, since tracemalloc slows every
+    allocation and its peak is shared by all threads of the process.
+    """
+
+    def __init__(self, get_response):
+        if not settings.CHARACTER_PROFILING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.rows_processed = 0
+        recorder = QueryRecorder()
+        trace_memory = settings.CHARACTER_PROFILING_TRACE_MEMORY
+        if trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        seconds = time.perf_counter() - started
+
+        match = request.resolver_match
+        if match is not None:
+            profile_store.record(match.view_name, {
+                'seconds': seconds,
+                'queries': recorder.count,
+                'db_seconds': recorder.seconds,
+                'rows': request.rows_processed,
+                'peak_memory': tracemalloc.get_traced_memory()[1] - memory_before if trace_memory else None,
+            }, recorder.repeated_queries())
+        return response
+
+
+def prometheus_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(summary):
+    """Render a ProfileStore summary in the Prometheus text exposition format."""
+    lines = []
+    metrics = (
+        ('seconds', 'character_request_duration_seconds', 'Wall time per request.'),
+        ('queries', 'character_request_db_queries', 'Database queries per request.'),
+        ('db_seconds', 'character_request_db_duration_seconds', 'Database time per request.'),
+        ('rows', 'character_request_rows', 'Rows processed per request.'),
+    )
+    for key, name, help_text in metrics:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} summary']
+        for entry in summary:
+            view = prometheus_label(entry['view'])
+            for percentile, value in entry[key].items():
+                lines.append(f'{name}{{view="{view}",quantile="{percentile / 100}"}} {value}')
+            lines.append(f'{name}_sum{{view="{view}"}} {entry["totals"].get(key, 0)}')
+            lines.append(f'{name}_count{{view="{view}"}} {entry["totals"]["requests"]}')
+
+    name = 'character_request_repeated_queries_total'
+    lines += [f'# HELP {name} Requests that ran one query shape {REPEATED_QUERY_THRESHOLD}+ times.',
+              f'# TYPE {name} counter']
+    for entry in summary:
+        lines.append(f'{name}{{view="{prometheus_label(entry["view"])}"}} '
+                     f'{entry["totals"].get("repeated_query_requests", 0)}')
+
+    name = 'character_request_peak_memory_bytes'
+    lines += [f'# HELP {name} Largest traced allocation peak in the window.', f'# TYPE {name} gauge']
+    for entry in summary:
+        if entry['peak_memory'] is not None:
+            lines.append(f'{name}{{view="{prometheus_label(entry["view"])}"}} {entry["peak_memory"]}')
+    return '\n'.join(lines) + '\n'
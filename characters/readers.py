@@ -0,0 +1,172 @@
+import csv
+import json
+import re
+from itertools import islice
+
+from .parsing import CharacterParser, REQUIRED_FIELDS
+
+READ_BATCH_SIZE = 5000
+SNIFF_SIZE = 4096
+COLUMN_ALIASES = {
+    'name': 'Name',
+    'class': 'Class',
+    'character_class': 'Class',
+    'position': 'Position',
+}
+KEY_VALUE_LINE = re.compile(rb'^\s*[A-Za-z_]+\s*:', re.M)
+
+READERS = {}
+
+
+class RosterFormatError(ValueError):
+    pass
+
+
+def register_reader(reader_class):
+    reader = reader_class()
+    READERS[reader.format] = reader
+    return reader_class
+
+
+def normalize_columns(frame):
+    # Accept header spellings such as our own export's character_class
+    frame = frame.rename(columns=lambda column: COLUMN_ALIASES.get(str(column).strip().lower(), column))
+    missing = [field for field in REQUIRED_FIELDS if field not in frame.columns]
+    if missing:
+        raise RosterFormatError(f"Missing columns: {', '.join(missing)}.")
+    frame = frame[list(REQUIRED_FIELDS)].fillna('').astype(str)
+    return frame.apply(lambda column: column.str.strip())
+
+
+def rewind(source):
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return source
+
+
+class RosterReader:
+    format = None
+
+    def read_batches(self, source, batch_size=READ_BATCH_SIZE):
+        """Yield DataFrames with Name, Class and Position columns."""
+        raise NotImplementedError
+
+
+@register_reader
+class BlockReader(RosterReader):
+    format = 'blocks'
+
+    def read_batches(self, source, batch_size=READ_BATCH_SIZE):
+        import pandas as pd
+
+        lines = CharacterParser.iter_lines(rewind(source))
+        for columns in CharacterParser.parse_columns(lines, batch_size):
+            yield pd.DataFrame(columns, columns=list(REQUIRED_FIELDS))
+
+
+@register_reader
+class CsvReader(RosterReader):
+    format = 'csv'
+    separator = ','
+
+    def read_batches(self, source, batch_size=READ_BATCH_SIZE):
+        try:
+            import pyarrow.csv  # noqa: F401
+        except ImportError:
+            return self.read_batches_with_pandas(source, batch_size)
+        return self.read_batches_with_pyarrow(source, batch_size)
+
+    def read_batches_with_pyarrow(self, source, batch_size):
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+
+        # Read every column as text so names like 007 are not turned into numbers
+        header_line = rewind(source).read(SNIFF_SIZE).decode('utf-8-sig', errors='replace').splitlines()[:1]
+        header = next(csv.reader(header_line, delimiter=self.separator), [])
+        reader = pa_csv.open_csv(
+            rewind(source),
+            read_options=pa_csv.ReadOptions(block_size=max(batch_size * 64, 1 << 16)),
+            parse_options=pa_csv.ParseOptions(delimiter=self.separator),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={column: pa.string() for column in header},
+                strings_can_be_null=False,
+            ),
+        )
+        # pyarrow parses each block of rows in native code, on its own threads
+        for record_batch in reader:
+            yield normalize_columns(record_batch.to_pandas())
+
+    def read_batches_with_pandas(self, source, batch_size):
+        import pandas as pd
+
+        # The C parser tokenises each block of rows outside the interpreter
+        chunks = pd.read_csv(rewind(source), sep=self.separator, engine='c', chunksize=batch_size,
+                             dtype=str, keep_default_na=False, skipinitialspace=True, encoding='utf-8-sig')
+        with chunks:
+            for frame in chunks:
+                yield normalize_columns(frame)
+
+
+@register_reader
+class TsvReader(CsvReader):
+    format = 'tsv'
+    separator = '\t'
+
+
+@register_reader
+class XlsxReader(RosterReader):
+    format = 'xlsx'
+
+    def read_batches(self, source, batch_size=READ_BATCH_SIZE):
+        import pandas as pd
+        from openpyxl import load_workbook
+
+        # read_only streams rows from the sheet XML instead of loading every cell
+        workbook = load_workbook(rewind(source), read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    return
+                yield normalize_columns(pd.DataFrame(batch, columns=header))
+        finally:
+            workbook.close()
+
+
+@register_reader
+class JsonLinesReader(RosterReader):
+    format = 'jsonl'
+
+    def read_batches(self, source, batch_size=READ_BATCH_SIZE):
+        import pandas as pd
+
+        lines = (line.lstrip('\ufeff') for line in CharacterParser.iter_lines(rewind(source)) if line.strip())
+        while True:
+            batch = [json.loads(line) for line in islice(lines, batch_size)]
+            if not batch:
+                return
+            yield normalize_columns(pd.DataFrame(batch))
+
+
+def sniff_format(source):
+    """Guess the reader for an upload from its first few kilobytes."""
+    head = rewind(source).read(SNIFF_SIZE)
+    rewind(source)
+    if head.startswith(b'PK\x03\x04'):
+        return READERS['xlsx']
+
+    head = head.lstrip(b'\xef\xbb\xbf')
+    first_line = next((line for line in head.splitlines() if line.strip()), b'')
+    if first_line.lstrip().startswith(b'{'):
+        return READERS['jsonl']
+    # The block parser skips lines that are not Key: Value, such as a leading
+    # comment, so any such line in the window marks the file as blocks
+    if KEY_VALUE_LINE.search(head):
+        return READERS['blocks']
+    if b'\t' in first_line:
+        return READERS['tsv']
+    return READERS['csv']
@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import time
+from functools import cached_property
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .models import Character
+
+MAX_TANKS = 2
+MAX_HEALS = 2
+POSITION_CLASS_MAP = {
+    'Tank': ['Paladin', 'Warrior'],
+    'Heal': ['Shaman', 'Paladin', 'Druid'],
+    'Ranged_Dps': ['Warlock', 'Mage', 'Shaman'],
+    'Melee_Dps': ['Warrior', 'Paladin', 'Druid'],
+}
+ROLE_CAPS = {'Tank': MAX_TANKS, 'Heal': MAX_HEALS}
+RULES_RELOAD_INTERVAL = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+class RosterRules:
+    """Position/class legality and role caps, precomputed for constant-time lookups."""
+
+    def __init__(self, position_class_map=None, role_caps=None):
+        position_class_map = POSITION_CLASS_MAP if position_class_map is None else position_class_map
+        role_caps = ROLE_CAPS if role_caps is None else role_caps
+
+        self.class_choices = tuple(Character.CLASS_CHOICES)
+        self.position_choices = tuple(Character.POSITION_CHOICES)
+        self.classes = tuple(value for value, _ in self.class_choices)
+        self.positions = tuple(value for value, _ in self.position_choices)
+        self.class_codes = {value: code for code, value in enumerate(self.classes)}
+        self.position_codes = {value: code for code, value in enumerate(self.positions)}
+
+        for position, classes in position_class_map.items():
+            if position not in self.position_codes:
+                raise ImproperlyConfigured(f"Unknown position in roster rules: {position}")
+            for character_class in classes:
+                if character_class not in self.class_codes:
+                    raise ImproperlyConfigured(f"Unknown class in roster rules: {character_class}")
+        for position, cap in role_caps.items():
+            if position not in self.position_codes or int(cap) < 0:
+                raise ImproperlyConfigured(f"Invalid role cap in roster rules: {position}={cap}")
+
+        self.position_class_map = {position: tuple(classes) for position, classes in position_class_map.items()}
+        self.role_caps = {position: int(cap) for position, cap in role_caps.items()}
+        self.legal_pairs = frozenset(
+            (position, character_class)
+            for position, classes in self.position_class_map.items()
+            for character_class in classes
+        )
+
+    @cached_property
+    def legal_matrix(self):
+        # legal_matrix[position_code, class_code]; the extra last row and column
+        # are all False so the -1 code of an unknown value lands on them.
+        # Built on first use, so numpy is only loaded once something is validated
+        import numpy as np
+
+        legal_matrix = np.zeros((len(self.positions) + 1, len(self.classes) + 1), dtype=bool)
+        for position, character_class in self.legal_pairs:
+            legal_matrix[self.position_codes[position], self.class_codes[character_class]] = True
+        return legal_matrix
+
+    def is_legal(self, position, character_class):
+        return (position, character_class) in self.legal_pairs
+
+    def role_cap(self, position):
+        return self.role_caps.get(position)
+
+
+_rules = None
+_rules_file_mtime = None
+_rules_checked_at = 0.0
+
+
+def read_overrides():
+    overrides = dict(settings.CHARACTER_ROSTER_RULES)
+    path = settings.CHARACTER_ROSTER_RULES_FILE
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as rules_file:
+            overrides.update(json.load(rules_file))
+    return overrides
+
+
+def load_rules():
+    global _rules, _rules_file_mtime, _rules_checked_at
+    overrides = read_overrides()
+    _rules = RosterRules(
+        {**POSITION_CLASS_MAP, **overrides.get('position_classes', {})},
+        {**ROLE_CAPS, **overrides.get('role_caps', {})},
+    )
+    _rules_file_mtime = rules_file_mtime()
+    _rules_checked_at = time.monotonic()
+    return _rules
+
+
+def rules_file_mtime():
+    path = settings.CHARACTER_ROSTER_RULES_FILE
+    try:
+        return os.stat(path).st_mtime if path else None
+    except OSError:
+        return None
+
+
+def get_rules():
+    global _rules_checked_at, _rules_file_mtime
+    if _rules is None:
+        return load_rules()
+
+    # Pick up edits to the rules file without a restart, checking its mtime
+    # at most once every RULES_RELOAD_INTERVAL seconds
+    now = time.monotonic()
+    if settings.CHARACTER_ROSTER_RULES_FILE and now - _rules_checked_at > RULES_RELOAD_INTERVAL:
+        _rules_checked_at = now
+        if rules_file_mtime() != _rules_file_mtime:
+            try:
+                return load_rules()
+            except (ImproperlyConfigured, ValueError) as exc:
+                # Keep serving the previous rules until the file changes again
+                _rules_file_mtime = rules_file_mtime()
+                logger.error('Ignoring invalid roster rules file: %s', exc)
+    return _rules
+
+
+@receiver(setting_changed)
+def reset_rules(setting, **kwargs):
+    global _rules
+    if setting in ('CHARACTER_ROSTER_RULES', 'CHARACTER_ROSTER_RULES_FILE'):
+        _rules = None
@@ -0,0 +1,14 @@
+from django.db import transaction
+from django.dispatch import Signal
+
+# Sent with user_id= whenever a user's roster is created, imported into or
+# deleted from through CharacterManager. The sender is RosterSync for the
+# writes of a sync and None otherwise.
+roster_changed = Signal()
+
+
+def send_roster_changed(user_id, sender=None):
+    # Receivers run right away and again once the surrounding transaction
+    # commits, so a cache refilled mid-transaction can't outlive the commit.
+    roster_changed.send(sender=sender, user_id=user_id)
+    transaction.on_commit(lambda: roster_changed.send(sender=sender, user_id=user_id))
@@ -0,0 +1,50 @@
+from django.core.cache import cache
+from django.db.models import Count
+from django.dispatch import receiver
+
+from .models import Character
+from .signals import roster_changed
+
+STATS_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def stats_cache_key(user_id):
+    return f'character_stats:{user_id}'
+
+
+class CharacterStats:
+    @staticmethod
+    def count_by(user_id, field):
+        rows = (Character.objects.filter(user_id=user_id)
+                .values_list(field)
+                .annotate(count=Count('id'))
+                .order_by(field))
+        return dict(rows)
+
+    @staticmethod
+    def compute(user_id):
+        class_counts = CharacterStats.count_by(user_id, 'character_class')
+        position_counts = CharacterStats.count_by(user_id, 'position')
+        return {
+            'class_counts': class_counts,
+            'position_counts': position_counts,
+            'total': sum(class_counts.values()),
+        }
+
+    @staticmethod
+    def get(user):
+        key = stats_cache_key(user.pk)
+        stats = cache.get(key)
+        if stats is None:
+            stats = CharacterStats.compute(user.pk)
+            cache.set(key, stats, STATS_CACHE_TIMEOUT)
+        return stats
+
+    @staticmethod
+    def invalidate(user_id):
+        cache.delete(stats_cache_key(user_id))
+
+
+@receiver(roster_changed)
+def invalidate_character_stats(sender, user_id, **kwargs):
+    CharacterStats.invalidate(user_id)
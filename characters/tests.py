@@ -1,17 +1,99 @@
-from django.test import TestCase
-from django.urls import reverse
+import hashlib
+import importlib
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import os
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+import pandas as pd
+
+from django.core.cache import cache
+from django.db import connection, IntegrityError, transaction
+from django.test import AsyncRequestFactory, TestCase, SimpleTestCase, override_settings
+from django.http import HttpResponse
+from django.urls import path, reverse
+from django.utils import timezone
 from django.contrib.auth.models import User
-from .models import Character
-from io import StringIO
+from django.core.files.uploadedfile import SimpleUploadedFile
+from .models import Character, ChunkedUpload, ImportJob, ImportedRecord, ImportedRoster, RoleCount, RosterVersion
+from .jobs import STALE_JOB_MESSAGE, process_pending_jobs
+from .chunked_uploads import UploadConflict, parsed_batches, write_chunk
+from .exporters import EXPORTERS
+from .export_cache import evict_exports
+from .profiling import profile_store, query_shape
+from .analytics import RosterQuery
+from .error_reports import ERROR_SUMMARY_SIZE, REPORT_FIELDS, open_report
+from .stats import CharacterStats
+from .readers import READERS, sniff_format
+from openpyxl import Workbook
+from . import async_views, rules
+from django.core.exceptions import ImproperlyConfigured
+from .parsing import (
+    CharacterParser, iter_mapped_columns, parse_written_layout, read_piece, split_at_record_boundaries,
+)
+from django.core.management import call_command, CommandError
+from .character_management import (
+    CharacterBatch, CharacterImporter, CharacterManager, CharacterValidator, CharacterBatchValidator,
+    ERROR_NAME_CAPITAL, ERROR_DUPLICATE_IN_FILE, ERROR_DUPLICATE_IN_ROSTER, ERROR_POSITION_CLASS,
+    ERROR_TOO_MANY_TANKS, ERROR_TOO_MANY_HEALS, RoleCapExceeded,
+)
+from io import StringIO, BytesIO
+from openpyxl import load_workbook
+
+
+def read_piece_bytes(content):
+    with tempfile.NamedTemporaryFile() as roster_file:
+        roster_file.write(content)
+        roster_file.flush()
+        return read_piece(roster_file.name, 0, len(content))
+
+
+# Tests get a cache of their own instead of the on-disk one the dev server uses
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'characters-tests'}}
+
+
+def use_temp_export_cache(test):
+    # Tests write characters straight through the ORM without bumping the
+    # roster version, so each test gets an empty export cache of its own
+    cache_dir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, cache_dir)
+    settings_override = override_settings(CHARACTER_EXPORT_CACHE_DIR=cache_dir)
+    settings_override.enable()
+    test.addCleanup(settings_override.disable)
+    return cache_dir
+
+
+def use_temp_error_reports(test):
+    # Failed uploads write their error report to disk, so each test gets a directory of its own
+    report_dir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, report_dir)
+    settings_override = override_settings(CHARACTER_ERROR_REPORT_DIR=report_dir)
+    settings_override.enable()
+    test.addCleanup(settings_override.disable)
+    return report_dir
+
+
+@override_settings(CACHES=TEST_CACHES)
+class RosterTestCase(TestCase):
+    """Logs testuser in, with an empty cache, export cache and error report directory of its own."""
 
-class CharacterTests(TestCase):
     @classmethod
     def setUpTestData(cls):
         cls.user = User.objects.create_user(username='testuser', password='password123')
 
     def setUp(self):
+        cache.clear()
+        self.report_dir = use_temp_error_reports(self)
+        self.cache_dir = use_temp_export_cache(self)
         self.client.login(username='testuser', password='password123')
 
+
+class CharacterTests(RosterTestCase):
     def test_character_creation_valid(self):
         response = self.client.post(reverse('add_character'), {
             'name': 'Gandalf',
@@ -21,6 +103,11 @@ class CharacterTests(TestCase):
         self.assertRedirects(response, reverse('character_list'))
         self.assertTrue(Character.objects.filter(name='Gandalf').exists())
 
+    def test_add_character_form_options(self):
+        response = self.client.get(reverse('add_character'))
+        self.assertContains(response, '<option value="Warlock">Warlock</option>', html=True)
+        self.assertContains(response, '<option value="Melee_Dps">Melee DPS</option>', html=True)
+
     def test_character_creation_invalid_name(self):
         response = self.client.post(reverse('add_character'), {
             'name': 'gandalf',
@@ -94,12 +181,52 @@ class CharacterTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, 'Name must start with a capital letter.')
 
+    def test_csv_upload_error_rolls_back_valid_rows(self):
+        csv_content = ("Name: Gandalf\nClass: Mage\nPosition: Ranged_Dps\n\n"
+                       "Name: thrall\nClass: Shaman\nPosition: Heal\n\n")
+        csv_file = StringIO(csv_content)
+        csv_file.name = 'test.csv'
+        response = self.client.post(reverse('upload_csv'), {'file': csv_file})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Character.objects.filter(user=self.user).exists())
+
+    def test_bulk_create_characters_in_batches(self):
+        characters = [{'Name': f'Mage{i}', 'Class': 'Mage', 'Position': 'Ranged_Dps'} for i in range(5)]
+        RosterVersion.objects.create(user=self.user)
+        RoleCount.objects.create(user=self.user, position='Ranged_Dps')
+        # savepoint + three (counter UPDATE + INSERT) batches + release + synced file reset + roster version bump
+        with self.assertNumQueries(10):
+            created = CharacterManager.bulk_create_characters(characters, self.user, batch_size=2)
+        self.assertEqual(created, 5)
+        self.assertEqual(Character.objects.filter(user=self.user).count(), 5)
+
+    def test_bulk_create_characters_rolls_back_on_failure(self):
+        def characters():
+            yield {'Name': 'Gandalf', 'Class': 'Mage', 'Position': 'Ranged_Dps'}
+            yield {'Name': 'Thrall', 'Class': 'Shaman', 'Position': 'Heal'}
+            raise ValueError('broken upload')
+
+        with self.assertRaises(ValueError):
+            CharacterManager.bulk_create_characters(characters(), self.user, batch_size=1)
+        self.assertFalse(Character.objects.filter(user=self.user).exists())
+
     def test_export_to_excel(self):
         Character.objects.create(name='Gandalf', character_class='Mage', position='Ranged_Dps', user=self.user)
         response = self.client.get(reverse('export_to_excel'))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response['Content-Disposition'], 'attachment; filename=characters.xlsx')
 
+    def test_export_to_excel_streams_every_row(self):
+        for i in range(5):
+            Character.objects.create(name=f'Mage{i}', character_class='Mage', position='Ranged_Dps', user=self.user)
+        response = self.client.get(reverse('export_to_excel'))
+        self.assertTrue(response.streaming)
+
+        workbook = load_workbook(BytesIO(b''.join(response.streaming_content)), read_only=True)
+        rows = list(workbook.active.values)
+        self.assertEqual(rows[0], ('id', 'name', 'character_class', 'position', 'user_id'))
+        self.assertEqual([row[1] for row in rows[1:]], [f'Mage{i}' for i in range(5)])
+
     def test_delete_character(self):
         character = Character.objects.create(name='Gandalf', character_class='Mage', position='Ranged_Dps',
                                              user=self.user)
@@ -150,3 +277,1499 @@ class CharacterTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, 'Invalid credentials')
 
+
+class CharacterParserTests(SimpleTestCase):
+    def test_blocks_split_across_chunks(self):
+        content = "Name: Gandalf\nClass: Mage\nPosition: Ranged_Dps\n\nName: Thrall\nClass: Shaman\nPosition: Heal\n"
+        upload = SimpleUploadedFile('test.csv', content.encode('utf-8'))
+        blocks = list(CharacterParser.iter_blocks(upload, chunk_size=7))
+        self.assertEqual(blocks, [
+            {'Name': 'Gandalf', 'Class': 'Mage', 'Position': 'Ranged_Dps'},
+            {'Name': 'Thrall', 'Class': 'Shaman', 'Position': 'Heal'},
+        ])
+
+    def test_multibyte_character_split_across_chunks(self):
+        content = "Name: Éowyn\r\nClass: Warrior\r\nPosition: Tank\r\n\r\n"
+        upload = SimpleUploadedFile('test.csv', content.encode('utf-8'))
+        # Chunk size 7 cuts the two-byte 'É' in half
+        blocks = list(CharacterParser.iter_blocks(upload, chunk_size=7))
+        self.assertEqual(blocks, [{'Name': 'Éowyn', 'Class': 'Warrior', 'Position': 'Tank'}])
+
+    def test_incomplete_trailing_block_is_dropped(self):
+        upload = SimpleUploadedFile('test.csv', b"Name: Gandalf\nClass: Mage\n\n\nName: Thrall\n")
+        blocks = list(CharacterParser.iter_blocks(upload))
+        self.assertEqual(blocks, [{'Name': 'Gandalf', 'Class': 'Mage'}])
+
+    def test_parse_columns_matches_blocks(self):
+        lines = "Name: Gandalf\nClass: Mage\nPosition: Ranged_Dps\n\nName: Thrall\nClass: Shaman\n\n" \
+                "Name: Jaina\nClass: Mage\nPosition: Ranged_Dps\n\nName: Arthas".split('\n')
+        batches = list(CharacterParser.parse_columns(lines, batch_size=2))
+        self.assertEqual(batches, [
+            {'Name': ['Gandalf', 'Thrall'], 'Class': ['Mage', 'Shaman'], 'Position': ['Ranged_Dps', '']},
+            {'Name': ['Jaina'], 'Class': ['Mage'], 'Position': ['Ranged_Dps']},
+        ])
+        blocks = list(CharacterParser.parse_lines(lines))
+        self.assertEqual([block['Name'] for block in blocks], ['Gandalf', 'Thrall', 'Jaina'])
+
+    def test_mapped_columns_match_block_reader(self):
+        content = ("Name: Gandalf\nClass: Mage\nPosition: Ranged_Dps\n\n"
+                   "Name: Éowyn\r\nClass: Warrior\r\nPosition: Tank\r\n\r\n"
+                   "  Class : Shaman\nnot a field\nName:Thrall: Warchief \nPosition: Heal\n \n\n"
+                   "Other: field\n\nName: Jaina\nClass: Mage\nPosition: Ranged_Dps\n\nName: Arthas\nClass: Paladin")
+        expected = {'Name': [], 'Class': [], 'Position': []}
+        upload = SimpleUploadedFile('test.csv', content.encode('utf-8'))
+        for frame in READERS['blocks'].read_batches(upload):
+            for field in expected:
+                expected[field] += frame[field].tolist()
+
+        with tempfile.NamedTemporaryFile(suffix='.csv') as roster_file:
+            roster_file.write(content.encode('utf-8'))
+            roster_file.flush()
+            for region_size in (16, 64, 4096):
+                columns = {'Name': [], 'Class': [], 'Position': []}
+                for region in iter_mapped_columns(roster_file.name, region_size):
+                    for field in columns:
+                        columns[field] += region[field]
+                self.assertEqual(columns, expected)
+        self.assertEqual(expected['Name'], ['Gandalf', 'Éowyn', 'Thrall: Warchief', '', 'Jaina'])
+
+    def test_written_layout_fast_path(self):
+        data = b"Name: Gandalf\nClass: Mage\nPosition: Ranged_Dps\n\nName: Thrall \nClass: Shaman\nPosition: Heal"
+        self.assertEqual(parse_written_layout(data), {
+            'Name': ['Gandalf', 'Thrall'], 'Class': ['Mage', 'Shaman'], 'Position': ['Ranged_Dps', 'Heal'],
+        })
+        # Anything else is left to the general parser
+        self.assertIsNone(parse_written_layout(b"Class: Mage\nName: Gandalf\nPosition: Ranged_Dps\n\n"))
+        self.assertIsNone(parse_written_layout(b"Name: Gandalf\nClass: Mage\nPosition: Ranged_Dps\n\n\n"))
+        self.assertIsNone(parse_written_layout(b"Name: Name: X\nClass: Mage\nPosition: Ranged_Dps\n\n"))
+
+
+class ImportJobTests(RosterTestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, CHARACTER_IMPORT_ASYNC_THRESHOLD=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, csv_content):
+        csv_file = StringIO(csv_content)
+        csv_file.name = 'test.csv'
+        return self.client.post(reverse('upload_csv'), {'file': csv_file})
+
+    def test_large_upload_is_queued(self):
+        response = self.upload("Name: Gandalf\nClass: Mage\nPosition: Ranged_Dps\n\n")
+        self.assertEqual(response.status_code, 200)
+        job = ImportJob.objects.get(user=self.user)
+        self.assertEqual(job.status, ImportJob.PENDING)
+        self.assertContains(response, reverse('import_job_status', args=[job.id]))
+        self.assertFalse(Character.objects.filter(user=self.user).exists())
+
+    def test_worker_imports_queued_file(self):
+        self.upload("Name: Gandalf\nClass: Mage\nPosition: Ranged_Dps\n\nName: Thrall\nClass: Shaman\nPosition: Heal\n\n")
+        self.assertEqual(process_pending_jobs(), 1)
+
+        job = ImportJob.objects.get(user=self.user)
+        self.assertEqual(job.status, ImportJob.DONE)
+        self.assertEqual(Character.objects.filter(user=self.user).count(), 2)
+
+        progress = self.client.get(reverse('import_job_status', args=[job.id])).json()
+        self.assertEqual(progress['status'], 'done')
+        self.assertEqual(progress['rows_parsed'], 2)
+        self.assertEqual(progress['rows_inserted'], 2)
+        self.assertEqual(progress['error_count'], 0)
+
+    def test_worker_reports_insert_errors(self):
+        self.upload("Name: Gandalf\nClass: Warrior\nPosition: Tank\n\n")
+        validate_batches = CharacterImporter.validate_batches
+
+        def validate_then_fill_tanks(importer, batches):
+            errors = validate_batches(importer, batches)
+            # Two Tanks added while the job sat between validation and insert
+            for name in ('Tank1', 'Tank2'):
+                CharacterManager.create_character({'Name': name, 'Class': 'Paladin', 'Position': 'Tank'}, self.user)
+            return errors
+
+        with mock.patch.object(CharacterImporter, 'validate_batches', validate_then_fill_tanks):
+            process_pending_jobs()
+
+        job = ImportJob.objects.get(user=self.user)
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertEqual(job.rows_inserted, 0)
+        self.assertEqual(job.error_messages, ['There cannot be more than 2 Tanks.'])
+        self.assertFalse(Character.objects.filter(user=self.user, name='Gandalf').exists())
+
+    def test_worker_reports_validation_errors(self):
+        self.upload("Name: Gandalf\nClass: Mage\nPosition: Ranged_Dps\n\nName: thrall\nClass: Shaman\nPosition: Heal\n\n")
+        process_pending_jobs()
+
+        job = ImportJob.objects.get(user=self.user)
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertEqual(job.error_messages, ['Name must start with a capital letter.'])
+        self.assertEqual(job.error_counts, {'name_capital': 1})
+        self.assertFalse(Character.objects.filter(user=self.user).exists())
+
+        progress = self.client.get(reverse('import_job_status', args=[job.id])).json()
+        response = self.client.get(progress['error_report']['csv'])
+        self.assertIn(b'2,Name,name_capital,', b''.join(response.streaming_content))
+
+    @override_settings(CHARACTER_IMPORT_JOB_TIMEOUT=60)
+    def test_worker_fails_jobs_left_running_by_a_dead_worker(self):
+        self.upload("Name: Gandalf\nClass: Mage\nPosition: Ranged_Dps\n\n")
+        stale = ImportJob.objects.get(user=self.user)
+        path = stale.file.path
+        long_ago = timezone.now() - timedelta(minutes=2)
+        ImportJob.objects.filter(pk=stale.pk).update(status=ImportJob.RUNNING, started_at=long_ago,
+                                                     heartbeat_at=long_ago)
+        live = ImportJob.objects.create(user=self.user, file='imports/live.csv', status=ImportJob.RUNNING,
+                                        started_at=timezone.now(), heartbeat_at=timezone.now())
+
+        self.assertEqual(process_pending_jobs(), 0)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, ImportJob.FAILED)
+        self.assertEqual(stale.error_messages, [STALE_JOB_MESSAGE])
+        self.assertFalse(os.path.exists(path))
+        live.refresh_from_db()
+        self.assertEqual(live.status, ImportJob.RUNNING)
+
+    def test_job_status_is_private(self):
+        other = User.objects.create_user(username='other', password='password123')
+        job = ImportJob.objects.create(user=other, file='imports/missing.csv')
+        response = self.client.get(reverse('import_job_status', args=[job.id]))
+        self.assertEqual(response.status_code, 404)
+
+
+class ExportFormatTests(RosterTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Character.objects.create(name='Gandalf', character_class='Mage', position='Ranged_Dps', user=cls.user)
+        Character.objects.create(name='Thrall', character_class='Shaman', position='Heal', user=cls.user)
+
+    def test_export_csv(self):
+        response = self.client.get(reverse('export_characters_format', args=['csv']))
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=characters.csv')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(lines[0], 'id,name,character_class,position,user_id')
+        self.assertEqual([line.split(',')[1] for line in lines[1:]], ['Gandalf', 'Thrall'])
+
+    def test_export_json_lines(self):
+        response = self.client.get(reverse('export_characters_format', args=['jsonl']))
+        records = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([record['name'] for record in records], ['Gandalf', 'Thrall'])
+        self.assertEqual(records[1]['position'], 'Heal')
+
+    @unittest.skipUnless(EXPORTERS['parquet'].is_available(), 'pyarrow is not installed')
+    def test_export_parquet(self):
+        import pyarrow.parquet as pq
+
+        response = self.client.get(reverse('export_characters_format', args=['parquet']))
+        table = pq.read_table(BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(table.column('name').to_pylist(), ['Gandalf', 'Thrall'])
+
+    def test_format_from_query_parameter(self):
+        response = self.client.get(reverse('export_characters'), {'format': 'jsonl'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+
+    def test_format_from_accept_header(self):
+        response = self.client.get(reverse('export_characters'),
+                                   HTTP_ACCEPT='application/x-ndjson;q=0.5, text/csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+
+    def test_default_format_is_xlsx(self):
+        response = self.client.get(reverse('export_characters'), HTTP_ACCEPT='text/html,*/*;q=0.8')
+        self.assertEqual(response['Content-Type'], EXPORTERS['xlsx'].content_type)
+
+    def test_unknown_format(self):
+        response = self.client.get(reverse('export_characters_format', args=['pdf']))
+        self.assertEqual(response.status_code, 406)
+
+
+class CharacterStatsTests(RosterTestCase):
+    def test_stats_are_aggregated_in_the_database(self):
+        CharacterManager.bulk_create_characters([
+            {'Name': 'Gandalf', 'Class': 'Mage', 'Position': 'Ranged_Dps'},
+            {'Name': 'Thrall', 'Class': 'Shaman', 'Position': 'Heal'},
+            {'Name': 'Rexxar', 'Class': 'Shaman', 'Position': 'Ranged_Dps'},
+        ], self.user)
+        with self.assertNumQueries(2):
+            stats = CharacterStats.get(self.user)
+        self.assertEqual(stats, {
+            'class_counts': {'Mage': 1, 'Shaman': 2},
+            'position_counts': {'Heal': 1, 'Ranged_Dps': 2},
+            'total': 3,
+        })
+
+    def test_cached_stats_cost_no_queries(self):
+        CharacterStats.get(self.user)
+        with self.assertNumQueries(0):
+            CharacterStats.get(self.user)
+
+    def test_create_and_delete_invalidate_stats(self):
+        self.assertEqual(CharacterStats.get(self.user)['total'], 0)
+        character = CharacterManager.create_character(
+            {'Name': 'Gandalf', 'Class': 'Mage', 'Position': 'Ranged_Dps'}, self.user)
+        self.assertEqual(CharacterStats.get(self.user)['total'], 1)
+        CharacterManager.bulk_create_characters([{'Name': 'Thrall', 'Class': 'Shaman', 'Position': 'Heal'}], self.user)
+        self.assertEqual(CharacterStats.get(self.user)['position_counts'], {'Heal': 1, 'Ranged_Dps': 1})
+        self.client.post(reverse('delete_character', args=[character.id]))
+        self.assertEqual(CharacterStats.get(self.user)['total'], 1)
+
+    def test_character_list_shows_stats(self):
+        CharacterManager.create_character({'Name': 'Gandalf', 'Class': 'Mage', 'Position': 'Ranged_Dps'}, self.user)
+        response = self.client.get(reverse('character_list'))
+        self.assertEqual(response.context['character_stats']['total'], 1)
+        self.assertContains(response, 'Total characters: 1')
+
+
+UNIQUE_NAME_INDEX = 'character_unique_user_name'
+
+
+class CharacterQueryTests(RosterTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = User.objects.create_user(username='other', password='password123')
+        for owner in (cls.user, cls.other):
+            CharacterManager.bulk_create_characters([
+                {'Name': f'Char{i}', 'Class': 'Mage', 'Position': 'Ranged_Dps'} for i in range(50)
+            ] + [
+                {'Name': 'Tank1', 'Class': 'Warrior', 'Position': 'Tank'},
+                {'Name': 'Heal1', 'Class': 'Druid', 'Position': 'Heal'},
+            ], owner)
+
+    def assertUsesIndex(self, queryset, index_name, sorted_by_index=False):
+        if connection.vendor not in ('sqlite', 'mysql'):
+            self.skipTest(f'EXPLAIN checks are not written for {connection.vendor}')
+        plan = queryset.explain()
+        if connection.vendor == 'sqlite' and index_name == UNIQUE_NAME_INDEX:
+            # SQLite backs unique constraints with an automatically named index
+            index_name = 'sqlite_autoindex_characters_character'
+        self.assertIn(index_name, plan)
+        if sorted_by_index:
+            self.assertNotIn('TEMP B-TREE', plan)
+            self.assertNotIn('filesort', plan)
+
+    def test_count_by_position_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(CharacterManager.count_characters_by_position(self.user, 'Tank'), 1)
+        self.assertUsesIndex(Character.objects.filter(user=self.user, position='Tank'),
+                             'character_user_position_idx')
+
+    def test_filter_by_position_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(len(CharacterManager.filter_characters_by_position(self.user, 'Heal')), 1)
+        self.assertUsesIndex(CharacterManager.filter_characters_by_position(self.user, 'Heal'),
+                             'character_user_position_idx')
+
+    def test_sort_by_name_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(len(CharacterManager.sort_characters_by_name(self.user)), 52)
+        self.assertUsesIndex(CharacterManager.sort_characters_by_name(self.user), UNIQUE_NAME_INDEX,
+                             sorted_by_index=True)
+
+    def test_duplicate_name_lookup_query(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(Character.objects.filter(name='Char7', user=self.user).exists())
+        self.assertUsesIndex(Character.objects.filter(name='Char7', user=self.user), UNIQUE_NAME_INDEX)
+
+    def test_duplicate_name_rejected_by_database(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Character.objects.create(name='Char1', character_class='Mage', position='Ranged_Dps', user=self.user)
+
+    def test_same_name_allowed_for_other_users(self):
+        self.assertEqual(Character.objects.filter(name='Char1').count(), 2)
+
+    def test_upload_with_existing_name_is_rolled_back(self):
+        csv_file = StringIO("Name: Newbie\nClass: Mage\nPosition: Ranged_Dps\n\n"
+                            "Name: Char1\nClass: Mage\nPosition: Ranged_Dps\n\n")
+        csv_file.name = 'test.csv'
+        response = self.client.post(reverse('upload_csv'), {'file': csv_file})
+        self.assertContains(response, 'Names cannot be the same for the same user: Char1')
+        self.assertFalse(Character.objects.filter(name='Newbie').exists())
+
+
+class CharacterBatchValidatorTests(RosterTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Character.objects.create(name='Gandalf', character_class='Mage', position='Ranged_Dps', user=cls.user)
+        Character.objects.create(name='Tank1', character_class='Warrior', position='Tank', user=cls.user)
+
+    def test_error_codes_per_row(self):
+        upload = pd.DataFrame({
+            'Name': ['Thrall', 'jaina', 'Thrall', 'Gandalf', 'Uther', 'Tank2', 'Tank3', 'Heal1', 'Heal2', 'Heal3'],
+            'Class': ['Shaman', 'Mage', 'Shaman', 'Mage', 'Paladin', 'Paladin', 'Warrior', 'Druid', 'Druid', 'Druid'],
+            'Position': ['Heal', 'Ranged_Dps', 'Ranged_Dps', 'Ranged_Dps', 'Ranged_Dps',
+                         'Tank', 'Tank', 'Melee_Dps', 'Heal', 'Heal'],
+        })
+        # The fixture has no role counters yet, so they are counted from the roster
+        with self.assertNumQueries(3):
+            codes = CharacterValidator.validate_batch(upload, self.user)
+        self.assertEqual(codes.tolist(), [
+            0,
+            ERROR_NAME_CAPITAL,
+            ERROR_DUPLICATE_IN_FILE,
+            ERROR_DUPLICATE_IN_ROSTER,
+            ERROR_POSITION_CLASS,
+            0,
+            ERROR_TOO_MANY_TANKS,
+            0,
+            0,
+            ERROR_TOO_MANY_HEALS,
+        ])
+
+    def test_state_carries_across_batches(self):
+        validator = CharacterBatchValidator()
+        first = validator.validate({'Name': ['Tank1', 'Tank2'], 'Class': ['Warrior', 'Paladin'],
+                                    'Position': ['Tank', 'Tank']})
+        second = validator.validate([{'Name': 'Tank1', 'Class': 'Warrior', 'Position': 'Tank'}])
+        self.assertEqual(first.tolist(), [0, 0])
+        self.assertEqual(second.tolist(), [ERROR_DUPLICATE_IN_FILE | ERROR_TOO_MANY_TANKS])
+
+    def test_error_messages(self):
+        batch = [{'Name': 'gandalf', 'Class': 'Paladin', 'Position': 'Ranged_Dps'}]
+        codes = CharacterValidator.validate_batch(batch, self.user)
+        self.assertEqual(CharacterBatchValidator.error_messages(batch, codes), [
+            'Name must start with a capital letter.',
+            'Paladin cannot be a Ranged_Dps.',
+        ])
+
+    def test_missing_fields_are_invalid(self):
+        codes = CharacterValidator.validate_batch([{'Name': 'Gandalf'}])
+        self.assertEqual(codes.tolist(), [ERROR_POSITION_CLASS])
+
+
+class RosterRulesTests(SimpleTestCase):
+    def test_default_rules(self):
+        roster_rules = rules.get_rules()
+        self.assertTrue(roster_rules.is_legal('Tank', 'Warrior'))
+        self.assertFalse(roster_rules.is_legal('Tank', 'Mage'))
+        self.assertFalse(roster_rules.is_legal('Tank', 'Necromancer'))
+        self.assertEqual(roster_rules.role_cap('Tank'), 2)
+        self.assertEqual(roster_rules.classes, tuple(value for value, _ in Character.CLASS_CHOICES))
+        self.assertTrue(roster_rules.legal_matrix[roster_rules.position_codes['Heal'], roster_rules.class_codes['Druid']])
+
+    @override_settings(CHARACTER_ROSTER_RULES={'position_classes': {'Tank': ['Druid']}, 'role_caps': {'Tank': 3}})
+    def test_overrides_from_settings(self):
+        roster_rules = rules.get_rules()
+        self.assertTrue(roster_rules.is_legal('Tank', 'Druid'))
+        self.assertFalse(roster_rules.is_legal('Tank', 'Warrior'))
+        self.assertTrue(roster_rules.is_legal('Heal', 'Shaman'))
+        self.assertEqual(roster_rules.role_cap('Tank'), 3)
+        self.assertEqual(roster_rules.role_cap('Heal'), 2)
+        self.assertEqual(CharacterValidator.validate_batch([{'Name': 'Bear', 'Class': 'Druid', 'Position': 'Tank'}]).tolist(), [0])
+
+    def test_unknown_class_is_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            rules.RosterRules({'Tank': ['Necromancer']})
+
+    def test_rules_file_is_hot_reloaded(self):
+        rules_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, rules_dir)
+        path = os.path.join(rules_dir, 'rules.json')
+        with open(path, 'w') as rules_file:
+            json.dump({'role_caps': {'Heal': 4}}, rules_file)
+
+        with override_settings(CHARACTER_ROSTER_RULES_FILE=path), mock.patch.object(rules, 'RULES_RELOAD_INTERVAL', -1):
+            self.assertEqual(rules.get_rules().role_cap('Heal'), 4)
+            with open(path, 'w') as rules_file:
+                json.dump({'role_caps': {'Heal': 5}}, rules_file)
+            os.utime(path, (0, 0))
+            self.assertEqual(rules.get_rules().role_cap('Heal'), 5)
+
+            # A broken file keeps the last good rules
+            with open(path, 'w') as rules_file:
+                rules_file.write('{"position_classes": {"Tank": ["Necromancer"]}}')
+            os.utime(path, (1, 1))
+            with self.assertLogs('characters.rules', 'ERROR'):
+                self.assertEqual(rules.get_rules().role_cap('Heal'), 5)
+        self.assertEqual(rules.get_rules().role_cap('Heal'), 2)
+
+
+class CharacterPaginationTests(RosterTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        CharacterManager.bulk_create_characters(
+            [{'Name': f'Mage{i:02d}', 'Class': 'Mage', 'Position': 'Ranged_Dps'} for i in range(25)]
+            + [{'Name': f'Druid{i:02d}', 'Class': 'Druid', 'Position': 'Melee_Dps'} for i in range(5)],
+            cls.user
+        )
+
+    def test_pages_cover_roster_in_order(self):
+        names = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(1):
+                page, cursor = CharacterManager.page_characters(self.user, cursor=cursor, page_size=7)
+            names += [character.name for character in page]
+            if cursor is None:
+                break
+        self.assertEqual(names, sorted(Character.objects.values_list('name', flat=True)))
+
+    def test_filters(self):
+        page, cursor = CharacterManager.page_characters(self.user, position='Melee_Dps', page_size=10)
+        self.assertEqual([character.name for character in page], [f'Druid{i:02d}' for i in range(5)])
+        self.assertIsNone(cursor)
+        page, _ = CharacterManager.page_characters(self.user, character_class='Mage', page_size=3)
+        self.assertEqual([character.name for character in page], ['Mage00', 'Mage01', 'Mage02'])
+
+    def test_api_endpoint(self):
+        first = self.client.get(reverse('character_list_api'), {'page_size': 20}).json()
+        self.assertEqual(len(first['results']), 20)
+        second = self.client.get(reverse('character_list_api'),
+                                 {'page_size': 20, 'cursor': first['next_cursor']}).json()
+        self.assertEqual(len(second['results']), 10)
+        self.assertIsNone(second['next_cursor'])
+        self.assertEqual(second['results'][0]['name'], 'Mage15')
+
+    def test_api_rejects_bad_cursor(self):
+        response = self.client.get(reverse('character_list_api'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_character_list_next_page_link(self):
+        response = self.client.get(reverse('character_list'), {'class': 'Mage'})
+        self.assertEqual(len(response.context['characters']), 10)
+        self.assertContains(response, 'Next page')
+        response = self.client.get(reverse('character_list') + '?' + response.context['next_page_query'])
+        self.assertEqual(response.context['characters'][0].name, 'Mage10')
+
+
+class ImportRostersCommandTests(RosterTestCase):
+    def setUp(self):
+        super().setUp()
+        self.roster_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.roster_dir)
+
+    def write_roster(self, filename, characters):
+        path = os.path.join(self.roster_dir, filename)
+        with open(path, 'w', encoding='utf-8') as roster_file:
+            for name, character_class, position in characters:
+                roster_file.write(f"Name: {name}\nClass: {character_class}\nPosition: {position}\n\n")
+        return path
+
+    def test_pieces_end_on_record_boundaries(self):
+        path = self.write_roster('big.csv', [(f'Mage{i}', 'Mage', 'Ranged_Dps') for i in range(100)])
+        pieces = split_at_record_boundaries(path, 200)
+        self.assertGreater(len(pieces), 5)
+        self.assertEqual(pieces[0][0], 0)
+        self.assertEqual(pieces[-1][1], os.path.getsize(path))
+        names = [name for start, end in pieces for name in read_piece(path, start, end)['Name']]
+        self.assertEqual(names, [f'Mage{i}' for i in range(100)])
+
+    def test_imports_directory(self):
+        self.write_roster('a.csv', [(f'Mage{i}', 'Mage', 'Ranged_Dps') for i in range(30)] + [('Tank1', 'Warrior', 'Tank')])
+        self.write_roster('b.csv', [(f'Druid{i}', 'Druid', 'Melee_Dps') for i in range(30)] + [('Tank2', 'Paladin', 'Tank')])
+        out = StringIO()
+        call_command('import_rosters', self.roster_dir, user='testuser', processes=1, piece_size=300, stdout=out)
+        self.assertEqual(Character.objects.filter(user=self.user).count(), 62)
+        self.assertIn('parse + validate', out.getvalue())
+
+    def test_caps_and_duplicates_span_files(self):
+        self.write_roster('a.csv', [('Tank1', 'Warrior', 'Tank'), ('Tank2', 'Warrior', 'Tank')])
+        self.write_roster('b.csv', [('Tank3', 'Paladin', 'Tank'), ('Tank1', 'Paladin', 'Melee_Dps')])
+        err = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('import_rosters', os.path.join(self.roster_dir, '*.csv'), user='testuser',
+                         processes=1, stdout=StringIO(), stderr=err)
+        self.assertIn('b.csv: There cannot be more than 2 Tanks.', err.getvalue())
+        self.assertIn('b.csv: Names cannot be the same: Tank1', err.getvalue())
+        self.assertFalse(Character.objects.filter(user=self.user).exists())
+
+    def test_name_added_during_import(self):
+        self.write_roster('a.csv', [('Gandalf', 'Mage', 'Ranged_Dps'), ('Thrall', 'Shaman', 'Heal')])
+        bulk_create_batches = CharacterManager.bulk_create_batches
+
+        def add_thrall_first(batches, user):
+            # Added after the command validated the file against the roster
+            CharacterManager.create_character({'Name': 'Thrall', 'Class': 'Shaman', 'Position': 'Heal'}, user)
+            return bulk_create_batches(batches, user)
+
+        with mock.patch.object(CharacterManager, 'bulk_create_batches', add_thrall_first):
+            with self.assertRaisesMessage(CommandError, "Thrall from a.csv was added to testuser's roster during "
+                                                        "the import. Nothing was imported."):
+                call_command('import_rosters', self.roster_dir, user='testuser', processes=1, stdout=StringIO())
+        self.assertEqual(list(Character.objects.filter(user=self.user).values_list('name', flat=True)), ['Thrall'])
+
+    def test_process_pool(self):
+        self.write_roster('a.csv', [(f'Mage{i}', 'Mage', 'Ranged_Dps') for i in range(200)])
+        call_command('import_rosters', self.roster_dir, user='testuser', processes=2, piece_size=1000,
+                     stdout=StringIO())
+        self.assertEqual(Character.objects.filter(user=self.user).count(), 200)
+
+
+class RosterReaderTests(RosterTestCase):
+    def upload(self, filename, content):
+        return self.client.post(reverse('upload_csv'), {'file': SimpleUploadedFile(filename, content)})
+
+    def xlsx_bytes(self, rows):
+        workbook = Workbook()
+        for row in rows:
+            workbook.active.append(row)
+        output = BytesIO()
+        workbook.save(output)
+        return output.getvalue()
+
+    def test_sniff_format(self):
+        self.assertIs(sniff_format(BytesIO(b"Name: Gandalf\nClass: Mage\n")), READERS['blocks'])
+        self.assertIs(sniff_format(BytesIO(b"Name,Class,Position\nGandalf,Mage,Ranged_Dps\n")), READERS['csv'])
+        self.assertIs(sniff_format(BytesIO(b"Name\tClass\tPosition\n")), READERS['tsv'])
+        self.assertIs(sniff_format(BytesIO(b'{"Name": "Gandalf"}\n')), READERS['jsonl'])
+        self.assertIs(sniff_format(BytesIO(self.xlsx_bytes([['Name']]))), READERS['xlsx'])
+
+    def test_key_value_file_with_leading_comment(self):
+        content = b"# Raid roster, week 12\nName: Gandalf\nClass: Mage\nPosition: Ranged_Dps\n\n"
+        self.assertIs(sniff_format(BytesIO(content)), READERS['blocks'])
+        response = self.upload('roster.csv', content)
+        self.assertRedirects(response, reverse('character_list'))
+        self.assertTrue(Character.objects.filter(user=self.user, name='Gandalf').exists())
+
+    def test_key_value_file_with_bom(self):
+        content = "\ufeffName: Éowyn\nClass: Warrior\nPosition: Tank\n\n".encode('utf-8')
+        self.assertIs(sniff_format(BytesIO(content)), READERS['blocks'])
+        batch = next(READERS['blocks'].read_batches(SimpleUploadedFile('roster.csv', content)))
+        self.assertEqual(batch.iloc[0].tolist(), ['Éowyn', 'Warrior', 'Tank'])
+        self.assertEqual(read_piece_bytes(content), {'Name': ['Éowyn'], 'Class': ['Warrior'], 'Position': ['Tank']})
+        response = self.upload('roster.csv', content)
+        self.assertRedirects(response, reverse('character_list'))
+        self.assertTrue(Character.objects.filter(user=self.user, name='Éowyn').exists())
+
+    def test_csv_reader_batches(self):
+        content = "\ufeffname,character_class,position\n007,Mage,Ranged_Dps\n" + "".join(
+            f"Mage{i}, Mage,Ranged_Dps\n" for i in range(5000))
+        batches = list(READERS['csv'].read_batches(BytesIO(content.encode('utf-8')), batch_size=1000))
+        self.assertGreater(len(batches), 1)
+        self.assertEqual(sum(len(batch) for batch in batches), 5001)
+        self.assertEqual(batches[0].iloc[0].tolist(), ['007', 'Mage', 'Ranged_Dps'])
+        self.assertEqual(batches[0].iloc[1].tolist(), ['Mage0', 'Mage', 'Ranged_Dps'])
+
+    def test_csv_reader_pandas_fallback(self):
+        content = b"Name,Class,Position\n007,Mage,Ranged_Dps\nThrall,Shaman,Heal\n"
+        batches = list(READERS['csv'].read_batches_with_pandas(BytesIO(content), batch_size=10))
+        self.assertEqual(batches[0]['Name'].tolist(), ['007', 'Thrall'])
+
+    def test_upload_csv_file(self):
+        response = self.upload('roster.csv', b"Name,Class,Position\nGandalf,Mage,Ranged_Dps\nThrall,Shaman,Heal\n")
+        self.assertRedirects(response, reverse('character_list'))
+        self.assertEqual(Character.objects.filter(user=self.user).count(), 2)
+
+    def test_upload_tsv_file(self):
+        response = self.upload('roster.tsv', b"Name\tClass\tPosition\nGandalf\tMage\tRanged_Dps\n")
+        self.assertRedirects(response, reverse('character_list'))
+        self.assertTrue(Character.objects.filter(name='Gandalf').exists())
+
+    def test_upload_xlsx_file(self):
+        content = self.xlsx_bytes([['Name', 'Class', 'Position'], ['Gandalf', 'Mage', 'Ranged_Dps']])
+        response = self.upload('roster.xlsx', content)
+        self.assertRedirects(response, reverse('character_list'))
+        self.assertTrue(Character.objects.filter(name='Gandalf').exists())
+
+    def test_upload_json_lines_file(self):
+        content = b'{"Name": "Gandalf", "Class": "Mage", "Position": "Ranged_Dps"}\n' \
+                  b'{"Name": "thrall", "Class": "Shaman", "Position": "Heal"}\n'
+        response = self.upload('roster.jsonl', content)
+        self.assertContains(response, 'Name must start with a capital letter.')
+        self.assertFalse(Character.objects.filter(user=self.user).exists())
+
+    def test_upload_csv_missing_columns(self):
+        response = self.upload('roster.csv', b"Name,Class\nGandalf,Mage\n")
+        self.assertContains(response, 'Missing columns: Position.')
+
+    def test_export_round_trips_through_upload(self):
+        other = User.objects.create_user(username='other', password='password123')
+        Character.objects.create(name='Gandalf', character_class='Mage', position='Ranged_Dps', user=other)
+        self.client.login(username='other', password='password123')
+        exported = b''.join(self.client.get(reverse('export_characters_format', args=['csv'])).streaming_content)
+        self.client.login(username='testuser', password='password123')
+        self.upload('characters.csv', exported)
+        self.assertTrue(Character.objects.filter(user=self.user, name='Gandalf').exists())
+
+
+class RosterSyncTests(RosterTestCase):
+    ROSTER = "Name,Class,Position\nGandalf,Mage,Ranged_Dps\nThrall,Shaman,Heal\nArthas,Paladin,Tank\n"
+
+    def sync(self, content):
+        return self.client.post(reverse('upload_csv'), {
+            'file': SimpleUploadedFile('roster.csv', content.encode('utf-8')),
+            'sync': '1',
+        })
+
+    def roster(self):
+        return set(Character.objects.filter(user=self.user).values_list('name', 'character_class', 'position'))
+
+    def test_first_sync_inserts_everything(self):
+        response = self.sync(self.ROSTER)
+        self.assertEqual(response.context['import_diff']['inserted'], 3)
+        self.assertEqual(len(self.roster()), 3)
+        self.assertEqual(ImportedRecord.objects.filter(user=self.user).count(), 3)
+        self.assertTrue(ImportedRoster.objects.filter(user=self.user).exists())
+
+    def test_unchanged_file_is_skipped(self):
+        self.sync(self.ROSTER)
+        with mock.patch('characters.character_management.RosterSync.read') as read:
+            response = self.sync(self.ROSTER)
+        read.assert_not_called()
+        self.assertTrue(response.context['import_diff']['file_unchanged'])
+        self.assertContains(response, 'unchanged since your last sync')
+
+    def test_resync_applies_only_the_diff(self):
+        self.sync(self.ROSTER)
+        gandalf_id = Character.objects.get(user=self.user, name='Gandalf').id
+        response = self.sync("Name,Class,Position\nGandalf,Mage,Ranged_Dps\nThrall,Shaman,Ranged_Dps\n"
+                             "Jaina,Mage,Ranged_Dps\n")
+        self.assertEqual(response.context['import_diff'], {
+            'file_unchanged': False, 'inserted': 1, 'updated': 1, 'deleted': 1, 'unchanged': 1,
+        })
+        self.assertEqual(self.roster(), {
+            ('Gandalf', 'Mage', 'Ranged_Dps'), ('Thrall', 'Shaman', 'Ranged_Dps'), ('Jaina', 'Mage', 'Ranged_Dps'),
+        })
+        # Unchanged characters keep their rows
+        self.assertEqual(Character.objects.get(user=self.user, name='Gandalf').id, gandalf_id)
+        self.assertEqual(set(ImportedRecord.objects.filter(user=self.user).values_list('name', flat=True)),
+                         {'Gandalf', 'Thrall', 'Jaina'})
+
+    def test_roster_change_since_the_sync_is_undone_by_the_same_file(self):
+        self.sync(self.ROSTER)
+        CharacterManager.delete_character(Character.objects.get(user=self.user, name='Gandalf'))
+        response = self.sync(self.ROSTER)
+        self.assertEqual(response.context['import_diff'], {
+            'file_unchanged': False, 'inserted': 1, 'updated': 0, 'deleted': 0, 'unchanged': 2,
+        })
+        self.assertEqual(len(self.roster()), 3)
+        self.assertTrue(self.sync(self.ROSTER).context['import_diff']['file_unchanged'])
+
+    def test_sync_keeps_hand_added_characters(self):
+        Character.objects.create(name='Uther', character_class='Paladin', position='Tank', user=self.user)
+        Character.objects.create(name='Gandalf', character_class='Warlock', position='Ranged_Dps', user=self.user)
+        response = self.sync(self.ROSTER)
+        self.assertEqual(response.context['import_diff']['updated'], 1)
+        self.sync("Name,Class,Position\nThrall,Shaman,Heal\n")
+        # Gandalf was taken over by the first sync, Uther never was
+        self.assertEqual(self.roster(), {('Uther', 'Paladin', 'Tank'), ('Thrall', 'Shaman', 'Heal')})
+
+    def test_sync_checks_caps_against_the_resulting_roster(self):
+        Character.objects.create(name='Uther', character_class='Paladin', position='Tank', user=self.user)
+        Character.objects.create(name='Varian', character_class='Warrior', position='Tank', user=self.user)
+        response = self.sync(self.ROSTER)
+        self.assertContains(response, 'There cannot be more than 2 Tanks.')
+        self.assertFalse(Character.objects.filter(user=self.user, name='Gandalf').exists())
+        self.assertFalse(ImportedRoster.objects.filter(user=self.user).exists())
+
+    def test_plain_upload_is_unaffected(self):
+        self.sync(self.ROSTER)
+        response = self.client.post(reverse('upload_csv'), {
+            'file': SimpleUploadedFile('roster.csv', self.ROSTER.encode('utf-8')),
+        })
+        self.assertContains(response, 'Names cannot be the same for the same user: Gandalf')
+
+    @override_settings(CHARACTER_IMPORT_ASYNC_THRESHOLD=0)
+    def test_queued_sync(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with override_settings(MEDIA_ROOT=media_root):
+            self.sync(self.ROSTER)
+            process_pending_jobs()
+        job = ImportJob.objects.get(user=self.user)
+        self.assertTrue(job.sync)
+        self.assertEqual(job.status, ImportJob.DONE)
+        self.assertEqual(job.rows_inserted, 3)
+        self.assertEqual(len(self.roster()), 3)
+        progress = self.client.get(reverse('import_job_status', args=[job.id])).json()
+        self.assertEqual(progress['diff'], {
+            'file_unchanged': False, 'inserted': 3, 'updated': 0, 'deleted': 0, 'unchanged': 0,
+        })
+
+
+class ExportCacheTests(RosterTestCase):
+    def setUp(self):
+        super().setUp()
+        CharacterManager.create_character({'Name': 'Gandalf', 'Class': 'Mage', 'Position': 'Ranged_Dps'}, self.user)
+
+    def export(self, **headers):
+        return self.client.get(reverse('export_characters_format', args=['csv']), headers=headers)
+
+    def test_roster_changes_bump_the_version(self):
+        version = RosterVersion.objects.get(user=self.user).version
+        self.assertGreater(version, 0)
+        character = CharacterManager.create_character(
+            {'Name': 'Thrall', 'Class': 'Shaman', 'Position': 'Heal'}, self.user)
+        self.assertGreater(RosterVersion.objects.get(user=self.user).version, version)
+        version = RosterVersion.objects.get(user=self.user).version
+        CharacterManager.delete_character(character)
+        self.assertGreater(RosterVersion.objects.get(user=self.user).version, version)
+
+    def test_repeat_export_is_served_from_disk(self):
+        first = b''.join(self.export().streaming_content)
+        with mock.patch('characters.export_cache.iter_character_rows') as rows:
+            response = self.export()
+            second = b''.join(response.streaming_content)
+        rows.assert_not_called()
+        self.assertEqual(first, second)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_if_none_match_returns_304(self):
+        etag = self.export()['ETag']
+        response = self.export(if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_roster_change_invalidates_export(self):
+        etag = self.export()['ETag']
+        CharacterManager.create_character({'Name': 'Thrall', 'Class': 'Shaman', 'Position': 'Heal'}, self.user)
+        response = self.export(if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn(b'Thrall', b''.join(response.streaming_content))
+
+    def test_reused_user_id_gets_its_own_exports(self):
+        self.export()
+        user_id = self.user.pk
+        self.user.delete()
+        user = User.objects.create_user(id=user_id, username='newcomer', password='password123')
+        CharacterManager.create_character({'Name': 'Thrall', 'Class': 'Shaman', 'Position': 'Heal'}, user)
+        self.client.login(username='newcomer', password='password123')
+        body = b''.join(self.export().streaming_content)
+        self.assertIn(b'Thrall', body)
+        self.assertNotIn(b'Gandalf', body)
+
+    def test_least_recently_used_exports_are_evicted(self):
+        for name, age in (('old', 300), ('recent', 200), ('newest', 100)):
+            path = os.path.join(self.cache_dir, f'1-1.{name}')
+            with open(path, 'wb') as export_file:
+                export_file.write(b'x' * 10)
+            os.utime(path, (os.path.getmtime(path) - age,) * 2)
+        with override_settings(CHARACTER_EXPORT_CACHE_MAX_BYTES=20):
+            evict_exports()
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['1-1.newest', '1-1.recent'])
+
+
+@override_settings(CHARACTER_PROFILING=True, CHARACTER_PROFILING_METRICS_TOKEN='scrape-me')
+class ProfilingMiddlewareTests(RosterTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.staff = User.objects.create_user(username='staff', password='password123', is_staff=True)
+        Character.objects.create(name='Gandalf', character_class='Mage', position='Ranged_Dps', user=cls.user)
+
+    def setUp(self):
+        super().setUp()
+        profile_store.clear()
+        self.addCleanup(profile_store.clear)
+
+    def view_summary(self, view):
+        return next(entry for entry in profile_store.summary() if entry['view'] == view)
+
+    def test_requests_are_recorded_per_view(self):
+        self.client.get(reverse('character_list'))
+        self.client.get(reverse('character_list'))
+
+        entry = self.view_summary('character_list')
+        self.assertEqual(entry['totals']['requests'], 2)
+        self.assertGreater(entry['queries'][50], 0)
+        self.assertEqual(entry['rows'][95], 1)
+        self.assertGreater(entry['seconds'][99], 0)
+
+    def test_repeated_query_shapes_are_flagged(self):
+        self.assertEqual(query_shape("SELECT * FROM t WHERE id = 7 AND name IN ('a', 'b')"),
+                         'SELECT * FROM t WHERE id = ? AND name IN (...)')
+        with override_settings(ROOT_URLCONF='characters.tests'):
+            self.client.get('/n-plus-one/')
+        entry = self.view_summary('n_plus_one')
+        self.assertEqual(entry['totals']['repeated_query_requests'], 1)
+        self.assertEqual(entry['repeated_queries'][0][1], 12)
+
+    def test_dashboard_is_staff_only(self):
+        self.assertEqual(self.client.get(reverse('profiling_dashboard')).status_code, 302)
+        self.client.login(username='staff', password='password123')
+        response = self.client.get(reverse('profiling_dashboard'))
+        self.assertContains(response, 'profiling_dashboard')
+
+    def test_prometheus_metrics(self):
+        self.client.get(reverse('character_list'))
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('profiling_metrics')).status_code, 403)
+
+        response = self.client.get(reverse('profiling_metrics'), headers={'Authorization': 'Bearer scrape-me'})
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('# TYPE character_request_duration_seconds summary', body)
+        self.assertIn('character_request_duration_seconds_count{view="character_list"} 1', body)
+        self.assertIn('character_request_duration_seconds{view="character_list",quantile="0.95"}', body)
+
+
+class BenchmarkCommandTests(RosterTestCase):
+    def setUp(self):
+        super().setUp()
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.baseline = os.path.join(self.workdir, 'baseline.json')
+
+    def run_benchmarks(self, *args):
+        out = StringIO()
+        call_command('run_benchmarks', '--sizes', '20', '--baseline', self.baseline, *args, stdout=out, stderr=out)
+        return out.getvalue()
+
+    def test_baseline_round_trip(self):
+        output = self.run_benchmarks('--save-baseline')
+        self.assertIn('validate (batch)', output)
+        with open(self.baseline) as baseline_file:
+            stages = json.load(baseline_file)['20']
+        self.assertEqual(set(stages), {
+            'parse', 'validate (per row)', 'validate (batch)', 'read + validate upload', 'create',
+            'character_list', 'export_to_excel', 'export_to_excel (cached)',
+        })
+        self.assertEqual(stages['create']['rows'], 20)
+        self.assertIsNotNone(stages['parse']['peak_memory'])
+        # Everything the benchmark wrote was rolled back
+        self.assertEqual(list(User.objects.all()), [self.user])
+        self.assertFalse(Character.objects.exists())
+
+    def test_regressions_fail_the_command(self):
+        with open(self.baseline, 'w') as baseline_file:
+            json.dump({'20': {'parse': {'rows_per_second': 1e12, 'peak_memory': 1}}}, baseline_file)
+        with self.assertRaisesMessage(CommandError, '2 benchmark regressions.'):
+            self.run_benchmarks()
+
+
+class AsyncViewTests(RosterTestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = AsyncRequestFactory()
+
+    def request(self, method, name, data=None, **headers):
+        request = getattr(self.factory, method)(reverse(name), data or {}, headers=headers)
+        request.user = self.user
+
+        async def auser():
+            return self.user
+
+        request.auser = auser
+        return request
+
+    async def read_export(self, response):
+        return b''.join([block async for block in response.streaming_content])
+
+    async def test_async_upload(self):
+        upload = SimpleUploadedFile('roster.csv', b"Name,Class,Position\nGandalf,Mage,Ranged_Dps\nThrall,Shaman,Heal\n")
+        response = await async_views.upload_csv(self.request('post', 'upload_csv', {'file': upload}))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(await Character.objects.filter(user=self.user).acount(), 2)
+
+    async def test_async_upload_errors(self):
+        upload = SimpleUploadedFile('roster.csv', b"Name,Class,Position\ngandalf,Mage,Tank\n")
+        response = await async_views.upload_csv(self.request('post', 'upload_csv', {'file': upload}))
+        self.assertContains(response, 'Name must start with a capital letter.')
+        self.assertContains(response, 'Mage cannot be a Tank.')
+        self.assertFalse(await Character.objects.filter(user=self.user).aexists())
+
+    async def test_async_sync_parses_in_the_executor(self):
+        roster = b"Name,Class,Position\nGandalf,Mage,Ranged_Dps\nThrall,Shaman,Heal\n"
+        with mock.patch('characters.async_views.run_cpu_bound', wraps=async_views.run_cpu_bound) as run_cpu_bound:
+            response = await async_views.upload_csv(self.request('post', 'upload_csv', {
+                'file': SimpleUploadedFile('roster.csv', roster), 'sync': '1'}))
+        self.assertContains(response, 'Roster synced: 2 added')
+        self.assertEqual([call.args[0].__name__ for call in run_cpu_bound.call_args_list],
+                         ['getattr', 'file_digest', 'parse'])
+
+    async def test_async_export_streams_in_chunks(self):
+        for i in range(5):
+            await Character.objects.acreate(name=f'Mage{i}', character_class='Mage', position='Ranged_Dps',
+                                            user=self.user)
+        with mock.patch('characters.async_views.EXPORT_CHUNK_SIZE', 2):
+            response = await async_views.export_to_excel(self.request('get', 'export_to_excel'))
+        self.assertTrue(response.is_async)
+        workbook = load_workbook(BytesIO(await self.read_export(response)), read_only=True)
+        self.assertEqual([row[1] for row in list(workbook.active.values)[1:]], [f'Mage{i}' for i in range(5)])
+
+        not_modified = await async_views.export_to_excel(
+            self.request('get', 'export_to_excel', if_none_match=response['ETag']))
+        self.assertEqual(not_modified.status_code, 304)
+
+    async def test_async_export_no_characters(self):
+        response = await async_views.export_to_excel(self.request('get', 'export_to_excel'))
+        self.assertContains(response, 'No characters available to export.')
+
+    async def test_failed_encoding_leaves_no_partial_file(self):
+        await Character.objects.acreate(name='Gandalf', character_class='Mage', position='Ranged_Dps',
+                                        user=self.user)
+
+        def broken_stream(rows, header=None):
+            next(iter(rows))
+            raise ValueError('encoder failed')
+            yield
+
+        with mock.patch.object(EXPORTERS['xlsx'], 'stream', broken_stream), \
+                self.assertRaisesMessage(ValueError, 'encoder failed'):
+            await async_views.export_to_excel(self.request('get', 'export_to_excel'))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+class RoleCountTests(RosterTestCase):
+    def add(self, name, character_class, position):
+        return self.client.post(reverse('add_character'), {
+            'name': name, 'class': character_class, 'position': position,
+        })
+
+    def count(self, position):
+        return RoleCount.objects.get(user=self.user, position=position).count
+
+    def test_counters_follow_adds_deletes_and_imports(self):
+        self.add('Tank1', 'Warrior', 'Tank')
+        self.add('Gandalf', 'Mage', 'Ranged_Dps')
+        self.assertEqual(self.count('Tank'), 1)
+
+        CharacterManager.delete_character(Character.objects.get(user=self.user, name='Tank1'))
+        self.assertEqual(self.count('Tank'), 0)
+
+        self.client.post(reverse('upload_csv'), {'file': SimpleUploadedFile(
+            'roster.csv', b'Name,Class,Position\nArthas,Paladin,Tank\nThrall,Shaman,Heal\nUther,Paladin,Heal\n')})
+        self.assertEqual(self.count('Tank'), 1)
+        self.assertEqual(self.count('Heal'), 2)
+        self.assertEqual(self.count('Ranged_Dps'), 1)
+
+    def test_counter_starts_from_existing_roster(self):
+        Character.objects.create(name='Tank1', character_class='Paladin', position='Tank', user=self.user)
+        self.add('Tank2', 'Warrior', 'Tank')
+        self.assertEqual(self.count('Tank'), 2)
+
+    def test_full_counter_blocks_the_write(self):
+        # Another request already took the last slot but its row is not visible yet
+        RoleCount.objects.create(user=self.user, position='Tank', count=2)
+        response = self.add('Tank1', 'Warrior', 'Tank')
+        self.assertContains(response, 'There cannot be more than 2 Tanks.')
+        self.assertFalse(Character.objects.filter(user=self.user).exists())
+        self.assertEqual(self.count('Tank'), 2)
+
+    def test_rejected_import_leaves_counters_alone(self):
+        RoleCount.objects.create(user=self.user, position='Heal', count=1)
+        with self.assertRaises(RoleCapExceeded):
+            with transaction.atomic():
+                CharacterManager.adjust_role_counts(self.user, {'Ranged_Dps': 3, 'Heal': 2})
+        self.assertEqual(self.count('Heal'), 1)
+        self.assertFalse(RoleCount.objects.filter(user=self.user, position='Ranged_Dps').exists())
+
+    def test_sync_moves_characters_between_counters(self):
+        roster = 'Name,Class,Position\nThrall,Shaman,Heal\nArthas,Paladin,Tank\n'
+        self.client.post(reverse('upload_csv'), {
+            'file': SimpleUploadedFile('roster.csv', roster.encode('utf-8')), 'sync': '1'})
+        self.client.post(reverse('upload_csv'), {
+            'file': SimpleUploadedFile('roster.csv', b'Name,Class,Position\nThrall,Shaman,Ranged_Dps\n'),
+            'sync': '1'})
+        self.assertEqual(self.count('Heal'), 0)
+        self.assertEqual(self.count('Tank'), 0)
+        self.assertEqual(self.count('Ranged_Dps'), 1)
+
+    def test_migration_seeds_counters_from_rosters(self):
+        from django.apps import apps
+        migration = importlib.import_module('characters.migrations.0008_rolecount')
+        Character.objects.create(name='Tank1', character_class='Paladin', position='Tank', user=self.user)
+        Character.objects.create(name='Gandalf', character_class='Mage', position='Ranged_Dps', user=self.user)
+        Character.objects.create(name='Jaina', character_class='Mage', position='Ranged_Dps', user=self.user)
+        migration.seed_role_counts(apps, None)
+        self.assertEqual(dict(RoleCount.objects.filter(user=self.user).values_list('position', 'count')),
+                         {'Tank': 1, 'Ranged_Dps': 2})
+
+
+class StartupImportTests(SimpleTestCase):
+    HEAVY_MODULES = ('numpy', 'openpyxl', 'pandas', 'pyarrow')
+
+    def test_serving_pages_does_not_load_heavy_libraries(self):
+        # A fresh interpreter, since this one already has them from other tests
+        script = (
+            'import sys, django; django.setup(); '
+            'import djangoProject.urls; from django.core.handlers.wsgi import WSGIHandler; WSGIHandler(); '
+            f'print(",".join(m for m in {self.HEAVY_MODULES!r} if m in sys.modules))'
+        )
+        env = {**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)}
+        result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, env=env, check=True)
+        self.assertEqual(result.stdout.strip(), '')
+
+
+class CharacterBatchTests(RosterTestCase):
+    def test_classes_and_positions_are_stored_as_codes(self):
+        batch = CharacterBatch.from_columns(pd.DataFrame({
+            'Name': ['Gandalf', 'Thrall', 'Nobody'],
+            'Class': ['Mage', 'Shaman', 'Bard'],
+            'Position': ['Ranged_Dps', 'Heal', 'Heal'],
+        }))
+        self.assertEqual(batch.class_codes.dtype, 'int8')
+        self.assertEqual(batch.class_codes.tolist()[2], -1)
+        thrall = list(batch)[1]
+        self.assertEqual((thrall.name, thrall.character_class, thrall.position), ('Thrall', 'Shaman', 'Heal'))
+        self.assertFalse(hasattr(thrall, '__dict__'))
+        self.assertEqual(batch.position_counts(), {'Heal': 2, 'Ranged_Dps': 1})
+        self.assertEqual(batch.to_frame()['Class'].tolist(), ['Mage', 'Shaman', ''])
+
+    def test_take_and_save(self):
+        batch = next(CharacterBatch.iter_from_records([
+            {'Name': 'Gandalf', 'Class': 'Mage', 'Position': 'Ranged_Dps'},
+            {'Name': 'Nobody', 'Class': 'Bard', 'Position': 'Heal'},
+            {'Name': 'Thrall', 'Class': 'Shaman', 'Position': 'Heal'},
+        ], batch_size=10))
+        with self.assertRaises(ValueError):
+            batch.to_models(self.user)
+
+        unknown_position = batch.take([0])
+        unknown_position.position_codes[0] = -1
+        with self.assertRaisesMessage(ValueError, 'Only characters with a known class and position can be saved.'):
+            CharacterManager.bulk_create_batches([unknown_position], self.user)
+
+        created = CharacterManager.bulk_create_batches([batch.take([0, 2])], self.user)
+        self.assertEqual(created, 2)
+        self.assertEqual(set(Character.objects.filter(user=self.user).values_list('name', 'character_class')),
+                         {('Gandalf', 'Mage'), ('Thrall', 'Shaman')})
+        self.assertEqual(RoleCount.objects.get(user=self.user, position='Heal').count, 1)
+
+
+class RosterAnalyticsTests(RosterTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = User.objects.create_user(username='other', password='password123')
+        cls.staff = User.objects.create_user(username='staff', password='password123', is_staff=True)
+        for name, character_class, position, user in [
+            ('Gandalf', 'Mage', 'Ranged_Dps', cls.user),
+            ('Jaina', 'Mage', 'Ranged_Dps', cls.user),
+            ('Thrall', 'Shaman', 'Heal', cls.user),
+            ('Arthas', 'Paladin', 'Tank', cls.user),
+            ('Uther', 'Paladin', 'Heal', cls.other),
+        ]:
+            Character.objects.create(name=name, character_class=character_class, position=position, user=user)
+
+    def test_group_by_one_field_in_one_query(self):
+        with self.assertNumQueries(3):  # session, user, GROUP BY
+            response = self.client.get(reverse('roster_analytics'), {'group_by': 'class'})
+        self.assertEqual(response.json(), {
+            'scope': 'user', 'group_by': ['class'], 'total': 4,
+            'counts': {'Mage': 2, 'Paladin': 1, 'Shaman': 1},
+        })
+
+    def test_cross_tab_with_filter(self):
+        response = self.client.get(reverse('roster_analytics'), {'group_by': 'position', 'class': 'Paladin'})
+        self.assertEqual(response.json()['counts'], {'Tank': 1})
+        response = self.client.get(reverse('roster_analytics'), {'group_by': 'position,class'})
+        self.assertEqual(response.json(), {
+            'scope': 'user', 'group_by': ['position', 'class'], 'total': 4,
+            'rows': ['Heal', 'Ranged_Dps', 'Tank'],
+            'columns': ['Mage', 'Paladin', 'Shaman'],
+            'counts': [[0, 0, 1], [2, 0, 0], [0, 1, 0]],
+        })
+
+    def test_total_without_grouping(self):
+        response = self.client.get(reverse('roster_analytics'), {'position': 'Ranged_Dps'})
+        self.assertEqual(response.json(), {'scope': 'user', 'group_by': [], 'total': 2})
+
+    def test_invalid_queries(self):
+        for params in ({'group_by': 'name'}, {'group_by': 'class,class'},
+                       {'group_by': 'class,position,user'}, {'scope': 'everyone'}):
+            response = self.client.get(reverse('roster_analytics'), params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('error', response.json())
+
+    def test_rollup_across_users_is_staff_only(self):
+        response = self.client.get(reverse('roster_analytics'), {'scope': 'all', 'group_by': 'user'})
+        self.assertEqual(response.status_code, 403)
+
+        self.client.login(username='staff', password='password123')
+        response = self.client.get(reverse('roster_analytics'), {'scope': 'all', 'group_by': 'user'})
+        self.assertEqual(response.json()['counts'], {'other': 1, 'testuser': 4})
+        response = self.client.get(reverse('roster_analytics'), {'scope': 'all', 'group_by': 'class', 'user': 'other'})
+        self.assertEqual(response.json()['counts'], {'Paladin': 1})
+
+    def test_rollups_are_cached(self):
+        query = RosterQuery(['position'])
+        self.assertEqual(query.get()['total'], 5)
+        Character.objects.create(name='Varian', character_class='Warrior', position='Tank', user=self.other)
+        with self.assertNumQueries(0):
+            self.assertEqual(query.get()['total'], 5)
+        self.assertEqual(RosterQuery(['position'], user=self.other).get()['total'], 2)
+
+
+class BulkOperationTests(RosterTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = User.objects.create_user(username='other', password='password123')
+
+    def setUp(self):
+        super().setUp()
+        CharacterManager.bulk_create_characters(
+            [{'Name': f'Mage{i}', 'Class': 'Mage', 'Position': 'Ranged_Dps'} for i in range(30)]
+            + [{'Name': 'Arthas', 'Class': 'Paladin', 'Position': 'Tank'},
+               {'Name': 'Uther', 'Class': 'Paladin', 'Position': 'Heal'}],
+            self.user,
+        )
+        self.stranger = Character.objects.create(name='Jaina', character_class='Mage', position='Ranged_Dps',
+                                                 user=self.other)
+
+    def count(self, position):
+        return RoleCount.objects.get(user=self.user, position=position).count
+
+    def test_delete_by_ids_in_constant_queries(self):
+        ids = list(Character.objects.filter(user=self.user, position='Ranged_Dps').values_list('id', flat=True))
+        version = RosterVersion.objects.get(user=self.user).version
+        RoleCount.objects.create(user=self.user, position='Melee_Dps')
+        # session, user, savepoint, counter lock, GROUP BY, counter UPDATE, DELETE, release, synced file reset,
+        # version bump
+        with self.assertNumQueries(10):
+            response = self.client.post(reverse('bulk_delete_characters'), {'ids': ids + [self.stranger.id]})
+        self.assertEqual(response.json(), {'deleted': 30})
+        self.assertEqual(Character.objects.filter(user=self.user).count(), 2)
+        self.assertTrue(Character.objects.filter(id=self.stranger.id).exists())
+        self.assertEqual(self.count('Ranged_Dps'), 0)
+        self.assertEqual(RosterVersion.objects.get(user=self.user).version, version + 1)
+
+    def test_delete_by_filter_and_all(self):
+        response = self.client.post(reverse('bulk_delete_characters'), {'class': 'Paladin', 'position': 'Tank'})
+        self.assertEqual(response.json(), {'deleted': 1})
+        self.assertEqual(self.count('Tank'), 0)
+
+        response = self.client.post(reverse('bulk_delete_characters'))
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('bulk_delete_characters'), {'all': '1'})
+        self.assertEqual(response.json(), {'deleted': 31})
+        self.assertEqual(Character.objects.count(), 1)
+
+    def test_change_position(self):
+        uther = Character.objects.get(user=self.user, name='Uther')
+        response = self.client.post(reverse('bulk_change_position'), {'ids': f'{uther.id}', 'position': 'Tank'})
+        self.assertEqual(response.json(), {'updated': 1})
+        self.assertEqual(self.count('Tank'), 2)
+        self.assertEqual(self.count('Heal'), 0)
+
+    def test_change_position_checks_classes_and_caps(self):
+        mages = list(Character.objects.filter(user=self.user, position='Ranged_Dps').values_list('id', flat=True))
+        response = self.client.post(reverse('bulk_change_position'), {'ids': mages[:2], 'position': 'Tank'})
+        self.assertEqual(response.json(), {'error': 'Mage cannot be a Tank.'})
+
+        Character.objects.create(name='Varian', character_class='Warrior', position='Melee_Dps', user=self.user)
+        RoleCount.objects.filter(user=self.user, position='Melee_Dps').update(count=1)
+        ids = list(Character.objects.filter(user=self.user, character_class__in=['Warrior', 'Paladin'])
+                   .values_list('id', flat=True))
+        response = self.client.post(reverse('bulk_change_position'), {'ids': ids, 'position': 'Tank'})
+        self.assertEqual(response.json(), {'error': 'There cannot be more than 2 Tanks.'})
+        self.assertEqual(Character.objects.filter(user=self.user, position='Tank').count(), 1)
+        self.assertEqual(self.count('Tank'), 1)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get(reverse('bulk_delete_characters')).status_code, 405)
+        response = self.client.post(reverse('bulk_delete_characters'), {'ids': 'one'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('bulk_change_position'), {'position': 'Tank'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('bulk_change_position'), {'ids': '1', 'position': 'Bard'})
+        self.assertEqual(response.json(), {'error': 'Unknown position: Bard.'})
+
+
+class UploadErrorReportTests(RosterTestCase):
+    def upload(self, count, **data):
+        # count characters, every one of them with a lowercase name
+        roster = ''.join(f"Name: mage{i}\nClass: Mage\nPosition: Ranged_Dps\n\n" for i in range(count))
+        return self.client.post(reverse('upload_csv'), {'file': SimpleUploadedFile('roster.csv', roster.encode()),
+                                                        **data})
+
+    def test_summary_is_capped_and_counted(self):
+        response = self.upload(ERROR_SUMMARY_SIZE + 10)
+        report = response.context['error_report']
+        self.assertEqual(report.total, ERROR_SUMMARY_SIZE + 10)
+        self.assertEqual(len(report.summary), ERROR_SUMMARY_SIZE)
+        self.assertEqual(report.most_common(), [('name_capital', ERROR_SUMMARY_SIZE + 10)])
+        self.assertContains(response, 'Row 3: Name must start with a capital letter.')
+        self.assertNotContains(response, f'Row {ERROR_SUMMARY_SIZE + 1}:')
+        self.assertContains(response, reverse('upload_error_report', args=[report.token, 'xlsx']))
+        self.assertFalse(Character.objects.filter(user=self.user).exists())
+
+    def test_download_every_error(self):
+        token = self.upload(ERROR_SUMMARY_SIZE + 10).context['error_report'].token
+
+        opened = []
+
+        def track_open_report(user_id, token):
+            opened.append(open_report(user_id, token))
+            return opened[-1]
+
+        with mock.patch('characters.views.open_report', track_open_report):
+            response = self.client.get(reverse('upload_error_report', args=[token, 'csv']))
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        response.close()
+        # The download leaves no file handle behind
+        self.assertTrue(all(report_file.closed for report_file in opened))
+        self.assertEqual(lines[0], ','.join(REPORT_FIELDS))
+        self.assertEqual(len(lines), ERROR_SUMMARY_SIZE + 11)
+        self.assertEqual(lines[-1], f'{ERROR_SUMMARY_SIZE + 10},Name,name_capital,Name must start with a capital letter.')
+
+        response = self.client.get(reverse('upload_error_report', args=[token, 'xlsx']))
+        sheet = load_workbook(BytesIO(b''.join(response.streaming_content))).active
+        self.assertEqual(sheet.max_row, ERROR_SUMMARY_SIZE + 11)
+        self.assertEqual([cell.value for cell in sheet[2]], [1, 'Name', 'name_capital',
+                                                             'Name must start with a capital letter.'])
+
+    def test_report_is_private(self):
+        token = self.upload(1).context['error_report'].token
+        User.objects.create_user(username='other', password='password123')
+        self.client.login(username='other', password='password123')
+        response = self.client.get(reverse('upload_error_report', args=[token, 'csv']))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('upload_error_report', args=['x' + token[1:], 'csv']))
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(CHARACTER_UPLOAD_FAIL_FAST_ERRORS=5)
+    def test_fail_fast_stops_reading(self):
+        response = self.upload(ERROR_SUMMARY_SIZE, fail_fast='1')
+        self.assertEqual(response.context['error_report'].total, 5)
+        self.assertContains(response, 'the upload stopped early')
+
+    def test_expired_reports_are_removed(self):
+        stale = os.path.join(self.report_dir, f'{self.user.pk}-{"0" * 32}.csv')
+        with open(stale, 'w') as stale_file:
+            stale_file.write('row,field,code,message\n')
+        os.utime(stale, (0, 0))
+        self.upload(1)
+        self.assertFalse(os.path.exists(stale))
+
+
+class ChunkedUploadTests(RosterTestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, CHARACTER_UPLOAD_CHUNK_SIZE=64)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def roster(self, count):
+        return ''.join(f"Name: Mage{i}\nClass: Mage\nPosition: Ranged_Dps\n\n" for i in range(count)).encode()
+
+    def start(self, data, **options):
+        response = self.client.post(reverse('start_chunked_upload'), {'size': len(data), **options})
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def put_chunk(self, upload, data, index, checksum=None):
+        chunk = data[index * upload['chunk_size']:(index + 1) * upload['chunk_size']]
+        return self.client.put(reverse('upload_chunk', args=[upload['token'], index]), chunk,
+                               content_type='application/octet-stream',
+                               headers={'X-Chunk-SHA256': checksum or hashlib.sha256(chunk).hexdigest()})
+
+    def finalize(self, upload):
+        return self.client.post(reverse('finalize_chunked_upload', args=[upload['token']]))
+
+    def test_upload_in_any_order_and_import(self):
+        data = self.roster(20)
+        upload = self.start(data)
+        self.assertEqual(upload['chunks'], -(-len(data) // 64))
+        for index in reversed(range(upload['chunks'])):
+            self.assertEqual(self.put_chunk(upload, data, index).status_code, 200)
+
+        response = self.finalize(upload)
+        self.assertEqual(response.status_code, 202)
+        # The last chunk to arrive parsed only a chunk's worth; the job parses the rest
+        self.assertLess(response.json()['parsed_rows'], 20)
+        self.assertEqual(process_pending_jobs(), 1)
+        self.assertEqual(Character.objects.filter(user=self.user).count(), 20)
+        self.assertEqual(self.client.get(response.json()['status_url']).json()['rows_inserted'], 20)
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'uploads')), [])
+
+    def test_prefix_is_parsed_while_chunks_arrive(self):
+        data = self.roster(20)
+        upload = self.start(data)
+        self.put_chunk(upload, data, 2)
+        self.assertEqual(self.put_chunk(upload, data, 1).json()['parsed_rows'], 0)
+        progress = self.put_chunk(upload, data, 0).json()
+        # Three 64 byte chunks hold four complete records, but one request
+        # parses about a chunk's worth of them
+        self.assertEqual(progress['parsed_rows'], 2)
+        self.assertEqual(data[:progress['parsed_bytes']].count(b'Name:'), 2)
+        progress = self.put_chunk(upload, data, 3).json()
+        self.assertEqual(progress['parsed_rows'], 4)
+        self.assertEqual(data[:progress['parsed_bytes']].count(b'Name:'), 4)
+
+    def test_racing_chunk_with_other_bytes_is_rejected(self):
+        data = self.roster(10)
+        upload = self.start(data)
+        # Loaded before another request stores chunk 0
+        stale = ChunkedUpload.objects.get()
+        self.put_chunk(upload, data, 0)
+        other = data[:64].replace(b'Mage0', b'Mage9')
+        with self.assertRaises(UploadConflict):
+            write_chunk(stale, 0, BytesIO(other), hashlib.sha256(other).hexdigest())
+        with open(os.path.join(self.media_root, 'uploads', upload['token'], 'roster'), 'rb') as roster_file:
+            self.assertEqual(roster_file.read(64), data[:64])
+        self.assertEqual(write_chunk(stale, 0, BytesIO(data[:64]), hashlib.sha256(data[:64]).hexdigest()).received,
+                         {'0': hashlib.sha256(data[:64]).hexdigest()})
+
+    def test_segments_do_not_pad_to_the_longest_value(self):
+        long_name = 'M' + 'a' * 500
+        data = self.roster(3).replace(b'Name: Mage1', f'Name: {long_name}'.encode())
+        upload = self.start(data)
+        for index in range(upload['chunks']):
+            self.put_chunk(upload, data, index)
+        import numpy as np
+
+        upload_dir = os.path.join(self.media_root, 'uploads', upload['token'])
+        stored = 0
+        for name in os.listdir(upload_dir):
+            if name.startswith('segment-'):
+                with np.load(os.path.join(upload_dir, name)) as segment:
+                    stored += segment['Name'].nbytes
+        self.assertEqual(stored, len('Mage0' + long_name + 'Mage2'))
+        batches = [batch for batch, row_codes in parsed_batches(ChunkedUpload.objects.get())]
+        self.assertEqual(pd.concat(batches)['Name'].tolist(), ['Mage0', long_name, 'Mage2'])
+
+    def test_import_reads_parsed_segments_not_the_file(self):
+        data = self.roster(10)
+        upload = self.start(data)
+        for index in range(upload['chunks']):
+            self.put_chunk(upload, data, index)
+        self.finalize(upload)
+        with open(os.path.join(self.media_root, 'uploads', upload['token'], 'roster'), 'wb') as roster_file:
+            roster_file.write(b'\0' * len(data))
+        process_pending_jobs()
+        self.assertEqual(Character.objects.filter(user=self.user).count(), 10)
+
+    def test_parsed_upload_reports_errors_with_row_numbers(self):
+        data = self.roster(6).replace(b'Name: Mage4', b'Name: mage4')
+        upload = self.start(data)
+        for index in range(upload['chunks']):
+            self.put_chunk(upload, data, index)
+        job_id = self.finalize(upload).json()['import_job']
+        process_pending_jobs()
+        job = ImportJob.objects.get(id=job_id)
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertEqual(job.error_counts, {'name_capital': 1})
+        self.assertFalse(Character.objects.filter(user=self.user).exists())
+        response = self.client.get(reverse('upload_error_report', args=[job.error_report, 'csv']))
+        self.assertIn(b'5,Name,name_capital,', b''.join(response.streaming_content))
+
+    def test_resume_and_retries(self):
+        data = self.roster(10)
+        upload = self.start(data)
+        self.put_chunk(upload, data, 0)
+        self.put_chunk(upload, data, 3)
+
+        status = self.client.get(reverse('chunked_upload_status', args=[upload['token']])).json()
+        self.assertEqual(status['received'], [0, 3])
+        self.assertEqual(self.put_chunk(upload, data, 0).status_code, 200)
+        self.assertEqual(self.put_chunk(upload, data, 0, checksum='0' * 64).status_code, 409)
+
+        response = self.finalize(upload)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('starting with chunk 1', response.json()['error'])
+
+        for index in range(1, upload['chunks']):
+            self.put_chunk(upload, data, index)
+        self.assertEqual(self.finalize(upload).status_code, 202)
+        # Finalizing again hands back the same job
+        self.assertEqual(self.finalize(upload).status_code, 202)
+        self.assertEqual(ImportJob.objects.count(), 1)
+
+    def test_bad_chunks_are_rejected(self):
+        data = self.roster(10)
+        upload = self.start(data)
+        self.assertEqual(self.put_chunk(upload, data, 1, checksum='0' * 64).status_code, 400)
+        self.assertEqual(self.put_chunk(upload, data, upload['chunks']).status_code, 400)
+        response = self.client.put(reverse('upload_chunk', args=[upload['token'], 0]), data[:65],
+                                   content_type='application/octet-stream',
+                                   headers={'X-Chunk-SHA256': hashlib.sha256(data[:65]).hexdigest()})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(ChunkedUpload.objects.get().received, {})
+        self.assertEqual(self.client.post(reverse('start_chunked_upload'), {'size': 0}).status_code, 400)
+
+    def test_other_formats_are_parsed_by_the_job(self):
+        data = b'Name,Class,Position\n' + b''.join(f'Mage{i},Mage,Ranged_Dps\n'.encode() for i in range(10))
+        upload = self.start(data)
+        for index in range(upload['chunks']):
+            progress = self.put_chunk(upload, data, index).json()
+        self.assertEqual(progress['parsed_rows'], 0)
+        self.finalize(upload)
+        process_pending_jobs()
+        self.assertEqual(Character.objects.filter(user=self.user).count(), 10)
+
+    def test_upload_is_private(self):
+        data = self.roster(2)
+        upload = self.start(data)
+        User.objects.create_user(username='other', password='password123')
+        self.client.login(username='other', password='password123')
+        self.assertEqual(self.put_chunk(upload, data, 0).status_code, 404)
+        self.assertEqual(self.client.get(reverse('chunked_upload_status', args=[upload['token']])).status_code, 404)
+
+
+class ConvertRosterCommandTests(SimpleTestCase):
+    # A SimpleTestCase fails on any database query, which the converter must not make
+    def setUp(self):
+        super().setUp()
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def write_roster(self, characters):
+        path = os.path.join(self.workdir, 'roster.csv')
+        with open(path, 'w', encoding='utf-8') as roster_file:
+            for name, character_class, position in characters:
+                roster_file.write(f"Name: {name}\nClass: {character_class}\nPosition: {position}\n\n")
+        return path
+
+    def convert(self, path, output, **options):
+        out, err = StringIO(), StringIO()
+        call_command('convert_roster', path, os.path.join(self.workdir, output), stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_convert_to_csv_xlsx_and_jsonl(self):
+        path = self.write_roster([(f'Mage{i}', 'Mage', 'Ranged_Dps') for i in range(50)])
+        self.convert(path, 'roster.out', region_size=100, format='csv')
+        with open(os.path.join(self.workdir, 'roster.out'), encoding='utf-8') as output:
+            lines = output.read().splitlines()
+        self.assertEqual(lines[0], 'name,character_class,position')
+        self.assertEqual(lines[1:3], ['Mage0,Mage,Ranged_Dps', 'Mage1,Mage,Ranged_Dps'])
+        self.assertEqual(len(lines), 51)
+
+        self.convert(path, 'roster.xlsx')
+        sheet = load_workbook(os.path.join(self.workdir, 'roster.xlsx')).active
+        self.assertEqual(sheet.max_row, 51)
+        self.assertEqual([cell.value for cell in sheet[51]], ['Mage49', 'Mage', 'Ranged_Dps'])
+
+        self.convert(path, 'roster.jsonl')
+        with open(os.path.join(self.workdir, 'roster.jsonl'), encoding='utf-8') as output:
+            first = json.loads(output.readline())
+        self.assertEqual(first, {'name': 'Mage0', 'character_class': 'Mage', 'position': 'Ranged_Dps'})
+
+    @unittest.skipUnless(EXPORTERS['parquet'].is_available(), 'pyarrow is not installed')
+    def test_convert_to_parquet(self):
+        import pyarrow.parquet as pq
+
+        path = self.write_roster([('Gandalf', 'Mage', 'Ranged_Dps'), ('Thrall', 'Shaman', 'Heal')])
+        self.convert(path, 'roster.parquet')
+        table = pq.read_table(os.path.join(self.workdir, 'roster.parquet'))
+        self.assertEqual(table.column_names, ['name', 'character_class', 'position'])
+        self.assertEqual(table.column('name').to_pylist(), ['Gandalf', 'Thrall'])
+
+    def test_invalid_rows_fail_without_output(self):
+        path = self.write_roster([('Gandalf', 'Mage', 'Ranged_Dps'), ('thrall', 'Shaman', 'Heal'),
+                                  ('Gandalf', 'Mage', 'Ranged_Dps')])
+        with self.assertRaises(CommandError):
+            self.convert(path, 'roster.csv')
+        self.assertEqual(os.listdir(self.workdir), ['roster.csv'])
+
+        _, err = self.convert(path, 'converted.csv', skip_invalid=True)
+        self.assertIn('Row 2: Name must start with a capital letter.', err)
+        self.assertIn('Row 3: Names cannot be the same: Gandalf', err)
+        self.assertIn('Skipped 2 invalid rows.', err)
+        with open(os.path.join(self.workdir, 'converted.csv'), encoding='utf-8') as output:
+            self.assertEqual(output.read().splitlines()[1:], ['Gandalf,Mage,Ranged_Dps'])
+
+    def test_unknown_format(self):
+        path = self.write_roster([('Gandalf', 'Mage', 'Ranged_Dps')])
+        with self.assertRaises(CommandError):
+            self.convert(path, 'roster.pdf')
+
+
+def n_plus_one(request):
+    for character_id in range(12):
+        Character.objects.filter(id=character_id).exists()
+    return HttpResponse('ok')
+
+
+urlpatterns = [path('n-plus-one/', n_plus_one, name='n_plus_one')]
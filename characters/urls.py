@@ -1,17 +1,42 @@
+from django.conf import settings
 from django.urls import path
+from . import async_views
 from .views import (
     upload_csv, character_list, export_to_excel,
     add_character, delete_character, register,
-    user_login, user_logout, landing_page
+    user_login, user_logout, landing_page, import_job_status,
+    export_characters, character_list_api, roster_analytics, profiling_dashboard, profiling_metrics,
+    bulk_delete_characters, bulk_change_position, upload_error_report,
+    start_chunked_upload, chunked_upload_status, upload_chunk, finalize_chunked_upload,
 )
 
+# Under ASGI the upload and export pages can run as coroutines, keeping
+# parsing and xlsx encoding off the event loop
+if settings.CHARACTER_ASYNC_VIEWS:
+    upload_csv = async_views.upload_csv
+    export_to_excel = async_views.export_to_excel
+
 urlpatterns = [
     path('', landing_page, name='landing_page'),
     path('upload_csv/', upload_csv, name='upload_csv'),
+    path('upload_csv/errors/<str:token>/<str:fmt>/', upload_error_report, name='upload_error_report'),
+    path('api/uploads/', start_chunked_upload, name='start_chunked_upload'),
+    path('api/uploads/<str:token>/', chunked_upload_status, name='chunked_upload_status'),
+    path('api/uploads/<str:token>/chunks/<int:index>/', upload_chunk, name='upload_chunk'),
+    path('api/uploads/<str:token>/finalize/', finalize_chunked_upload, name='finalize_chunked_upload'),
+    path('import_jobs/<int:job_id>/', import_job_status, name='import_job_status'),
     path('characters/', character_list, name='character_list'),
+    path('api/characters/', character_list_api, name='character_list_api'),
+    path('api/analytics/', roster_analytics, name='roster_analytics'),
     path('export_to_excel/', export_to_excel, name='export_to_excel'),
+    path('export/', export_characters, name='export_characters'),
+    path('export/<str:fmt>/', export_characters, name='export_characters_format'),
     path('add_character/', add_character, name='add_character'),
     path('delete_character/<int:character_id>/', delete_character, name='delete_character'),
+    path('api/characters/delete/', bulk_delete_characters, name='bulk_delete_characters'),
+    path('api/characters/position/', bulk_change_position, name='bulk_change_position'),
+    path('profiling/', profiling_dashboard, name='profiling_dashboard'),
+    path('profiling/metrics/', profiling_metrics, name='profiling_metrics'),
     path('register/', register, name='register'),
     path('login/', user_login, name='login'),
     path('logout/', user_logout, name='logout'),
@@ -3,11 +3,28 @@ from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm
 from django.shortcuts import render, redirect, get_object_or_404
-from .models import Character
-from .character_management import CharacterValidator, CharacterManager, MAX_TANKS, MAX_HEALS
-from django.http import HttpResponse
-import pandas as pd
-from io import StringIO
+from django.db import IntegrityError, transaction
+from .models import Character, ChunkedUpload, ImportJob, RosterVersion
+from .character_management import (
+    CharacterValidator, CharacterManager, CharacterImporter, RosterSync, RoleCapExceeded, DEFAULT_PAGE_SIZE,
+    MAX_BULK_IDS,
+)
+from .rules import get_rules
+from .analytics import RosterQuery
+from django.conf import settings
+from .stats import CharacterStats
+from .profiling import profile_store, record_rows, render_prometheus, REPEATED_QUERY_THRESHOLD
+from django.contrib.admin.views.decorators import staff_member_required
+from .exporters import EXPORTERS, available_formats, negotiate_format
+from .export_cache import export_etag, open_cached_export
+from .error_reports import REPORT_FIELDS, iter_report_rows, open_report
+from .chunked_uploads import (
+    CHECKSUM_HEADER, ChunkError, UploadConflict, finalize_upload, start_upload, write_chunk,
+)
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.views.decorators.http import require_http_methods, require_POST
 
 MAX_DISPLAYED_CHARACTERS = 10
 
@@ -15,63 +32,188 @@ MAX_DISPLAYED_CHARACTERS = 10
 def upload_csv(request):
     if request.method == "POST" and request.FILES['file']:
         csv_file = request.FILES['file']
+        sync = bool(request.POST.get('sync'))
+        fail_fast = bool(request.POST.get('fail_fast'))
 
-        character_data = {}
-        tank_count = 0
-        heal_count = 0
-        names_set = set()
-        error_messages = []
+        # Large files are queued for the import worker so they don't tie up this request
+        if csv_file.size > settings.CHARACTER_IMPORT_ASYNC_THRESHOLD:
+            import_job = ImportJob.objects.create(user=request.user, file=csv_file, sync=sync, fail_fast=fail_fast)
+            return render(request, 'upload_csv.html', {'import_job': import_job})
 
-        file_content = StringIO(csv_file.read().decode('utf-8'))
+        max_errors = settings.CHARACTER_UPLOAD_FAIL_FAST_ERRORS if fail_fast else None
+        if sync:
+            # The file is the whole roster: only the differences are written
+            roster_sync = RosterSync(request.user, max_errors=max_errors)
+            error_messages = roster_sync.run(csv_file)
+            record_rows(request, roster_sync.rows_parsed)
+            if error_messages:
+                return render(request, 'upload_csv.html', error_context(roster_sync.report))
+            return render(request, 'upload_csv.html', {'import_diff': roster_sync.diff})
 
-        for line in file_content:
-            line = line.strip()
-            if ':' in line:
-                key, value = map(str.strip, line.split(':', 1))
-                character_data[key] = value
+        importer = CharacterImporter(request.user, max_errors=max_errors)
+        error_messages = importer.run(csv_file)
+        record_rows(request, importer.rows_parsed)
 
-            if line == '':
-                # Validate character data
-                error_messages += CharacterValidator.validate(character_data, names_set, tank_count, heal_count)
+        if error_messages:
+            return render(request, 'upload_csv.html', error_context(importer.report))
 
-                if 'Tank' in character_data.get('Position', ''):
-                    tank_count += 1
-                if 'Heal' in character_data.get('Position', ''):
-                    heal_count += 1
+        return redirect('character_list')
+    return render(request, 'upload_csv.html')
 
-                if error_messages:
-                    character_data = {}
-                    continue
+def error_context(report):
+    return {'error_messages': report.messages(), 'error_report': report}
 
-                CharacterManager.create_character(character_data, request.user)
-                character_data = {}
+@login_required
+def upload_error_report(request, token, fmt):
+    # Reports are named after their owner, so another user's token is just a 404
+    report_file = open_report(request.user.pk, token)
+    if report_file is None or fmt not in ('csv', 'xlsx'):
+        if report_file is not None:
+            report_file.close()
+        raise Http404('No such error report.')
+    if fmt == 'csv':
+        return FileResponse(report_file, as_attachment=True, filename='upload_errors.csv', content_type='text/csv')
+    response = StreamingHttpResponse(EXPORTERS['xlsx'].stream(report_rows(report_file), header=REPORT_FIELDS),
+                                     content_type=EXPORTERS['xlsx'].content_type)
+    response['Content-Disposition'] = 'attachment; filename=upload_errors.xlsx'
+    return response
 
-        # Final check for remaining character data
-        if character_data and all(k in character_data for k in ['Name', 'Class', 'Position']):
-            error_messages += CharacterValidator.validate(character_data, names_set, tank_count, heal_count)
+def report_rows(report_file):
+    with report_file:
+        yield from iter_report_rows(report_file)
 
-            if not error_messages:
-                CharacterManager.create_character(character_data, request.user)
+@login_required
+@require_POST
+def start_chunked_upload(request):
+    try:
+        size = int(request.POST['size'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Send the file size in bytes.'}, status=400)
+    try:
+        upload = start_upload(request.user, size, bool(request.POST.get('sync')),
+                              bool(request.POST.get('fail_fast')))
+    except ChunkError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    return JsonResponse(upload.progress(), status=201)
 
-        if error_messages:
-            return render(request, 'upload_csv.html', {'error_messages': error_messages})
+@login_required
+def chunked_upload_status(request, token):
+    # What a client resuming an upload asks for: the chunks already stored
+    upload = get_object_or_404(ChunkedUpload, token=token, user=request.user)
+    return JsonResponse(upload.progress())
 
-        return redirect('character_list')
-    return render(request, 'upload_csv.html')
+@login_required
+@require_http_methods(['PUT'])
+def upload_chunk(request, token, index):
+    upload = get_object_or_404(ChunkedUpload, token=token, user=request.user)
+    try:
+        # The body is streamed to disk, never read into memory as a whole
+        upload = write_chunk(upload, index, request, request.headers.get(CHECKSUM_HEADER))
+    except UploadConflict as exc:
+        return JsonResponse({'error': str(exc)}, status=409)
+    except ChunkError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    return JsonResponse(upload.progress())
+
+@login_required
+@require_POST
+def finalize_chunked_upload(request, token):
+    upload = get_object_or_404(ChunkedUpload, token=token, user=request.user)
+    try:
+        upload = finalize_upload(upload)
+    except ChunkError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    progress = upload.progress()
+    progress['status_url'] = reverse('import_job_status', args=[upload.import_job_id])
+    return JsonResponse(progress, status=202)
+
+@login_required
+def import_job_status(request, job_id):
+    import_job = get_object_or_404(ImportJob, id=job_id, user=request.user)
+    progress = import_job.progress()
+    if import_job.error_report:
+        progress['error_report'] = {
+            fmt: reverse('upload_error_report', args=[import_job.error_report, fmt]) for fmt in ('csv', 'xlsx')
+        }
+    return JsonResponse(progress)
 
 @login_required
 def character_list(request):
-    # Use the sorting method to display characters sorted by name
-    characters = CharacterManager.sort_characters_by_name(request.user)[:MAX_DISPLAYED_CHARACTERS]
-    # Aggregating character classes for display or analysis
-    character_classes_count = CharacterManager.aggregate_character_classes(request.user)
+    # Characters sorted by name, one keyset page at a time
+    try:
+        characters, next_cursor = page_from_request(request, MAX_DISPLAYED_CHARACTERS)
+    except ValueError:
+        # A stale or hand-edited cursor just starts again from the first page
+        characters, next_cursor = CharacterManager.page_characters(
+            request.user, page_size=MAX_DISPLAYED_CHARACTERS,
+            position=request.GET.get('position'), character_class=request.GET.get('class')
+        )
+    record_rows(request, len(characters))
+    next_query = request.GET.copy()
+    next_query['cursor'] = next_cursor
+    # Cached per user and invalidated whenever the roster changes
+    character_stats = CharacterStats.get(request.user)
     return render(request, 'character_list.html', {
         'characters': characters,
-        'character_classes_count': character_classes_count,
+        'next_page_query': next_query.urlencode() if next_cursor else None,
+        'rules': get_rules(),
+        'selected_position': request.GET.get('position', ''),
+        'selected_class': request.GET.get('class', ''),
+        'character_classes_count': character_stats['class_counts'],
+        'character_stats': character_stats,
     })
 
+@login_required
+def character_list_api(request):
+    try:
+        characters, next_cursor = page_from_request(request, DEFAULT_PAGE_SIZE)
+    except ValueError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    record_rows(request, len(characters))
+    return JsonResponse({
+        'results': [
+            {
+                'id': character.id,
+                'name': character.name,
+                'character_class': character.character_class,
+                'position': character.position,
+            }
+            for character in characters
+        ],
+        'next_cursor': next_cursor,
+    })
+
+@login_required
+def roster_analytics(request):
+    scope = request.GET.get('scope', 'user')
+    if scope not in ('user', 'all'):
+        return JsonResponse({'error': 'scope must be user or all.'}, status=400)
+    if scope == 'all' and not request.user.is_staff:
+        return JsonResponse({'error': 'Only staff can query every roster.'}, status=403)
+    try:
+        query = RosterQuery.from_params(request.GET, user=request.user if scope == 'user' else None)
+    except ValueError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    result = query.get()
+    record_rows(request, result['total'])
+    return JsonResponse({'scope': scope, **result})
+
+def page_from_request(request, default_page_size):
+    try:
+        page_size = int(request.GET.get('page_size', default_page_size))
+    except ValueError:
+        raise ValueError('page_size must be an integer.')
+    return CharacterManager.page_characters(
+        request.user,
+        cursor=request.GET.get('cursor'),
+        page_size=page_size,
+        position=request.GET.get('position'),
+        character_class=request.GET.get('class'),
+    )
+
 @login_required
 def add_character(request):
+    rules = get_rules()
     if request.method == "POST":
         name = request.POST.get('name').strip()
         character_class = request.POST.get('class')
@@ -79,56 +221,153 @@ def add_character(request):
 
         if not CharacterValidator.name_starts_with_capital(name):
             return render(request, 'add_character.html', {
+                'rules': rules,
                 'error_message': 'Name must start with a capital letter.'
             })
 
-        if not CharacterValidator.is_valid_position_class(position, character_class):
+        if not rules.is_legal(position, character_class):
             return render(request, 'add_character.html', {
+                'rules': rules,
                 'error_message': f"{character_class} cannot be a {position}."
             })
 
         if Character.objects.filter(name=name, user=request.user).exists():
             return render(request, 'add_character.html', {
+                'rules': rules,
                 'error_message': 'Names cannot be the same for the same user.'
             })
 
-        if position == 'Tank' and CharacterManager.count_characters_by_position(request.user, 'Tank') >= MAX_TANKS:
+        try:
+            with transaction.atomic():
+                CharacterManager.create_character({'Name': name, 'Class': character_class, 'Position': position},
+                                                  request.user)
+        except IntegrityError:
+            # A concurrent request added the same name after the check above
             return render(request, 'add_character.html', {
-                'error_message': 'There cannot be more than 2 Tanks.'
+                'rules': rules,
+                'error_message': 'Names cannot be the same for the same user.'
             })
-
-        if position == 'Heal' and CharacterManager.count_characters_by_position(request.user, 'Heal') >= MAX_HEALS:
+        except RoleCapExceeded as exc:
+            # The role counter row enforces Tank/Heal caps, concurrent adds included
             return render(request, 'add_character.html', {
-                'error_message': 'There cannot be more than 2 Healers.'
+                'rules': rules,
+                'error_message': str(exc)
             })
-
-        CharacterManager.create_character({'Name': name, 'Class': character_class, 'Position': position}, request.user)
         return redirect('character_list')
 
-    return render(request, 'add_character.html')
+    return render(request, 'add_character.html', {'rules': rules})
 
 @login_required
 def delete_character(request, character_id):
     character = get_object_or_404(Character, id=character_id, user=request.user)
-    character.delete()
+    CharacterManager.delete_character(character)
     return redirect('character_list')
 
+def ids_from_request(request):
+    # ids=1&ids=2 and ids=1,2 both work; None when no ids were sent
+    values = [value for item in request.POST.getlist('ids') for value in item.split(',') if value.strip()]
+    if not values:
+        return None
+    try:
+        ids = [int(value) for value in values]
+    except ValueError:
+        raise ValueError('ids must be integers.')
+    if len(ids) > MAX_BULK_IDS:
+        raise ValueError(f'At most {MAX_BULK_IDS} ids can be sent at once.')
+    return ids
+
 @login_required
-def export_to_excel(request):
-    # Use the export method from CharacterManager
-    df = CharacterManager.export_characters_to_dataframe(request.user)
+@require_POST
+def bulk_delete_characters(request):
+    try:
+        ids = ids_from_request(request)
+    except ValueError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    position = request.POST.get('position')
+    character_class = request.POST.get('class')
+    if ids is None and not position and not character_class and not request.POST.get('all'):
+        # Deleting the whole roster has to be asked for explicitly
+        return JsonResponse({'error': 'Send ids, a position or class, or all=1.'}, status=400)
+    deleted = CharacterManager.bulk_delete_characters(request.user, ids, position, character_class)
+    record_rows(request, deleted)
+    return JsonResponse({'deleted': deleted})
+
+@login_required
+@require_POST
+def bulk_change_position(request):
+    try:
+        ids = ids_from_request(request)
+        if ids is None:
+            raise ValueError('Send the ids of the characters to move.')
+        updated = CharacterManager.bulk_change_position(request.user, ids, request.POST.get('position'))
+    except (ValueError, RoleCapExceeded) as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    record_rows(request, updated)
+    return JsonResponse({'updated': updated})
 
-    if df.empty:
+@login_required
+def export_to_excel(request):
+    if not CharacterManager.get_characters(request.user).exists():
         return render(request, 'character_list.html', {
             'characters': [],
             'error_message': 'No characters available to export.'
         })
 
-    response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    response['Content-Disposition'] = 'attachment; filename=characters.xlsx'
-    df.to_excel(response, index=False)
+    return export_response(request, EXPORTERS['xlsx'], request.user)
+
+@login_required
+def export_characters(request, fmt=None):
+    exporter = negotiate_format(request, fmt)
+    if exporter is None:
+        return HttpResponse(
+            f"Supported export formats: {', '.join(available_formats())}",
+            status=406, content_type='text/plain'
+        )
+    return export_response(request, exporter, request.user)
+
+def export_response(request, exporter, user):
+    roster_version = RosterVersion.for_user(user.pk)
+    etag = export_etag(roster_version, exporter)
+    not_modified = export_not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+
+    # Built once per roster version by the streaming exporters, then sent from disk
+    response = FileResponse(open_cached_export(exporter, user, roster_version), content_type=exporter.content_type)
+    return add_export_headers(response, exporter, etag)
+
+def export_not_modified(request, etag):
+    # A client that already holds this version gets a 304 without the roster being read
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        not_modified['ETag'] = etag
+    return not_modified
+
+def add_export_headers(response, exporter, etag):
+    response['Content-Disposition'] = f'attachment; filename=characters.{exporter.extension}'
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
     return response
 
+@staff_member_required
+def profiling_dashboard(request):
+    summary = profile_store.summary()
+    return render(request, 'profiling_dashboard.html', {
+        'profiling_enabled': settings.CHARACTER_PROFILING,
+        'views': summary,
+        'repeated_queries': [(entry['view'], shape, count)
+                             for entry in summary for shape, count in entry['repeated_queries']],
+        'repeated_query_threshold': REPEATED_QUERY_THRESHOLD,
+    })
+
+def profiling_metrics(request):
+    # Scrapers authenticate with the configured bearer token, people as staff
+    token = settings.CHARACTER_PROFILING_METRICS_TOKEN
+    if not (request.user.is_staff or (token and request.headers.get('Authorization') == f'Bearer {token}')):
+        return HttpResponse(status=403)
+    return HttpResponse(render_prometheus(profile_store.summary()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # User registration and authentication views
 def register(request):
     if request.method == 'POST':
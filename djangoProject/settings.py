@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'characters.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -92,6 +93,19 @@ LOGIN_REDIRECT_URL = 'character_list'
 LOGOUT_REDIRECT_URL = 'landing_page'
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# A file-based cache is shared by every web worker and the import worker, so a
+# roster change made in one process invalidates cached stats for all of them.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -128,6 +142,57 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Uploaded files (import job queue)
+
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Uploads larger than this many bytes are queued as an ImportJob and processed
+# by `manage.py run_import_worker` instead of inside the request.
+CHARACTER_IMPORT_ASYNC_THRESHOLD = 2621440
+# A running job that has not saved progress for this many seconds is taken to
+# have lost its worker and is failed. The insert pass is one transaction that
+# saves no progress, so this must cover inserting the largest upload.
+CHARACTER_IMPORT_JOB_TIMEOUT = 60 * 60
+
+# Roster rule overrides, merged over the defaults in characters/rules.py, e.g.
+# {'position_classes': {'Tank': ['Paladin', 'Warrior', 'Druid']}, 'role_caps': {'Tank': 3}}
+CHARACTER_ROSTER_RULES = {}
+# Optional JSON file with the same shape; edits are picked up without a restart.
+CHARACTER_ROSTER_RULES_FILE = None
+
+# Generated exports, kept per (user, roster version, format) and evicted least
+# recently used first once the directory grows past the byte cap.
+CHARACTER_EXPORT_CACHE_DIR = BASE_DIR / 'export_cache'
+CHARACTER_EXPORT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Per-view request profiling, shown at /profiling/ to staff and at
+# /profiling/metrics/ in Prometheus text format. Tracing memory slows every
+# allocation, so it is a separate switch.
+CHARACTER_PROFILING = False
+CHARACTER_PROFILING_TRACE_MEMORY = False
+# Bearer token that lets a metrics scraper read /profiling/metrics/ without a session.
+CHARACTER_PROFILING_METRICS_TOKEN = None
+
+# Serve upload_csv and export_to_excel from the async views in
+# characters/async_views.py; only worth it when running under asgi.py.
+CHARACTER_ASYNC_VIEWS = False
+# Threads shared by the async views for parsing uploads and encoding exports.
+CHARACTER_ASYNC_CPU_WORKERS = 4
+
+# Every error of an upload is written to a CSV report here, downloadable (as
+# CSV or XLSX) for this many seconds; only a summary is kept in memory.
+CHARACTER_ERROR_REPORT_DIR = BASE_DIR / 'error_reports'
+CHARACTER_ERROR_REPORT_MAX_AGE = 24 * 60 * 60
+# With "stop at the first errors" ticked, an upload is abandoned after this many.
+CHARACTER_UPLOAD_FAIL_FAST_ERRORS = 100
+
+# Resumable uploads through api/uploads/: the file arrives in chunks of this
+# many bytes, written in place under MEDIA_ROOT/uploads. Uploads never
+# finalized are dropped after CHARACTER_CHUNKED_UPLOAD_MAX_AGE seconds.
+CHARACTER_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+CHARACTER_CHUNKED_UPLOAD_MAX_SIZE = 2 * 1024 * 1024 * 1024
+CHARACTER_CHUNKED_UPLOAD_MAX_AGE = 24 * 60 * 60
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 